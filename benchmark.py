@@ -0,0 +1,267 @@
+# benchmark.py
+# Замеры горячих путей симуляции, наблюдений и отрисовки на трассах из tracks/ и синтетических больших трассах
+# (large — 1000x1000, huge — 4000x4000, только по запросу).
+#
+# Примеры:
+#   python benchmark.py                        # прогнать и напечатать
+#   python benchmark.py --save                 # записать результат как базовый (benchmark_baseline.json)
+#   python benchmark.py --compare              # сравнить с базовым; код выхода 1, если что-то замедлилось
+#   python benchmark.py --only get_state --tracks track_05
+#   python benchmark.py --only render car_update --tracks track_05 large huge
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # отрисовка меряется без окна
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from main import Game, GymRacerEnv, RacerEnv, Track
+from track_io import save_track_binary
+from vec_env import VecRacerEnv
+
+BASELINE_PATH = "benchmark_baseline.json"
+BUNDLED_TRACKS = ("track_01", "track_02", "track_05")
+SYNTHETIC_TRACKS = {"large": 1000, "huge": 4000}
+VEC_ENVS = 64
+
+
+def measure(func, min_time=0.2, repeats=5):
+    # Медиана из repeats серий; размер серии подбирается так, чтобы она шла не меньше min_time
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed < min_time / 10 else 1 + int(min_time / max(elapsed, 1e-9))
+
+    timings = [elapsed / loops]
+    for _ in range(repeats - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - started) / loops)
+    return statistics.median(timings)
+
+
+def make_large_track(path, size=SYNTHETIC_TRACKS["large"]):
+    # Кольцо асфальта с поребриками и чекпоинтами на травяном поле
+    ys, xs = np.ogrid[0:size, 0:size]
+    radius = np.hypot((xs - size / 2).astype(np.float32), (ys - size / 2).astype(np.float32))
+    outer, inner = size * 0.45, size * 0.35
+    grid = np.zeros((size, size), dtype=np.uint8)
+    grid[(radius < outer + 2) & (radius > inner - 2)] = 2
+    grid[(radius < outer) & (radius > inner)] = 1
+    middle = (outer + inner) / 2
+    start_x, start_y = int(size / 2 + middle), size // 2
+    grid[start_y - 1:start_y + 1, int(size / 2 + inner):int(size / 2 + outer)] = 3
+    checkpoints = []
+    for i, a in enumerate(np.linspace(0, 2 * np.pi, 9)[1:-1]):
+        checkpoints.append({"id": i + 1, "x": int(size / 2 + middle * np.cos(a)), "y": int(size / 2 + middle * np.sin(a))})
+    save_track_binary({
+        "name": f"Synthetic {size}x{size}",
+        "tile_size": 24,
+        "grid": grid,
+        "start_position": {"x": start_x, "y": start_y, "angle": 90},
+        "checkpoints": checkpoints,
+    }, path)
+    return path
+
+
+# === Замеры ===
+# Каждый принимает путь к трассе и возвращает функцию одного вызова (или None, если замер неприменим)
+def bench_car_update(track_path):
+    env = RacerEnv(track_path)
+    car, track = env.car, env.track
+    return lambda: car.apply_action(5, track)  # газ + вправо (как в обучении): машина ездит по кругу
+
+
+def bench_get_tile(track_path):
+    track = Track(track_path)
+    rng = np.random.default_rng(0)
+    points = list(zip(rng.uniform(0, track.width * track.tile_size, 1024).tolist(),
+                      rng.uniform(0, track.height * track.tile_size, 1024).tolist()))
+    state = {"i": 0}
+
+    def call():
+        x, y = points[state["i"] & 1023]
+        state["i"] += 1
+        return track.get_tile(x, y)
+    return call
+
+
+def bench_cast_ray(track_path):
+    env = RacerEnv(track_path)
+    return lambda: env.cast_ray(0)
+
+
+def bench_get_state(track_path):
+    env = RacerEnv(track_path)
+    return env.get_state
+
+
+def bench_gym_step(track_path):
+    env = GymRacerEnv(track_path)
+    env.reset()
+    actions = np.random.default_rng(0).integers(0, 8, 4096).tolist()
+    state = {"i": 0}
+
+    def call():
+        _, _, terminated, truncated, _ = env.step(actions[state["i"] & 4095])
+        state["i"] += 1
+        if terminated or truncated:
+            env.reset()
+    return call
+
+
+def bench_vec_step(track_path):
+    # Время шага всей пакетной среды; на одну машину — делить на VEC_ENVS
+    env = VecRacerEnv(track_path, num_envs=VEC_ENVS)
+    env.reset()
+    actions = np.random.default_rng(0).integers(0, 8, (64, VEC_ENVS))
+    state = {"i": 0}
+
+    def call():
+        env.step(actions[state["i"] & 63])
+        state["i"] += 1
+    return call
+
+
+def bench_render(track_path):
+    game = Game(track_path, False, True)
+    # Машина едет по кругу около старта: меняются и камера, и угол спрайта
+    cx, cy = game.car.x, game.car.y
+    poses = [(cx + 60 * np.cos(a), cy + 60 * np.sin(a), np.degrees(a) + 90)
+             for a in np.linspace(0, 2 * np.pi, 120, endpoint=False)]
+    state = {"i": 0}
+
+    def call():
+        game.car.x, game.car.y, game.car.angle = poses[state["i"] % 120]
+        game.car.prev_x, game.car.prev_y, game.car.prev_angle = game.car.x, game.car.y, game.car.angle
+        state["i"] += 1
+        game.render()
+    return call
+
+
+BENCHMARKS = {
+    "car_update": bench_car_update,
+    "get_tile": bench_get_tile,
+    "cast_ray": bench_cast_ray,
+    "get_state": bench_get_state,
+    "gym_step": bench_gym_step,
+    "vec_step": bench_vec_step,
+    "render": bench_render,
+}
+
+# Производные величины для сводки: замер -> (подпись, единиц работы за вызов)
+RATES = {
+    "gym_step": ("шагов среды/с", 1),
+    "vec_step": ("шагов машин/с", VEC_ENVS),
+    "render": ("кадров/с", 1),
+}
+
+
+def run(track_paths, only=None, min_time=0.2):
+    results = {}
+    for track_name, track_path in track_paths.items():
+        for bench_name, factory in BENCHMARKS.items():
+            if only and bench_name not in only:
+                continue
+            call = factory(track_path)
+            key = f"{track_name}/{bench_name}"
+            if call is None:
+                print(f"{key:32s} пропущено", file=sys.stderr)
+                continue
+            seconds = measure(call, min_time=min_time)
+            results[key] = seconds * 1e6
+            line = f"{key:32s} {seconds * 1e6:12.2f} мкс"
+            if bench_name in RATES:
+                label, per_call = RATES[bench_name]
+                line += f"   {per_call / seconds:12.0f} {label}"
+            print(line, file=sys.stderr)
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pygame": pygame.version.ver,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Замедление больше tolerance (доля) — регрессия; замеров без базы не сравниваем
+    regressions = []
+    print(f"{'замер':32s} {'база, мкс':>12s} {'сейчас, мкс':>12s} {'изм.':>8s}")
+    for key, value in results.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            print(f"{key:32s} {'—':>12s} {value:12.2f}")
+            continue
+        change = value / base - 1.0
+        mark = ""
+        if change > tolerance:
+            mark = "  ❌ медленнее"
+            regressions.append(key)
+        elif change < -tolerance:
+            mark = "  ✅ быстрее"
+        print(f"{key:32s} {base:12.2f} {value:12.2f} {change:+8.1%}{mark}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарки симуляции, наблюдений и отрисовки")
+    parser.add_argument("--tracks", nargs="+", default=list(BUNDLED_TRACKS) + ["large"],
+                        help="имена трасс из tracks/ и/или large, huge (синтетические)")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="только эти замеры")
+    parser.add_argument("--min-time", type=float, default=0.2, help="минимальная длительность серии, с")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="записать результат как базовый")
+    parser.add_argument("--compare", action="store_true", help="сравнить с базовым")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление (0.25 = 25%%)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        track_paths = {}
+        for name in args.tracks:
+            if name in SYNTHETIC_TRACKS:
+                track_paths[name] = make_large_track(os.path.join(tmp, name + ".trk"), SYNTHETIC_TRACKS[name])
+            else:
+                track_paths[name] = os.path.join("tracks", name + ".json")
+        results = run(track_paths, only=args.only, min_time=args.min_time)
+    pygame.quit()
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+        print(f"✅ Базовые замеры записаны: {args.baseline}", file=sys.stderr)
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ Замедлилось: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# editor_tools.py
+# Инструменты редактора трасс поверх сетки NumPy: кисть любого радиуса (квадратная или круглая) с протяжкой
+# по отрезку между событиями мыши, заливка прямоугольника, заливка области (построчная, по отрезкам строк)
+# и отмена/повтор.
+#
+# История хранит не копии сетки, а разницу каждой операции: индексы изменённых клеток, старые и новые значения
+# (6 байт на клетку). Мазок кистью от нажатия до отпускания — одна запись. Объём истории ограничен max_bytes
+# и max_steps: самые старые записи вытесняются.
+
+from collections import deque
+
+import numpy as np
+
+BRUSH_SHAPES = ("square", "round")
+
+
+def brush_footprint(radius, shape="square"):
+    size = 2 * radius + 1
+    if shape == "round":
+        dy, dx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+        return dx * dx + dy * dy <= (radius + 0.5) ** 2
+    return np.ones((size, size), dtype=bool)
+
+
+def line_points(x0, y0, x1, y1):
+    # Клетки отрезка без пропусков (шаг не больше одной клетки по каждой оси)
+    steps = max(abs(x1 - x0), abs(y1 - y0))
+    if steps == 0:
+        return np.array([x0]), np.array([y0])
+    t = np.arange(steps + 1) / steps
+    return np.rint(x0 + (x1 - x0) * t).astype(np.int64), np.rint(y0 + (y1 - y0) * t).astype(np.int64)
+
+
+def stroke_mask(x0, y0, x1, y1, radius, shape="square"):
+    # Маска следа кисти вдоль отрезка: (левый, верхний, маска) в координатах сетки (могут выходить за край)
+    footprint = brush_footprint(radius, shape)
+    xs, ys = line_points(x0, y0, x1, y1)
+    left, top = int(xs.min()) - radius, int(ys.min()) - radius
+    mask = np.zeros((int(ys.max()) - top + radius + 1, int(xs.max()) - left + radius + 1), dtype=bool)
+    size = 2 * radius + 1
+    for x, y in zip((xs - left - radius).tolist(), (ys - top - radius).tolist()):
+        mask[y:y + size, x:x + size] |= footprint
+    return left, top, mask
+
+
+def flood_fill_spans(grid, x, y, value):
+    # Построчная заливка по сериям: границы серий подходящих клеток во всех строках считаются заранее
+    # одним проходом NumPy, дальше обход идёт от серии к серии (по O(1) на серию, а не на клетку).
+    # Пишет value в grid; возвращает закрашенные отрезки [(строка, начало, конец)] и прежнее значение
+    height, width = grid.shape
+    target = int(grid[y, x])
+    if target == value:
+        return [], target
+    match = grid == target
+    index = np.arange(width, dtype=np.int32)
+    # Для подходящей клетки — конец её серии; для любой — первая подходящая клетка не левее неё (или width)
+    run_end = np.minimum.accumulate(np.where(match, width, index)[:, ::-1], axis=1)[:, ::-1]
+    next_run = np.minimum.accumulate(np.where(match, index, width)[:, ::-1], axis=1)[:, ::-1]
+    run_start = np.maximum.accumulate(np.where(match, 0, index + 1), axis=1)
+    ends, nexts, starts = (memoryview(np.ascontiguousarray(a, dtype=np.int32)) for a in (run_end, next_run, run_start))
+    cells = memoryview(grid)
+
+    spans = []
+    stack = [(x, y)]
+    while stack:
+        sx, sy = stack.pop()
+        if cells[sy, sx] != target:
+            continue  # серия уже залита
+        start, end = starts[sy, sx], ends[sy, sx]
+        grid[sy, start:end] = value
+        spans.append((sy, start, end))
+        for ny in (sy - 1, sy + 1):
+            if 0 <= ny < height:
+                nx = nexts[ny, start]
+                while nx < end:
+                    if cells[ny, nx] == target:
+                        stack.append((nx, ny))
+                    nx = ends[ny, nx]
+                    if nx < width:
+                        nx = nexts[ny, nx]
+    return spans, target
+
+
+class EditHistory:
+    # Все правки сетки идут через этот класс: он пишет в grid и запоминает разницу.
+    # begin()/commit() объединяют несколько правок (мазок кистью) в одну запись отмены.
+    # Методы правки возвращают затронутую рамку (x0, y0, x1, y1) для перерисовки или None.
+    def __init__(self, grid, max_bytes=64 * 1024 * 1024, max_steps=500):
+        self.grid = grid
+        self.flat = grid.reshape(-1)  # вид той же памяти
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.bytes_used = 0
+        self.current = None
+
+    def begin(self):
+        if self.current is None:
+            self.current = ([], [], [])
+
+    def commit(self):
+        if self.current is None:
+            return
+        indices, old, new = self.current
+        self.current = None
+        if not indices:
+            return
+        indices = np.concatenate(indices)
+        old = np.concatenate(old)
+        new = np.concatenate(new)
+        if len(indices) > 1:
+            # Клетка, закрашенная в мазке несколько раз: для отмены нужно первое старое значение, для повтора —
+            # последнее новое
+            order = np.argsort(indices, kind="stable")
+            indices, old, new = indices[order], old[order], new[order]
+            first = np.concatenate(([True], indices[1:] != indices[:-1]))
+            last = np.concatenate((indices[1:] != indices[:-1], [True]))
+            indices, old, new = indices[first], old[first], new[last]
+        keep = old != new
+        indices, old, new = indices[keep], old[keep], new[keep]
+        if not indices.size:
+            return
+        width = self.grid.shape[1]
+        ys, xs = indices // width, indices % width
+        bounds = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        entry = (indices.astype(np.int32), old, new, bounds)
+        self.undo_stack.append(entry)
+        self.bytes_used += self.entry_bytes(entry)
+        for dropped in self.redo_stack:
+            self.bytes_used -= self.entry_bytes(dropped)
+        self.redo_stack = []
+        while len(self.undo_stack) > 1 and (self.bytes_used > self.max_bytes or len(self.undo_stack) > self.max_steps):
+            self.bytes_used -= self.entry_bytes(self.undo_stack.popleft())
+
+    @staticmethod
+    def entry_bytes(entry):
+        return entry[0].nbytes + entry[1].nbytes + entry[2].nbytes
+
+    def record(self, indices, old, value):
+        self.begin()
+        self.current[0].append(indices)
+        self.current[1].append(old)
+        self.current[2].append(np.full(len(indices), value, dtype=np.uint8))
+
+    def paint_mask(self, left, top, mask, value):
+        # Закрасить клетки маски (в координатах сетки, с обрезкой по краю); одиночный вызов — своя запись отмены
+        height, width = self.grid.shape
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + mask.shape[1], width), min(top + mask.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        region = self.grid[y0:y1, x0:x1]
+        changed = mask[y0 - top:y1 - top, x0 - left:x1 - left] & (region != value)
+        if not changed.any():
+            return None
+        ys, xs = np.nonzero(changed)
+        standalone = self.current is None
+        self.record((ys + y0) * width + (xs + x0), region[ys, xs], value)
+        region[changed] = value
+        if standalone:
+            self.commit()
+        return x0, y0, x1, y1
+
+    def stroke(self, x0, y0, x1, y1, radius, value, shape="square"):
+        left, top, mask = stroke_mask(x0, y0, x1, y1, radius, shape)
+        return self.paint_mask(left, top, mask, value)
+
+    def fill_rect(self, x0, y0, x1, y1, value):
+        # Углы включительно, в любом порядке
+        left, right = min(x0, x1), max(x0, x1)
+        top, bottom = min(y0, y1), max(y0, y1)
+        return self.paint_mask(left, top, np.ones((bottom - top + 1, right - left + 1), dtype=bool), value)
+
+    def flood_fill(self, x, y, value):
+        height, width = self.grid.shape
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+        spans, target = flood_fill_spans(self.grid, x, y, value)
+        if not spans:
+            return None
+        rows = np.array([s[0] for s in spans], dtype=np.int64)
+        starts = np.array([s[1] for s in spans], dtype=np.int64)
+        lengths = np.array([s[2] - s[1] for s in spans], dtype=np.int64)
+        # Индексы всех клеток отрезков без цикла по клеткам
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        indices = np.repeat(rows * width + starts, lengths) + offsets
+        standalone = self.current is None
+        self.record(indices, np.full(len(indices), target, dtype=np.uint8), value)
+        if standalone:
+            self.commit()
+        return int(starts.min()), int(rows.min()), int((starts + lengths).max()), int(rows.max()) + 1
+
+    def undo(self):
+        self.commit()
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        indices, old, new, bounds = entry
+        self.flat[indices] = old
+        self.redo_stack.append(entry)  # bytes_used учитывает записи обоих стеков
+        return bounds
+
+    def redo(self):
+        self.commit()
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        indices, old, new, bounds = entry
+        self.flat[indices] = new
+        self.undo_stack.append(entry)
+        return bounds
@@ -0,0 +1,209 @@
+# evaluate_ai.py
+# Оценка сохранённых моделей без окна: каждая пара (модель, трасса) — отдельная задача в пуле процессов,
+# внутри задачи M заездов идут одной пакетной средой VecRacerEnv и одним predict на тик.
+#
+# Примеры:
+#   python evaluate_ai.py                                          # все models/*.zip на всех tracks/*.json
+#   python evaluate_ai.py --models "models/racer_model_*_steps.zip" --episodes 16 --laps 3
+#   python evaluate_ai.py --out results.json --workers 8
+#   python evaluate_ai.py --replays replays/eval                  # сохранить каждый заезд (python replay.py ...)
+
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from main import ACTION_CONTROLS, LapTimer, PHYSICS_HZ, SensorConfig
+from policy_export import load_policy
+from replay import REPLAY_EXT, ReplayWriter, encode_controls
+from track_progress import load_progress
+from vec_env import VecRacerEnv
+
+_models = {}  # модели, уже загруженные в этом процессе
+ACTION_CODES = [encode_controls(*controls) for controls in ACTION_CONTROLS]
+
+
+def _init_worker():
+    # Параллелизм — на уровне процессов; torch (если модель без экспорта .npz) прочитает это при импорте
+    os.environ["OMP_NUM_THREADS"] = "1"
+    os.environ["MKL_NUM_THREADS"] = "1"
+
+
+def load_model(model_path):
+    model = _models.get(model_path)
+    if model is None:
+        model = load_policy(model_path)
+        _models[model_path] = model
+    return model
+
+
+def replay_name(model_path, track_path, seed, episode):
+    model_name = os.path.splitext(os.path.basename(model_path))[0]
+    track_name = os.path.splitext(os.path.basename(track_path))[0]
+    return f"{model_name}@{track_name}_s{seed}_e{episode}{REPLAY_EXT}"
+
+
+def evaluate_pair(model_path, track_path, episodes=8, laps=1, max_steps=PHYSICS_HZ * 300, seed=0,
+                  deterministic=False, replay_dir=None):
+    # Заезд заканчивается аварией (трава), проходом laps кругов или по лимиту max_steps.
+    # replay_dir — каждый заезд пишется туда отдельным повтором
+    model = load_model(model_path)
+    model.set_random_seed(seed)
+
+    env = VecRacerEnv(track_path, num_envs=episodes, sensors=SensorConfig.for_model(model_path))
+    obs = env.reset()
+    progress = load_progress(env.track, track_path)
+    timers = [LapTimer(env.track, progress) for _ in range(episodes)]
+    active = np.ones(episodes, dtype=bool)
+    crashed = np.zeros(episodes, dtype=bool)
+    completed = np.zeros(episodes, dtype=bool)
+    total_reward = np.zeros(episodes, dtype=np.float64)
+    steps = np.zeros(episodes, dtype=np.int64)
+    recorders = []
+    if replay_dir:
+        meta = {"track": track_path, "driver": os.path.basename(model_path), "seed": seed, "created": time.time()}
+        recorders = [ReplayWriter(os.path.join(replay_dir, replay_name(model_path, track_path, seed, i)),
+                                  env.track, dict(meta, episode=i), PHYSICS_HZ) for i in range(episodes)]
+
+    started = time.perf_counter()
+    for _ in range(max_steps):
+        for i in np.flatnonzero(active):
+            timers[i].update(env.x[i], env.y[i])
+            if timers[i].laps_completed >= laps:
+                completed[i] = True
+                active[i] = False
+        if not active.any():
+            break
+
+        actions, _ = model.predict(obs, deterministic=deterministic)
+        if recorders:
+            for i in np.flatnonzero(active):
+                recorders[i].record_code(ACTION_CODES[actions[i]], env.x[i], env.y[i], env.angle[i], env.speed[i],
+                                         env.brake_factor[i])
+        obs, rewards, dones, _ = env.step(actions)
+        total_reward[active] += rewards[active]
+        steps[active] += 1
+        crashed |= dones & active
+        active &= ~dones
+    elapsed = time.perf_counter() - started
+    for i, recorder in enumerate(recorders):
+        outcome = "finish" if completed[i] else "crash" if crashed[i] else "timeout"
+        recorder.close({"outcome": outcome, "reward": float(total_reward[i]), "lap_times": timers[i].lap_times,
+                        "lap_ticks": timers[i].lap_ticks, "best_lap_time": timers[i].best_lap_time})
+
+    lap_times = [t for timer in timers for t in timer.lap_times]
+    return {
+        "model": model_path,
+        "track": track_path,
+        "episodes": episodes,
+        "laps": laps,
+        "seed": seed,
+        "completion_rate": float(completed.mean()),
+        "crash_rate": float(crashed.mean()),
+        "timeout_rate": float((~completed & ~crashed).mean()),
+        "mean_reward": float(total_reward.mean()),
+        "mean_steps": float(steps.mean()),
+        "lap_times": lap_times,
+        "best_lap_time": min(lap_times) if lap_times else None,
+        "mean_lap_time": sum(lap_times) / len(lap_times) if lap_times else None,
+        "steps_per_sec": float(steps.sum() / elapsed) if elapsed > 0 else 0.0,
+    }
+
+
+def evaluate(model_paths, track_paths, workers=None, start_method=None, **kwargs):
+    if start_method is None:
+        start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+    jobs = [(model_path, track_path) for model_path in model_paths for track_path in track_paths]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context(start_method),
+                             initializer=_init_worker) as pool:
+        futures = [pool.submit(evaluate_pair, model_path, track_path, **kwargs)
+                   for model_path, track_path in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"{os.path.basename(result['model'])} @ {os.path.basename(result['track'])}: "
+                  f"финиш {result['completion_rate']:.0%}, аварии {result['crash_rate']:.0%}, "
+                  f"награда {result['mean_reward']:.1f}, {result['steps_per_sec']:.0f} шагов/с",
+                  file=sys.stderr)
+            results.append(result)
+    results.sort(key=lambda r: (r["model"], r["track"]))
+    return results
+
+
+def rank_models(results):
+    # Сводка по моделям: доля финишей по всем трассам, затем среднее лучшее время круга
+    by_model = {}
+    for result in results:
+        by_model.setdefault(result["model"], []).append(result)
+    ranking = []
+    for model_path, rows in by_model.items():
+        best = [r["best_lap_time"] for r in rows if r["best_lap_time"] is not None]
+        ranking.append({
+            "model": model_path,
+            "completion_rate": sum(r["completion_rate"] for r in rows) / len(rows),
+            "crash_rate": sum(r["crash_rate"] for r in rows) / len(rows),
+            "mean_reward": sum(r["mean_reward"] for r in rows) / len(rows),
+            "mean_best_lap_time": sum(best) / len(best) if best else None,
+        })
+    ranking.sort(key=rank_key)
+    return ranking
+
+
+def rank_key(row):
+    # Порядок строк rank_models: чем меньше ключ, тем лучше модель
+    best_lap = row["mean_best_lap_time"]
+    return -row["completion_rate"], best_lap if best_lap is not None else float("inf"), -row["mean_reward"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Оценка моделей на трассах без отрисовки")
+    parser.add_argument("--models", nargs="+", default=["models/*.zip"], help="пути или маски zip-моделей")
+    parser.add_argument("--tracks", nargs="+", default=["tracks/*.json"], help="пути или маски трасс")
+    parser.add_argument("--episodes", type=int, default=8, help="заездов на пару модель/трасса")
+    parser.add_argument("--laps", type=int, default=1, help="кругов для зачёта финиша")
+    parser.add_argument("--max-steps", type=int, default=PHYSICS_HZ * 300, help="лимит тиков на заезд")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--deterministic", action="store_true",
+                        help="жадные действия (все заезды пары тогда одинаковы — хватит --episodes 1)")
+    parser.add_argument("--workers", type=int, default=None, help="процессов (по умолчанию — по числу ядер)")
+    parser.add_argument("--start-method", default=None, help="fork / forkserver / spawn")
+    parser.add_argument("--out", default=None, help="куда записать JSON (по умолчанию — stdout)")
+    parser.add_argument("--replays", default=None, metavar="DIR", help="сохранить повтор каждого заезда в DIR")
+    return parser.parse_args()
+
+
+def expand(patterns):
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or ([pattern] if os.path.exists(pattern) else []))
+    return paths
+
+
+def main():
+    args = parse_args()
+    model_paths = expand(args.models)
+    track_paths = expand(args.tracks)
+    if not model_paths or not track_paths:
+        sys.exit("Нет моделей или трасс для оценки")
+
+    results = evaluate(model_paths, track_paths, workers=args.workers, start_method=args.start_method,
+                       episodes=args.episodes, laps=args.laps, max_steps=args.max_steps, seed=args.seed,
+                       deterministic=args.deterministic, replay_dir=args.replays)
+    report = {"results": results, "ranking": rank_models(results)}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"✅ Результаты: {args.out}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == "__main__":
+    main()
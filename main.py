@@ -3,20 +3,29 @@ import json
 import os
 import math
 import sys
+import time
+from collections import OrderedDict
 import numpy as np
-import gym
 import gymnasium as gym
-from gym import spaces
-from stable_baselines3.common.env_checker import check_env  # для отладки
+from track_io import BackgroundSaver, load_track_data
+from editor_tools import BRUSH_SHAPES, EditHistory
+from profiler import FrameProfiler, run_with_cprofile
+from replay import ReplayWriter, best_replay_path, save_best_lap, session_replay_path
+from track_progress import load_progress
 
-pygame.init()
+# Импорт модуля не трогает дисплей и ассеты: Track, Car, RacerEnv и GymRacerEnv работают без экрана
+# (обучение на серверах). pygame.init() и загрузка спрайтов происходят только при отрисовке.
 
 # === Настройки экрана ===
 FULLSCREEN_DEFAULT = True
-info = pygame.display.Info()
-NATIVE_WIDTH, NATIVE_HEIGHT = info.current_w, info.current_h
 FPS = 60
 TILE_SIZE = 24
+CHUNK_TILES = 16  # сторона куска трассы в тайлах: отрисовка и кэш поверхностей идут кусками
+
+# Физика идёт фиксированными тиками, не зависящими от частоты кадров
+PHYSICS_HZ = 60
+PHYSICS_DT = 1.0 / PHYSICS_HZ
+MAX_FRAME_TIME = 0.25  # после долгого кадра (перетаскивание окна и т.п.) не догоняем больше этого
 
 # Типы покрытия
 SURFACE_TYPES = {
@@ -25,58 +34,306 @@ SURFACE_TYPES = {
     2: {"name": "curb", "traction": 0.6, "color": (169, 169, 169)},
     3: {"name": "start_finish", "traction": 1.0, "color": (255, 255, 0)},  # Желтый
 }
-
-os.makedirs("tracks", exist_ok=True)
-os.makedirs("assets", exist_ok=True)
+WALL_TILES = (0, 2)  # лучи датчиков останавливаются на offroad и curb
+
+# Датчики расстояния (лучи) для ИИ
+RAY_ANGLES = (-90, -45, 0, 45, 90)
+RAY_MAX_DISTANCE = 200
+
+# Управление машиной: (газ, тормоз, руль -1 влево / 0 / 1 вправо, ручник) для каждого действия ИИ
+ACTION_CONTROLS = (
+    (True, False, 0, False),   # 0: газ
+    (False, True, 0, False),   # 1: тормоз
+    (False, False, -1, False),  # 2: влево
+    (False, False, 1, False),  # 3: вправо
+    (True, False, -1, False),  # 4: газ + влево
+    (True, False, 1, False),   # 5: газ + вправо
+    (False, True, -1, False),  # 6: тормоз + влево
+    (False, True, 1, False),   # 7: тормоз + вправо
+)
+
+CHECKPOINT_AREA = 2.5  # Радиус области чекпоинта в тайлах (для 5x5 это 2)
+CHECKPOINT_RING_TILES = 3  # насколько тайлов от центра чекпоинта доходит его кольцо на экране
+LAP_MIN_PROGRESS = 0.9  # круг засчитывается, если вперёд вдоль трассы пройдено не меньше этой доли круга
+WRONG_WAY_SPEED = 3.0  # сглаженный откат по трассе (пикселей за тик), после которого «не в ту сторону»
+WRONG_WAY_SMOOTHING = 0.02  # ≈ секунда сглаживания
+
+CAR_IMAGE_PATH = 'assets/car.png'
+CAR_IMAGE_SIZE = (100, 50)
 
 
 # === Вспомогательные функции ===
+_native_size = None
+_car_image = None
+
+
+def get_native_size():
+    # Разрешение экрана запрашивается один раз, при первом открытии окна
+    global _native_size
+    if _native_size is None:
+        pygame.display.init()
+        info = pygame.display.Info()
+        _native_size = (info.current_w, info.current_h)
+    return _native_size
+
+
 def load_image(path, fallback_color=(100, 100, 100)):
     if os.path.exists(path):
         return pygame.image.load(path).convert()
     else:
-        surf = pygame.Surface((NATIVE_WIDTH, NATIVE_HEIGHT))
+        surf = pygame.Surface(get_native_size())
         surf.fill(fallback_color)
         return surf
 
 
+_fonts = {}
+
+
+def get_font(size, name=None):
+    # SysFont ищет шрифт в системной базе и очень медленный — каждый размер создаётся один раз
+    font = _fonts.get((name, size))
+    if font is None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        font = pygame.font.SysFont(name, size)
+        _fonts[(name, size)] = font
+    return font
+
+
+def load_car_image():
+    # Спрайт общий для всех машин и загружается только когда машину впервые рисуют
+    global _car_image
+    if _car_image is None:
+        image = pygame.Surface(CAR_IMAGE_SIZE)
+        image.fill((255, 0, 0))
+        if os.path.exists(CAR_IMAGE_PATH):
+            image = pygame.image.load(CAR_IMAGE_PATH).convert_alpha()
+            image = pygame.transform.scale(image, CAR_IMAGE_SIZE)
+        _car_image = image
+    return _car_image
+
+
+def controls_from_keys(keys):
+    # Клавиши (pygame.key.get_pressed() или словарь) -> то же управление, что у ИИ
+    return keys[pygame.K_w], keys[pygame.K_s], keys[pygame.K_d] - keys[pygame.K_a], keys[pygame.K_SPACE]
+
+
 # === Классы игры ===
 class Track:
     def __init__(self, filename):
-        with open(filename, 'r') as f:
-            data = json.load(f)
+        # .json или компактный .trk (см. track_io.py); сетка — непрерывный массив uint8 (height, width)
+        self.load_data(load_track_data(filename))
+
+    @classmethod
+    def from_data(cls, data):
+        track = cls.__new__(cls)
+        track.load_data(data)
+        return track
+
+    def load_data(self, data):
         self.name = data['name']
         self.width = data['width']
         self.height = data['height']
         self.tile_size = data['tile_size']
         self.grid = data['grid']
         self.start_pos = data['start_position']
+        self.revision = 0  # растёт при любом изменении трассы (сбрасывает кэши отрисовки)
         self.checkpoints = data.get('checkpoints', [])
 
+        self.cells = memoryview(self.grid)  # быстрый доступ к одной клетке: cells[y, x] -> int
+        self.wall_lut = np.zeros(256, dtype=bool)
+        self.wall_lut[list(WALL_TILES)] = True
+        # Сцепление по id покрытия списком Python-чисел: неизвестные id — как поребрик, как в get_surface_info
+        self.traction = [SURFACE_TYPES.get(tile_id, SURFACE_TYPES[2])['traction'] for tile_id in range(256)]
+
     def get_tile(self, x, y):
         tile_x = int(x // self.tile_size)
         tile_y = int(y // self.tile_size)
         if 0 <= tile_x < self.width and 0 <= tile_y < self.height:
-            return self.grid[tile_y][tile_x]
+            return self.cells[tile_y, tile_x]
         return 2
 
+    def tiles_at(self, x, y):
+        # Векторный get_tile: x, y — массивы мировых координат любой формы
+        tile_x = np.floor(np.asarray(x) / self.tile_size).astype(np.int64)
+        tile_y = np.floor(np.asarray(y) / self.tile_size).astype(np.int64)
+        return self.tiles_at_index(tile_x, tile_y)
+
+    def tiles_at_index(self, tile_x, tile_y):
+        inside = (tile_x >= 0) & (tile_x < self.width) & (tile_y >= 0) & (tile_y < self.height)
+        tiles = self.grid[np.clip(tile_y, 0, self.height - 1), np.clip(tile_x, 0, self.width - 1)]
+        return np.where(inside, tiles, 2)
+
+    def is_wall(self, tile_x, tile_y):
+        if 0 <= tile_x < self.width and 0 <= tile_y < self.height:
+            return self.cells[tile_y, tile_x] in WALL_TILES
+        return True
+
+    def cast_ray(self, x, y, angle, max_distance=RAY_MAX_DISTANCE):
+        # Обход по границам тайлов (Amanatides–Woo): проверяются только тайлы, которые пересекает луч.
+        # Возвращает расстояние до первой стены (offroad/curb), нормированное на max_distance.
+        ts = self.tile_size
+        tile_x = int(x // ts)
+        tile_y = int(y // ts)
+        if self.is_wall(tile_x, tile_y):
+            return 0.0
+
+        rad = math.radians(angle)
+        dir_x = math.cos(rad)
+        dir_y = math.sin(rad)
+
+        if dir_x > 0:
+            step_x, t_max_x, t_delta_x = 1, ((tile_x + 1) * ts - x) / dir_x, ts / dir_x
+        elif dir_x < 0:
+            step_x, t_max_x, t_delta_x = -1, (tile_x * ts - x) / dir_x, -ts / dir_x
+        else:
+            step_x, t_max_x, t_delta_x = 0, math.inf, math.inf
+        if dir_y > 0:
+            step_y, t_max_y, t_delta_y = 1, ((tile_y + 1) * ts - y) / dir_y, ts / dir_y
+        elif dir_y < 0:
+            step_y, t_max_y, t_delta_y = -1, (tile_y * ts - y) / dir_y, -ts / dir_y
+        else:
+            step_y, t_max_y, t_delta_y = 0, math.inf, math.inf
+
+        while True:
+            if t_max_x < t_max_y:
+                dist = t_max_x
+                tile_x += step_x
+                t_max_x += t_delta_x
+            else:
+                dist = t_max_y
+                tile_y += step_y
+                t_max_y += t_delta_y
+            if dist >= max_distance:
+                return 1.0
+            if self.is_wall(tile_x, tile_y):
+                return dist / max_distance
+
+    def cast_rays(self, x, y, angles, max_distance=RAY_MAX_DISTANCE):
+        # Пакетная версия cast_ray: x, y, angles транслируются (broadcast) друг с другом,
+        # результат — массив нормированных расстояний той же формы.
+        if np.ndim(x) == 0 and np.ndim(y) == 0 and np.size(angles) <= 32:
+            # Одна машина: обход в Python быстрее накладных расходов NumPy
+            x, y = float(x), float(y)
+            angles = np.asarray(angles, dtype=np.float64)
+            return np.array([self.cast_ray(x, y, a, max_distance) for a in angles.ravel().tolist()],
+                            dtype=np.float64).reshape(angles.shape)
+
+        x, y, angles = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                           np.asarray(y, dtype=np.float64),
+                                           np.asarray(angles, dtype=np.float64))
+        shape = angles.shape
+        x, y = x.ravel(), y.ravel()
+        rad = np.radians(angles.ravel())
+        dir_x, dir_y = np.cos(rad), np.sin(rad)
+
+        ts = self.tile_size
+        tile_x = np.floor(x / ts).astype(np.int64)
+        tile_y = np.floor(y / ts).astype(np.int64)
+        step_x = np.sign(dir_x).astype(np.int64)
+        step_y = np.sign(dir_y).astype(np.int64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_delta_x = np.where(step_x != 0, ts / np.abs(dir_x), np.inf)
+            t_delta_y = np.where(step_y != 0, ts / np.abs(dir_y), np.inf)
+            t_max_x = np.where(step_x != 0, ((tile_x + (step_x > 0)) * ts - x) / dir_x, np.inf)
+            t_max_y = np.where(step_y != 0, ((tile_y + (step_y > 0)) * ts - y) / dir_y, np.inf)
+
+        result = np.ones(x.shape, dtype=np.float64)
+        hit = self.wall_lut[self.tiles_at_index(tile_x, tile_y)]
+        result[hit] = 0.0
+        active = np.flatnonzero(~hit)
+        while active.size:
+            use_x = t_max_x[active] < t_max_y[active]
+            dist = np.where(use_x, t_max_x[active], t_max_y[active])
+            tile_x[active] += np.where(use_x, step_x[active], 0)
+            tile_y[active] += np.where(use_x, 0, step_y[active])
+            t_max_x[active] += np.where(use_x, t_delta_x[active], 0.0)
+            t_max_y[active] += np.where(use_x, 0.0, t_delta_y[active])
+
+            too_far = dist >= max_distance
+            hit = ~too_far & self.wall_lut[self.tiles_at_index(tile_x[active], tile_y[active])]
+            result[active[hit]] = dist[hit] / max_distance
+            active = active[~(too_far | hit)]
+        return result.reshape(shape)
+
     def get_surface_info(self, x, y):
         tile_id = self.get_tile(x, y)
         return SURFACE_TYPES.get(tile_id, SURFACE_TYPES[2])
 
-    def is_checkpoint(self, x, y):
-        tile_x = int(x // self.tile_size)
-        tile_y = int(y // self.tile_size)
+    def traction_at(self, x, y):
+        return self.traction[self.get_tile(x, y)]
+
+    # === Чекпоинты ===
+    # Области чекпоинтов растеризуются один раз в слой checkpoint_layer (индекс чекпоинта или -1 на тайл),
+    # поэтому запрос — одно обращение к массиву при любом числе чекпоинтов.
+    # Слой покрывает только рамку вокруг областей (и выходящих за край трассы) — не всю сетку,
+    # поэтому на огромной трассе он не больше нужного.
+    @property
+    def checkpoints(self):
+        return self._checkpoints
+
+    @checkpoints.setter
+    def checkpoints(self, checkpoints):
+        # Присвоение (в том числе из редактора) сразу перестраивает слой
+        self._checkpoints = list(checkpoints)
+        self.build_checkpoint_layer()
+        self.revision += 1
+
+    def mark_changed(self):
+        # Вызывается после правки сетки на месте (редактор)
+        self.revision += 1
+
+    def build_checkpoint_layer(self):
+        areas = [(math.ceil(cp['x'] - CHECKPOINT_AREA), math.floor(cp['x'] + CHECKPOINT_AREA),
+                  math.ceil(cp['y'] - CHECKPOINT_AREA), math.floor(cp['y'] + CHECKPOINT_AREA))
+                 for cp in self._checkpoints]
+        if not areas:
+            areas = [(0, -1, 0, -1)]  # пустой слой 1x1
+        min_x = min(a[0] for a in areas)
+        max_x = max(max(a[1] for a in areas), min_x)
+        min_y = min(a[2] for a in areas)
+        max_y = max(max(a[3] for a in areas), min_y)
+
+        dtype = np.int16 if len(areas) < 2 ** 15 else np.int32
+        layer = np.full((max_y - min_y + 1, max_x - min_x + 1), -1, dtype=dtype)
+        # Обход с конца: при пересечении областей остаётся первый чекпоинт списка, как при линейном поиске
+        for index in range(len(areas) - 1, -1, -1):
+            x0, x1, y0, y1 = areas[index]
+            layer[y0 - min_y:y1 - min_y + 1, x0 - min_x:x1 - min_x + 1] = index
+
+        self.checkpoint_origin = (min_x, min_y)
+        self.checkpoint_layer = layer
+        self.checkpoint_cells = memoryview(layer)
+        self.checkpoint_ids = np.array([cp['id'] for cp in self._checkpoints] + [-1], dtype=np.int64)
 
-        for cp in self.checkpoints:
-            area_size = 2.5  # Радиус области (для 5x5 это 2)
-            if cp['x'] - area_size <= tile_x <= cp['x'] + area_size and cp['y'] - area_size <= tile_y <= cp[
-                'y'] + area_size:
-                return cp['id']
+    def is_checkpoint(self, x, y):
+        tile_x = int(x // self.tile_size) - self.checkpoint_origin[0]
+        tile_y = int(y // self.tile_size) - self.checkpoint_origin[1]
+        if 0 <= tile_y < self.checkpoint_layer.shape[0] and 0 <= tile_x < self.checkpoint_layer.shape[1]:
+            index = self.checkpoint_cells[tile_y, tile_x]
+            if index >= 0:
+                return self._checkpoints[index]['id']
         return None
 
+    def checkpoints_at(self, x, y):
+        # Векторный is_checkpoint: id чекпоинта или -1
+        h, w = self.checkpoint_layer.shape
+        tile_x = np.floor(np.asarray(x) / self.tile_size).astype(np.int64) - self.checkpoint_origin[0]
+        tile_y = np.floor(np.asarray(y) / self.tile_size).astype(np.int64) - self.checkpoint_origin[1]
+        inside = (tile_x >= 0) & (tile_x < w) & (tile_y >= 0) & (tile_y < h)
+        index = self.checkpoint_layer[np.clip(tile_y, 0, h - 1), np.clip(tile_x, 0, w - 1)]
+        return self.checkpoint_ids[np.where(inside, index, -1)]
+
 
 class Car:
+    # Параметры физики (общие для Car и VecRacerEnv)
+    max_speed = 15.0
+    acceleration = 0.1
+    friction = 0.1
+    steering = 3.0
+    brake_decay = 0.92  # можно настроить: 0.9 = медленнее, 0.8 = быстрее
+    handbrake_traction = 0.05
+
     def __init__(self, x, y, angle=0):
         self.brake_factor = 1.0
         self.braking = False
@@ -84,61 +341,65 @@ class Car:
         self.y = y
         self.angle = angle
         self.speed = 0
-        self.max_speed = 15.0
-        self.acceleration = 0.1
-        self.friction = 0.1
-        self.steering = 3.0
         self.handbrake = False
         self.prev_x = self.x
         self.prev_y = self.y
+        self.prev_angle = self.angle
+
+    @property
+    def original_image(self):
+        return load_car_image()
 
-        self.original_image = pygame.Surface((100, 50))
-        self.original_image.fill((255, 0, 0))
-        if os.path.exists('assets/car.png'):
-            self.original_image = pygame.image.load('assets/car.png').convert_alpha()
-            self.original_image = pygame.transform.scale(self.original_image, (100, 50))
+    def interpolated(self, alpha):
+        # Положение между предыдущим и текущим тиком физики — для плавной отрисовки
+        return (self.prev_x + (self.x - self.prev_x) * alpha,
+                self.prev_y + (self.y - self.prev_y) * alpha,
+                self.prev_angle + (self.angle - self.prev_angle) * alpha)
 
     def update(self, keys, track):
+        self.control(*controls_from_keys(keys), track)
+
+    def apply_action(self, action, track):
+        self.control(*ACTION_CONTROLS[action], track)
+
+    def control(self, throttle, brake, steer, handbrake, track):
+        # Один тик физики. steer: -1 влево, 0 прямо, 1 вправо
         self.prev_x = self.x
         self.prev_y = self.y
+        self.prev_angle = self.angle
         # Управление газом
-        if keys[pygame.K_w]:
+        if throttle:
             self.speed += self.acceleration
 
         self.speed = max(-self.max_speed / 2, min(self.speed, self.max_speed))
-        if not (keys[pygame.K_w] or keys[pygame.K_s]):
+        if not (throttle or brake):
             if self.speed > 0:
                 self.speed = max(0, self.speed - self.friction)
             elif self.speed < 0:
                 self.speed = min(0, self.speed + self.friction)
 
         # Ручной тормоз
-        self.handbrake = keys[pygame.K_SPACE]
+        self.handbrake = handbrake
 
         # Плавный тормоз на S: управление brake_factor
-        if keys[pygame.K_s]:
-            self.brake_factor *= 0.92  # можно настроить: 0.9 = медленнее, 0.8 = быстрее
+        if brake:
+            self.brake_factor *= self.brake_decay
             self.brake_factor = max(0.0, self.brake_factor)
         else:
             self.brake_factor = 1.0
 
         # Поворот (руль)
-        if keys[pygame.K_a]:
-            self.angle -= self.steering * (abs(self.speed) / self.max_speed)
-        if keys[pygame.K_d]:
-            self.angle += self.steering * (abs(self.speed) / self.max_speed)
+        if steer:
+            self.angle += steer * self.steering * (abs(self.speed) / self.max_speed)
 
         rad = math.radians(self.angle)
         dx = self.speed * math.cos(rad)
         dy = self.speed * math.sin(rad)
 
-        surf = track.get_surface_info(self.x + dx, self.y + dy)
-        base_traction = surf['traction']
-
-        traction = base_traction * self.brake_factor
+        traction = track.traction_at(self.x + dx, self.y + dy) * self.brake_factor
 
         if self.handbrake and traction > 0:
-            traction *= 0.05
+            traction *= self.handbrake_traction
 
         self.x += dx * traction
         self.y += dy * traction
@@ -147,8 +408,316 @@ def get_actual_speed(self):
     dx = self.x - self.prev_x
     dy = self.y - self.prev_y
     return math.hypot(dx, dy)
+# === Отрисовка ===
+# Цвет каждого id покрытия (неизвестные id — как поребрик) для отрисовки сетки массивом
+TILE_PALETTE = np.zeros((256, 3), dtype=np.uint8)
+TILE_PALETTE[:] = SURFACE_TYPES[2]['color']
+for _tile_id, _surf in SURFACE_TYPES.items():
+    TILE_PALETTE[_tile_id] = _surf['color']
+
+
+class TrackRenderer:
+    # Трасса рисуется кусками по chunk_tiles x chunk_tiles тайлов: кусок (тайлы и попадающие на него кольца
+    # чекпоинтов) строится при первом появлении на экране и хранится в LRU-кэше, ограниченном max_bytes.
+    # Каждый кадр копируются только видимые куски — стоимость кадра не зависит от размера трассы,
+    # а с трассы .trk читаются (memmap) только тайлы у камеры.
+    # Кэш сбрасывается при изменении трассы (track.revision); разные масштабы хранятся рядом.
+    def __init__(self, track, chunk_tiles=CHUNK_TILES, max_bytes=64 * 1024 * 1024):
+        self.track = track
+        self.chunk_tiles = chunk_tiles
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.bytes_used = 0
+        self.revision = None
+        self.chunk_checkpoints = {}
+        self.chunk_bounds = (0, 0, 0, 0)
+
+    def index_checkpoints(self):
+        # Какие кольца задевают какой кусок; куски за краем трассы нужны, только если туда выходит кольцо
+        track, ct = self.track, self.chunk_tiles
+        reach = CHECKPOINT_RING_TILES
+        self.chunk_checkpoints = {}
+        min_cx, min_cy = 0, 0
+        max_cx, max_cy = (track.width - 1) // ct, (track.height - 1) // ct
+        for cp in track.checkpoints:
+            cx0, cx1 = (cp['x'] - reach) // ct, (cp['x'] + reach) // ct
+            cy0, cy1 = (cp['y'] - reach) // ct, (cp['y'] + reach) // ct
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    self.chunk_checkpoints.setdefault((cx, cy), []).append(cp)
+            min_cx, max_cx = min(min_cx, cx0), max(max_cx, cx1)
+            min_cy, max_cy = min(min_cy, cy0), max(max_cy, cy1)
+        self.chunk_bounds = (min_cx, min_cy, max_cx, max_cy)
+        self.chunks.clear()
+        self.bytes_used = 0
+        self.revision = track.revision
+
+    def build_chunk(self, cx, cy, zoom):
+        track, ct = self.track, self.chunk_tiles
+        scaled_tile = track.tile_size * zoom
+        left, top = round(cx * ct * scaled_tile), round(cy * ct * scaled_tile)
+        surface = pygame.Surface((round((cx + 1) * ct * scaled_tile) - left, round((cy + 1) * ct * scaled_tile) - top))
+        surface.fill((0, 0, 0))
+
+        # По пикселю на тайл через палитру, затем масштабирование без сглаживания — ровно тайлы
+        x0, y0 = max(cx * ct, 0), max(cy * ct, 0)
+        x1, y1 = min((cx + 1) * ct, track.width), min((cy + 1) * ct, track.height)
+        if x0 < x1 and y0 < y1:
+            tiles = pygame.surfarray.make_surface(TILE_PALETTE[np.asarray(track.grid[y0:y1, x0:x1]).T])
+            tiles_left, tiles_top = round(x0 * scaled_tile), round(y0 * scaled_tile)
+            tiles = pygame.transform.scale(tiles, (round(x1 * scaled_tile) - tiles_left,
+                                                   round(y1 * scaled_tile) - tiles_top))
+            surface.blit(tiles, (tiles_left - left, tiles_top - top))
+
+        checkpoints = self.chunk_checkpoints.get((cx, cy))
+        if checkpoints:
+            area_size = 2  # Радиус области (для 5x5 это 2)
+            radius = int(scaled_tile * (area_size + 0.5))
+            font = get_font(int(scaled_tile * 0.5))
+            for cp in checkpoints:
+                center_x = (cp['x'] * track.tile_size + track.tile_size // 2) * zoom - left
+                center_y = (cp['y'] * track.tile_size + track.tile_size // 2) * zoom - top
+                pygame.draw.circle(surface, (0, 255, 255), (center_x, center_y), radius, max(1, int(2 * zoom)))
+                text = font.render(str(cp['id']), True, (0, 0, 0))
+                surface.blit(text, text.get_rect(center=(center_x, center_y)))
+
+        return (surface.convert() if pygame.display.get_surface() else surface), left, top
+
+    def get_chunk(self, cx, cy, zoom):
+        key = (zoom, cx, cy)
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            return chunk
+        chunk = self.build_chunk(cx, cy, zoom)
+        self.chunks[key] = chunk
+        surface = chunk[0]
+        self.bytes_used += surface.get_width() * surface.get_height() * surface.get_bytesize()
+        while self.bytes_used > self.max_bytes and len(self.chunks) > 1:
+            _, (old, _, _) = self.chunks.popitem(last=False)
+            self.bytes_used -= old.get_width() * old.get_height() * old.get_bytesize()
+        return chunk
+
+    def draw(self, screen, camera_x, camera_y, zoom):
+        if self.revision != self.track.revision:
+            self.index_checkpoints()
+        origin_x, origin_y = round(-camera_x * zoom), round(-camera_y * zoom)
+        chunk_px = self.track.tile_size * zoom * self.chunk_tiles
+        screen_w, screen_h = screen.get_size()
+        min_cx, min_cy, max_cx, max_cy = self.chunk_bounds
+        cx0, cx1 = max(int((-origin_x) // chunk_px), min_cx), min(int((screen_w - origin_x) // chunk_px), max_cx)
+        cy0, cy1 = max(int((-origin_y) // chunk_px), min_cy), min(int((screen_h - origin_y) // chunk_px), max_cy)
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                surface, left, top = self.get_chunk(cx, cy, zoom)
+                screen.blit(surface, (origin_x + left, origin_y + top))
+
+
+class SpriteCache:
+    # Повёрнутые и отмасштабированные спрайты по ключу (масштаб, угол, квантованный до angle_step градусов).
+    # Вместо transform.scale + transform.rotate на каждую машину каждый кадр — готовая поверхность.
+    # Память ограничена max_bytes: давно не использованные повороты вытесняются (LRU).
+    def __init__(self, image, angle_step=2.0, max_bytes=64 * 1024 * 1024):
+        self.image = image
+        self.angle_step = angle_step
+        self.steps = max(1, round(360 / angle_step))
+        self.max_bytes = max_bytes
+        self.scaled = {}
+        self.sprites = OrderedDict()
+        self.bytes_used = 0
+
+    def get(self, angle, zoom):
+        index = round((angle % 360) / self.angle_step) % self.steps
+        key = (zoom, index)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+
+        scaled = self.scaled.get(zoom)
+        if scaled is None:
+            width, height = self.image.get_size()
+            scaled = pygame.transform.scale(self.image, (int(width * zoom), int(height * zoom)))
+            self.scaled[zoom] = scaled
+        sprite = pygame.transform.rotate(scaled, -index * self.angle_step)
+
+        self.sprites[key] = sprite
+        self.bytes_used += sprite.get_width() * sprite.get_height() * sprite.get_bytesize()
+        while self.bytes_used > self.max_bytes and len(self.sprites) > 1:
+            _, old = self.sprites.popitem(last=False)
+            self.bytes_used -= old.get_width() * old.get_height() * old.get_bytesize()
+        return sprite
+
+    def prebuild(self, zoom):
+        # Все повороты для масштаба заранее (например, перед заездом), чтобы не было рывков при первом повороте
+        for index in range(self.steps):
+            self.get(index * self.angle_step, zoom)
+
+    def draw(self, screen, angle, zoom, center):
+        sprite = self.get(angle, zoom)
+        screen.blit(sprite, sprite.get_rect(center=center))
+
+
+class HudLayer:
+    # Строки HUD по ключу: поверхность текста перерисовывается только когда меняется сам текст
+    # (время круга в отображаемой точности, число кругов, чекпоинты), иначе переиспользуется.
+    def __init__(self, font_size=24):
+        self.font = get_font(font_size)
+        self.lines = {}
+
+    def draw(self, screen, key, text, color, pos):
+        line = self.lines.get(key)
+        if line is None or line[0] != text or line[1] != color:
+            line = (text, color, self.font.render(text, True, color))
+            self.lines[key] = line
+        screen.blit(line[2], pos)
+
+
+# === Игровой цикл ===
+class FixedStepClock:
+    # Аккумулятор реального времени: сколько тиков физики выполнить в этом кадре.
+    # alpha — доля ещё не выполненного тика, по ней отрисовка интерполирует положение.
+    # ticks_per_frame > 0 — перемотка: ровно столько тиков на кадр независимо от времени.
+    def __init__(self, ticks_per_frame=0):
+        self.ticks_per_frame = ticks_per_frame
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.last_time = time.perf_counter()
+
+    def frame_ticks(self):
+        now = time.perf_counter()
+        elapsed = min(now - self.last_time, MAX_FRAME_TIME)
+        self.last_time = now
+        if self.ticks_per_frame:
+            self.accumulator = 0.0
+            self.alpha = 1.0
+            return self.ticks_per_frame
+
+        self.accumulator += elapsed
+        ticks = int(self.accumulator / PHYSICS_DT)
+        self.accumulator -= ticks * PHYSICS_DT
+        self.alpha = self.accumulator / PHYSICS_DT
+        return ticks
+
+
+class LapTimer:
+    # Хронометраж заезда по тикам физики: время круга одинаково в реальном времени, при перемотке и без экрана.
+    # progress (track_progress.py) — поле прогресса трассы: с ним круг засчитывается только после круга вперёд,
+    # линией старта на трассах без тайлов start_finish служит линия поля, и видна езда не в ту сторону
+    def __init__(self, track, progress=None):
+        self.track = track
+        self.progress = progress
+        self.required_checkpoints = len(track.checkpoints)
+        self.ticks = 0
+        self.lap_start_tick = None
+        self.current_lap_time = 0
+        self.last_lap_time = None
+        self.best_lap_time = None
+        self.lap_times = []
+        self.lap_ticks = []  # (тик старта, тик финиша) каждого круга — для вырезки круга из повтора
+        self.checkpoints_passed = set()
+        self.laps_completed = 0
+        self.race_started = False
+        self.crossed_start_finish = False
+        self.start_line_crossed = False
+        self.last_on_line = False
+        self.position = -1.0  # место на трассе: пикселей вдоль трассы от линии старта (-1 — неизвестно)
+        self.distance = 0.0  # пройдено вдоль трассы с начала заезда (назад — в минус)
+        self.lap_start_distance = 0.0
+        self.track_speed = 0.0  # сглаженное продвижение по трассе за тик
+        self.wrong_way = False
+
+    @property
+    def lap_fraction(self):
+        # Доля текущего круга, пройденная вперёд (None — без поля прогресса или трасса не замкнута)
+        if self.progress is None or not self.progress.closed or not self.race_started:
+            return None
+        return min(max((self.distance - self.lap_start_distance) / self.progress.lap_length, 0.0), 1.0)
+
+    def update(self, x, y):
+        # Вызывается раз за тик физики, до перемещения машины
+        if self.race_started:
+            self.current_lap_time = (self.ticks - self.lap_start_tick) * PHYSICS_DT
+
+        progress = self.progress
+        if progress is not None:
+            position = progress.progress_at(x, y)
+            delta = progress.delta_at(self.position, position)
+            if position >= 0:
+                self.position = position
+            self.distance += delta
+            self.track_speed += (delta - self.track_speed) * WRONG_WAY_SMOOTHING
+            self.wrong_way = self.track_speed < -WRONG_WAY_SPEED
+        if progress is not None and progress.closed:
+            on_line = progress.on_line_at(x, y)
+            lap_done = self.distance - self.lap_start_distance >= LAP_MIN_PROGRESS * progress.lap_length
+        else:
+            on_line = self.track.get_tile(x, y) == 3  # start_finish
+            lap_done = True
+
+        if on_line:
+            if not self.start_line_crossed:
+                self.start_line_crossed = True
+                self.race_started = True
+                self.lap_start_tick = self.ticks
+                self.lap_start_distance = self.distance
+                self.checkpoints_passed = set()
+            elif (self.crossed_start_finish and lap_done and
+                  len(self.checkpoints_passed) == self.required_checkpoints):
+                lap_time = self.current_lap_time
+                if self.best_lap_time is None or lap_time < self.best_lap_time:
+                    self.best_lap_time = lap_time
+                self.last_lap_time = lap_time
+                self.lap_times.append(lap_time)
+                self.lap_ticks.append((self.lap_start_tick, self.ticks))
+                self.laps_completed += 1
+                self.lap_start_tick = self.ticks
+                self.lap_start_distance = self.distance
+                self.checkpoints_passed = set()
+
+        checkpoint_id = self.track.is_checkpoint(x, y)
+        if checkpoint_id is not None and checkpoint_id not in self.checkpoints_passed:
+            self.checkpoints_passed.add(checkpoint_id)
+
+        if not self.last_on_line and on_line:
+            self.crossed_start_finish = True
+        elif self.last_on_line and not on_line:
+            self.crossed_start_finish = False
+
+        self.last_on_line = on_line
+        self.ticks += 1
+
+    def draw(self, hud, screen):
+        hud.draw(screen, "lap", f"Время круга: {self.current_lap_time:.2f}s", (255, 255, 255), (10, 10))
+
+        if self.last_lap_time:
+            hud.draw(screen, "last", f"Последний круг: {self.last_lap_time:.2f}s", (200, 200, 255), (10, 40))
+
+        if self.best_lap_time:
+            hud.draw(screen, "best", f"Лучший круг: {self.best_lap_time:.2f}s", (255, 255, 100), (10, 70))
+
+        hud.draw(screen, "laps", f"Круги: {self.laps_completed}", (100, 255, 100), (10, 100))
+
+        progress = f"Чекпоинты: {len(self.checkpoints_passed)}/{self.required_checkpoints}"
+        if self.lap_fraction is not None:
+            progress += f" | Круг: {self.lap_fraction:.0%}"
+        hud.draw(screen, "progress", progress, (200, 255, 200), (10, 130))
+
+        status = "ГОНКА НАЧАТА" if self.race_started else "ПЕРЕСЕКИТЕ СТАРТ"
+        status_color = (0, 255, 0) if self.race_started else (255, 255, 0)
+        hud.draw(screen, "status", status, status_color, (10, 160))
+
+        if self.wrong_way:
+            hud.draw(screen, "wrong_way", "НЕ В ТУ СТОРОНУ", (255, 80, 80), (10, 190))
+
+
+# Участки кадра, которые Game.run отмечает в профайлере (столбцы --profile-csv)
+PROFILE_SECTIONS = ("events", "lap", "physics", "track", "sprite", "hud", "overlay", "flip", "wait")
+
+
 class Game:
-    def __init__(self, track_path, fullscreen, time_trial_mode=False):
+    def __init__(self, track_path, fullscreen, time_trial_mode=False, profiler=None, record=False):
+        pygame.init()
         self.fullscreen = fullscreen
         self.time_trial_mode = time_trial_mode
         self.set_display_mode()
@@ -163,23 +732,25 @@ class Game:
             start['y'] * self.track.tile_size + self.track.tile_size // 2,
             start.get('angle', 0)
         )
+        self.track_renderer = TrackRenderer(self.track)
+        self.car_sprites = SpriteCache(self.car.original_image)
+        self.hud = HudLayer()
 
-        self.lap_start_time = None
-        self.last_lap_time = None
-        self.current_lap_time = 0
-        self.best_lap_time = None
-        self.checkpoints_passed = set()
-        self.laps_completed = 0
-        self.race_started = False
-        self.crossed_start_finish = False
-        self.start_line_crossed = False
-        self.required_checkpoints = len(self.track.checkpoints)
-        self.last_tile = None
+        self.lap = LapTimer(self.track, load_progress(self.track, track_path) if time_trial_mode else None)
+        self.profiler = profiler if profiler is not None else FrameProfiler()
+
+        # Заезд на время пишется в replays/<трасса>_last.rpl; лучший круг — в <трасса>_best.rpl
+        self.track_path = track_path
+        self.recorder = None
+        if record and time_trial_mode:
+            self.recorder = ReplayWriter(session_replay_path(track_path), self.track,
+                                         {"track": track_path, "driver": "игрок", "created": time.time()},
+                                         PHYSICS_HZ)
 
     def set_display_mode(self):
         if self.fullscreen:
             self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-            self.display_width, self.display_height = NATIVE_WIDTH, NATIVE_HEIGHT
+            self.display_width, self.display_height = get_native_size()
         else:
             self.screen = pygame.display.set_mode((800, 600))
             self.display_width, self.display_height = 800, 600
@@ -189,7 +760,16 @@ class Game:
         self.set_display_mode()
 
     def run(self):
+        try:
+            self.loop()
+        finally:
+            self.finish_recording()
+
+    def loop(self):
+        sim = FixedStepClock()
+        prof = self.profiler
         while self.running:
+            prof.begin_frame()
             keys = pygame.key.get_pressed()
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -200,189 +780,293 @@ class Game:
                         self.running = False
                     if event.key == pygame.K_F11:
                         self.toggle_fullscreen()
-
-            if self.time_trial_mode and self.race_started:
-                self.current_lap_time = (pygame.time.get_ticks() - self.lap_start_time) / 1000.0
-
-            if self.time_trial_mode:
-                current_tile = self.track.get_tile(self.car.x, self.car.y)
-
-                if current_tile == 3:  # start_finish
-                    if not self.start_line_crossed:
-                        self.start_line_crossed = True
-                        self.race_started = True
-                        self.lap_start_time = pygame.time.get_ticks()
-                        self.checkpoints_passed = set()
-                    elif self.crossed_start_finish and len(self.checkpoints_passed) == self.required_checkpoints:
-                        lap_time = self.current_lap_time
-                        if self.best_lap_time is None or lap_time < self.best_lap_time:
-                            self.best_lap_time = lap_time
-                        self.last_lap_time = lap_time
-                        self.laps_completed += 1
-                        self.lap_start_time = pygame.time.get_ticks()
-                        self.checkpoints_passed = set()
-
-                checkpoint_id = self.track.is_checkpoint(self.car.x, self.car.y)
-                if checkpoint_id is not None and checkpoint_id not in self.checkpoints_passed:
-                    self.checkpoints_passed.add(checkpoint_id)
-
-                if self.last_tile != 3 and current_tile == 3:
-                    self.crossed_start_finish = True
-                elif self.last_tile == 3 and current_tile != 3:
-                    self.crossed_start_finish = False
-
-                self.last_tile = current_tile
-
-            self.car.update(keys, self.track)
-            self.render()
+                    if event.key == pygame.K_F3:
+                        prof.toggle_overlay()
+            prof.mark("events")
+
+            controls = controls_from_keys(keys)
+            for _ in range(sim.frame_ticks()):
+                if self.time_trial_mode:
+                    self.lap.update(self.car.x, self.car.y)
+                    prof.mark("lap")
+                if self.recorder is not None:
+                    self.recorder.record(controls, self.car)
+                self.car.control(*controls, self.track)
+                prof.mark("physics")
+            self.render(sim.alpha)
             self.clock.tick(FPS)
-
-    def render(self):
-        camera_x = self.car.x - self.display_width // (2 * self.zoom)
-        camera_y = self.car.y - self.display_height // (2 * self.zoom)
-
+            prof.mark("wait")
+            prof.end_frame()
+
+    def finish_recording(self):
+        if self.recorder is None:
+            return
+        recorder, self.recorder = self.recorder, None
+        recorder.close({"lap_times": self.lap.lap_times, "lap_ticks": self.lap.lap_ticks,
+                        "best_lap_time": self.lap.best_lap_time})
+        if self.lap.lap_times:
+            saved = save_best_lap(recorder.path, best_replay_path(self.track_path), self.track, Car(0, 0))
+            if saved:
+                print(f"✅ Новый лучший круг: {self.lap.best_lap_time:.2f}s → {saved}")
+
+    def render(self, alpha=1.0):
+        car_x, car_y, car_angle = self.car.interpolated(alpha)
+        camera_x = car_x - self.display_width // (2 * self.zoom)
+        camera_y = car_y - self.display_height // (2 * self.zoom)
+
+        prof = self.profiler
         self.screen.fill((0, 0, 0))
+        self.track_renderer.draw(self.screen, camera_x, camera_y, self.zoom)
+        prof.mark("track")
 
-        for y in range(self.track.height):
-            for x in range(self.track.width):
-                tile_id = self.track.grid[y][x]
-                color = SURFACE_TYPES[tile_id]['color']
-                world_x = x * self.track.tile_size
-                world_y = y * self.track.tile_size
-
-                screen_x = (world_x - camera_x) * self.zoom
-                screen_y = (world_y - camera_y) * self.zoom
-                scaled_tile_size = self.track.tile_size * self.zoom
-
-                rect = pygame.Rect(screen_x, screen_y, scaled_tile_size, scaled_tile_size)
-                if -scaled_tile_size < screen_x < self.display_width and -scaled_tile_size < screen_y < self.display_height:
-                    pygame.draw.rect(self.screen, color, rect)
-
-        area_size = 2  # Радиус области (для 5x5 это 2)
-        for cp in self.track.checkpoints:
-            center_x = (cp['x'] * self.track.tile_size + self.track.tile_size // 2 - camera_x) * self.zoom
-            center_y = (cp['y'] * self.track.tile_size + self.track.tile_size // 2 - camera_y) * self.zoom
-            radius = int(self.track.tile_size * self.zoom * (area_size + 0.5))
-
-            if (center_x - radius < self.display_width and center_x + radius > 0 and
-                    center_y - radius < self.display_height and center_y + radius > 0):
-                pygame.draw.circle(self.screen, (0, 255, 255), (center_x, center_y), radius, max(1, int(2 * self.zoom)))
-                font = pygame.font.SysFont(None, int(self.track.tile_size * self.zoom * 0.5))
-                text = font.render(str(cp['id']), True, (0, 0, 0))
-                text_rect = text.get_rect(center=(center_x, center_y))
-                self.screen.blit(text, text_rect)
-
-        car_screen_x = (self.car.x - camera_x) * self.zoom
-        car_screen_y = (self.car.y - camera_y) * self.zoom
+        car_screen_x = (car_x - camera_x) * self.zoom
+        car_screen_y = (car_y - camera_y) * self.zoom
 
-        scaled_car = pygame.transform.scale(
-            self.car.original_image,
-            (int(100 * self.zoom), int(50 * self.zoom))
-        )
-        rotated_image = pygame.transform.rotate(scaled_car, -self.car.angle)
-        car_rect = rotated_image.get_rect(center=(car_screen_x, car_screen_y))
-        self.screen.blit(rotated_image, car_rect.topleft)
+        self.car_sprites.draw(self.screen, car_angle, self.zoom, (car_screen_x, car_screen_y))
+        prof.mark("sprite")
 
         if self.time_trial_mode:
-            font = pygame.font.SysFont(None, 24)
-
-            lap_text = font.render(f"Время круга: {self.current_lap_time:.2f}s", True, (255, 255, 255))
-            self.screen.blit(lap_text, (10, 10))
+            self.lap.draw(self.hud, self.screen)
+            prof.mark("hud")
 
-            if self.last_lap_time:
-                last_lap_text = font.render(f"Последний круг: {self.last_lap_time:.2f}s", True, (200, 200, 255))
-                self.screen.blit(last_lap_text, (10, 40))
+        prof.draw(self.screen, self.hud)
+        prof.mark("overlay")
+        pygame.display.flip()
+        prof.mark("flip")
 
-            if self.best_lap_time:
-                best_lap_text = font.render(f"Лучший круг: {self.best_lap_time:.2f}s", True, (255, 255, 100))
-                self.screen.blit(best_lap_text, (10, 70))
 
-            laps_text = font.render(f"Круги: {self.laps_completed}", True, (100, 255, 100))
-            self.screen.blit(laps_text, (10, 100))
+# === РЕДАКТОР ТРЕСС ===
+class EditorView:
+    # Холст редактора: постоянная поверхность «пиксель на тайл», в которой перекрашиваются только тайлы,
+    # задетые кистью. Кадр — масштабирование видимой части холста в окно, поэтому цена кадра зависит
+    # от размера окна, а не трассы. Вид прокручивается (стрелки, средняя кнопка) и масштабируется (колесо).
+    MIN_PIXEL_SIZE = 1
+    MAX_PIXEL_SIZE = 32
+
+    def __init__(self, track, view_w, view_h, pixel_size):
+        self.track = track
+        self.view_w = view_w
+        self.view_h = view_h
+        self.pixel_size = pixel_size
+        self.cam_x = 0.0  # левый верхний угол вида, в тайлах
+        self.cam_y = 0.0
+        self.canvas = pygame.surfarray.make_surface(TILE_PALETTE[np.asarray(track.grid).T])
+        self.labels = {}
+
+    def repaint(self, x0, y0, x1, y1):
+        # Перекрасить прямоугольник тайлов [x0, x1) x [y0, y1) из сетки
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(self.track.width, x1), min(self.track.height, y1)
+        if x0 < x1 and y0 < y1:
+            region = self.canvas.subsurface((x0, y0, x1 - x0, y1 - y0))
+            pygame.surfarray.blit_array(region, TILE_PALETTE[self.track.grid[y0:y1, x0:x1].T])
+
+    def screen_to_tile(self, mouse_x, mouse_y):
+        return (int(mouse_x / self.pixel_size + self.cam_x),
+                int(mouse_y / self.pixel_size + self.cam_y))
+
+    def tile_to_screen(self, tile_x, tile_y):
+        return ((tile_x - self.cam_x) * self.pixel_size + self.pixel_size // 2,
+                (tile_y - self.cam_y) * self.pixel_size + self.pixel_size // 2)
+
+    def pan(self, dx, dy):
+        max_x = max(0.0, self.track.width - self.view_w / self.pixel_size)
+        max_y = max(0.0, self.track.height - self.view_h / self.pixel_size)
+        self.cam_x = min(max(0.0, self.cam_x + dx), max_x)
+        self.cam_y = min(max(0.0, self.cam_y + dy), max_y)
+
+    def zoom(self, factor, anchor):
+        # Масштаб вокруг точки экрана anchor: тайл под курсором остаётся на месте
+        anchor_x, anchor_y = anchor
+        old = self.pixel_size
+        self.pixel_size = min(self.MAX_PIXEL_SIZE, max(self.MIN_PIXEL_SIZE, round(old * factor) or 1))
+        if self.pixel_size == old:
+            self.pixel_size = min(self.MAX_PIXEL_SIZE, max(self.MIN_PIXEL_SIZE, old + (1 if factor > 1 else -1)))
+        self.pan(anchor_x / old - anchor_x / self.pixel_size, anchor_y / old - anchor_y / self.pixel_size)
+
+    def draw(self, screen, font):
+        ps = self.pixel_size
+        tile_x0, tile_y0 = int(self.cam_x), int(self.cam_y)
+        tile_x1 = min(self.track.width, int(self.cam_x + self.view_w / ps) + 1)
+        tile_y1 = min(self.track.height, int(self.cam_y + self.view_h / ps) + 1)
+        offset_x = round((tile_x0 - self.cam_x) * ps)
+        offset_y = round((tile_y0 - self.cam_y) * ps)
+        view = screen.subsurface((0, 0, self.view_w, self.view_h))
+
+        visible = self.canvas.subsurface((tile_x0, tile_y0, tile_x1 - tile_x0, tile_y1 - tile_y0))
+        scaled = pygame.transform.scale(visible, ((tile_x1 - tile_x0) * ps, (tile_y1 - tile_y0) * ps))
+        view.blit(scaled, (offset_x, offset_y))
+
+        # Сетка — линиями по видимым границам тайлов (на мелком масштабе не рисуется)
+        if ps >= 4:
+            bottom = offset_y + (tile_y1 - tile_y0) * ps
+            right = offset_x + (tile_x1 - tile_x0) * ps
+            for i in range(tile_x1 - tile_x0):
+                x = offset_x + i * ps
+                pygame.draw.line(view, (50, 50, 50), (x, offset_y), (x, bottom - 1))
+                pygame.draw.line(view, (50, 50, 50), (x + ps - 1, offset_y), (x + ps - 1, bottom - 1))
+            for i in range(tile_y1 - tile_y0):
+                y = offset_y + i * ps
+                pygame.draw.line(view, (50, 50, 50), (offset_x, y), (right - 1, y))
+                pygame.draw.line(view, (50, 50, 50), (offset_x, y + ps - 1), (right - 1, y + ps - 1))
+
+        # Только видимые чекпоинты, подписи рендерятся один раз
+        radius = int(ps * 1.5)
+        for cp in self.track.checkpoints:
+            center_x, center_y = self.tile_to_screen(cp['x'], cp['y'])
+            if -radius <= center_x < self.view_w + radius and -radius <= center_y < self.view_h + radius:
+                pygame.draw.circle(view, (0, 255, 255), (center_x, center_y), radius, 2)
+                label = self.labels.get(cp['id'])
+                if label is None:
+                    label = font.render(str(cp['id']), True, (0, 0, 0))
+                    self.labels[cp['id']] = label
+                view.blit(label, label.get_rect(center=(center_x, center_y)))
 
-            progress_text = font.render(f"Чекпоинты: {len(self.checkpoints_passed)}/{self.required_checkpoints}", True,
-                                        (200, 255, 200))
-            self.screen.blit(progress_text, (10, 130))
+        start = self.track.start_pos
+        sx, sy = self.tile_to_screen(start["x"], start["y"])
+        if 0 <= sx < self.view_w and 0 <= sy < self.view_h:
+            pygame.draw.line(view, (255, 0, 0), (sx - 3, sy), (sx + 3, sy), 2)
+            pygame.draw.line(view, (255, 0, 0), (sx, sy - 3), (sx, sy + 3), 2)
 
-            status = "ГОНКА НАЧАТА" if self.race_started else "ПЕРЕСЕКИТЕ СТАРТ"
-            status_color = (0, 255, 0) if self.race_started else (255, 255, 0)
-            status_text = font.render(status, True, status_color)
-            self.screen.blit(status_text, (10, 160))
 
-        pygame.display.flip()
+def parse_grid_size(text):
+    # "400x300" -> (400, 300); для --new-track-size
+    width, height = (int(part) for part in text.lower().split("x"))
+    if width < 1 or height < 1:
+        raise ValueError(text)
+    return width, height
 
 
-# === РЕДАКТОР ТРЕСС ===
-def run_track_editor(slot_name="track_01.json"):
-    MAX_GRID_WIDTH = 100
-    MAX_GRID_HEIGHT = 100
+def run_track_editor(slot_name="track_01.json", new_size=(100, 80)):
+    # new_size — (ширина, высота) в тайлах для нового слота (python main.py --new-track-size 400x300)
+    MAX_GRID_WIDTH = 1000
+    MAX_GRID_HEIGHT = 1000
 
-    # 🔹 ВИЗУАЛЬНЫЙ размер тайла в редакторе (только для отрисовки и ввода!)
+    # 🔹 ВИЗУАЛЬНЫЙ размер тайла в редакторе (только для отрисовки и ввода!), меняется колесом мыши
     EDITOR_PIXEL_SIZE = 8
 
     # 🔹 ЛОГИЧЕСКИЙ размер тайла (будет сохранён в файл и использован в игре)
     LOGICAL_TILE_SIZE = 24
 
-    track_path = os.path.join("tracks", slot_name)
+    # Сохранение (S) и автосохранение раз в AUTOSAVE_INTERVAL секунд идут в фоновом потоке и не тормозят ввод.
+    # Автосохранение пишется в tracks/.autosave/<слот>; при выходе удаляется, только если всё сохранено (S),
+    # а после падения или выхода без S редактор при следующем открытии слота продолжит с него, если оно новее
+    # сохранённой трассы.
+    AUTOSAVE_INTERVAL = 60
 
-    if os.path.exists(track_path):
-        with open(track_path, 'r') as f:
-            data = json.load(f)
+    track_path = os.path.join("tracks", slot_name)
+    autosave_path = os.path.join("tracks", ".autosave", slot_name)
+    load_path = track_path
+    if os.path.exists(autosave_path) and (not os.path.exists(track_path) or
+                                          os.path.getmtime(autosave_path) > os.path.getmtime(track_path)):
+        load_path = autosave_path
+        print(f"↩️ Восстановлено автосохранение: {autosave_path} (S — сохранить в {track_path})")
+
+    if os.path.exists(load_path):
+        data = load_track_data(load_path)
         width = min(data['width'], MAX_GRID_WIDTH)
         height = min(data['height'], MAX_GRID_HEIGHT)
-        grid = data['grid']
-        if len(grid) != height or len(grid[0]) != width:
-            new_grid = [[0 for _ in range(width)] for _ in range(height)]
-            for y in range(min(len(grid), height)):
-                for x in range(min(len(grid[0]), width)):
-                    new_grid[y][x] = grid[y][x]
-            grid = new_grid
+        grid = np.zeros((height, width), dtype=np.uint8)
+        loaded = data['grid'][:height, :width]
+        grid[:loaded.shape[0], :loaded.shape[1]] = loaded
         start_pos = data.get('start_position', {"x": width // 2, "y": height // 2, "angle": 0})
         checkpoints = data.get('checkpoints', [])
     else:
         # Новая трасса
-        width = 100
-        height = 80
-        grid = [[0 for _ in range(width)] for _ in range(height)]
+        width = min(max(int(new_size[0]), 1), MAX_GRID_WIDTH)
+        height = min(max(int(new_size[1]), 1), MAX_GRID_HEIGHT)
+        grid = np.zeros((height, width), dtype=np.uint8)
         start_pos = {"x": width // 2, "y": height // 2, "angle": 0}
         checkpoints = []
 
-    # Настройка окна редактора (ограничено, но масштабируемо)
-    MAX_WIN_W = min(1200, NATIVE_WIDTH)
-    MAX_WIN_H = min(800, NATIVE_HEIGHT - 100)
+    # Редактор работает с той же Track, что и игра: присвоение track.checkpoints перестраивает слой чекпоинтов
+    track = Track.from_data({
+        "name": f"Custom Track - {slot_name}",
+        "width": width,
+        "height": height,
+        "tile_size": LOGICAL_TILE_SIZE,
+        "grid": grid,
+        "start_position": start_pos,
+        "checkpoints": checkpoints,
+    })
+
+    # Настройка окна редактора (ограничено; большие трассы прокручиваются)
+    native_w, native_h = get_native_size()
+    MAX_WIN_W = min(1200, native_w)
+    MAX_WIN_H = min(800, native_h - 100)
     win_w = min(width * EDITOR_PIXEL_SIZE, MAX_WIN_W)
     win_h = min(height * EDITOR_PIXEL_SIZE, MAX_WIN_H) + 60
 
     screen = pygame.display.set_mode((win_w, win_h))
     pygame.display.set_caption(f"Редактор — {slot_name} ({width}x{height})")
-    font = pygame.font.SysFont(None, 24)
+    font = get_font(24)
+    hud = HudLayer()
     clock = pygame.time.Clock()
+    view = EditorView(track, win_w, win_h - 60, EDITOR_PIXEL_SIZE)  # учитываем панель статуса
 
+    # Инструменты: B — кисть (мазок протягивается между событиями мыши), R — прямоугольник (тянуть мышью),
+    # F — заливка области. Ctrl+Z / Ctrl+Y — отмена и повтор правок сетки (чекпоинты и старт не отменяются)
+    TOOL_NAMES = {"brush": "Кисть", "rect": "Прямоугольник", "fill": "Заливка"}
     current_type = 1
+    tool = "brush"
     brush_size = 1
+    brush_shape = BRUSH_SHAPES[0]
     drawing = False
-    placing_checkpoint = False
-    checkpoint_counter = len(checkpoints) + 1
+    last_tile = None
+    rect_start = None
+    panning = False
+    checkpoint_counter = len(track.checkpoints) + 1
+    history = EditHistory(grid)
+
+    saver = BackgroundSaver()
+    saved_revision = track.revision if load_path == track_path else None
+    autosaved_revision = track.revision
+    last_autosave = time.perf_counter()
+    notice, notice_until = "", 0.0
+
+    def track_data():
+        return {
+            "name": f"Custom Track - {slot_name}",
+            "tile_size": LOGICAL_TILE_SIZE,
+            "grid": grid,
+            "start_position": start_pos,
+            "checkpoints": track.checkpoints,
+        }
 
-    def apply_brush(cx, cy, size, value):
-        radius = size // 2
-        for dy in range(-radius, radius + 1):
-            for dx in range(-radius, radius + 1):
-                nx, ny = cx + dx, cy + dy
-                if 0 <= ny < height and 0 <= nx < width:
-                    grid[ny][nx] = value
+    def close_editor():
+        # Автосохранение удаляется, только если всё сохранено в слот; иначе (в том числе после восстановления
+        # без S) туда дописывается текущее состояние — это может быть единственная копия правок
+        saver.wait()
+        saved = track.revision == saved_revision and not any(
+            error is not None and path == track_path for path, error in saver.poll())
+        if saved:
+            if os.path.exists(autosave_path):
+                os.remove(autosave_path)
+            return
+        if track.revision != autosaved_revision or not os.path.exists(autosave_path):
+            saver.save(track_data(), autosave_path)
+            saver.wait()
+        print(f"💾 Несохранённые правки остались в {autosave_path}")
+
+    def apply_edit(bounds):
+        # bounds — изменённая рамка тайлов (x0, y0, x1, y1) или None, если ничего не поменялось
+        if bounds is not None:
+            view.repaint(*bounds)
+            track.mark_changed()
 
     running = True
     while running:
         mouse_x, mouse_y = pygame.mouse.get_pos()
-        tile_x = mouse_x // EDITOR_PIXEL_SIZE
-        tile_y = mouse_y // EDITOR_PIXEL_SIZE
+        tile_x, tile_y = view.screen_to_tile(mouse_x, mouse_y)
+        in_view = mouse_y < view.view_h and 0 <= tile_x < width and 0 <= tile_y < height
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                close_editor()
                 return
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
+                    close_editor()
                     return
                 if event.key == pygame.K_1: current_type = 0  # offroad
                 if event.key == pygame.K_2: current_type = 1  # asphalt
@@ -391,87 +1075,130 @@ def run_track_editor(slot_name="track_01.json"):
                 if event.key == pygame.K_q: brush_size = 1
                 if event.key == pygame.K_w: brush_size = 3
                 if event.key == pygame.K_e: brush_size = 5
+                if event.key == pygame.K_LEFTBRACKET: brush_size = max(1, brush_size - 2)
+                if event.key == pygame.K_RIGHTBRACKET: brush_size = min(101, brush_size + 2)
+                if event.key == pygame.K_o:
+                    brush_shape = BRUSH_SHAPES[(BRUSH_SHAPES.index(brush_shape) + 1) % len(BRUSH_SHAPES)]
+                if event.key == pygame.K_b: tool = "brush"
+                if event.key == pygame.K_r: tool = "rect"
+                if event.key == pygame.K_f: tool = "fill"
+                if event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL:
+                    apply_edit(history.redo() if event.mod & pygame.KMOD_SHIFT else history.undo())
+                if event.key == pygame.K_y and event.mod & pygame.KMOD_CTRL:
+                    apply_edit(history.redo())
                 if event.key == pygame.K_s:
-                    track_data = {
-                        "name": f"Custom Track - {slot_name}",
-                        "width": width,
-                        "height": height,
-                        "tile_size": LOGICAL_TILE_SIZE,
-                        "grid": grid,
-                        "start_position": start_pos,
-                        "checkpoints": checkpoints
-                    }
-                    with open(track_path, "w") as f:
-                        json.dump(track_data, f, indent=2)
-                    print(f"✅ Сохранено: {track_path} (tile_size={LOGICAL_TILE_SIZE})")
+                    saver.save(track_data(), track_path)
+                    saved_revision = autosaved_revision = track.revision
                 if event.key == pygame.K_c:
-                    if 0 <= tile_x < width and 0 <= tile_y < height:
+                    if in_view:
                         exists = False
-                        for cp in checkpoints:
+                        for cp in track.checkpoints:
                             if cp['x'] == tile_x and cp['y'] == tile_y:
                                 exists = True
                                 break
 
                         if not exists:
-                            checkpoints.append({
+                            track.checkpoints = track.checkpoints + [{
                                 'id': checkpoint_counter,
                                 'x': tile_x,
                                 'y': tile_y
-                            })
+                            }]
                             checkpoint_counter += 1
                         else:
-                            checkpoints = [cp for cp in checkpoints if not (cp['x'] == tile_x and cp['y'] == tile_y)]
+                            track.checkpoints = [cp for cp in track.checkpoints
+                                                 if not (cp['x'] == tile_x and cp['y'] == tile_y)]
 
             if event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1 and 0 <= tile_x < width and 0 <= tile_y < height:
-                    apply_brush(tile_x, tile_y, brush_size, current_type)
-                    drawing = True
-                if event.button == 3 and 0 <= tile_x < width and 0 <= tile_y < height:
+                if event.button == 1 and in_view:
+                    if tool == "brush":
+                        history.begin()
+                        apply_edit(history.stroke(tile_x, tile_y, tile_x, tile_y, brush_size // 2, current_type,
+                                                  brush_shape))
+                        drawing = True
+                        last_tile = (tile_x, tile_y)
+                    elif tool == "rect":
+                        rect_start = (tile_x, tile_y)
+                    elif tool == "fill":
+                        apply_edit(history.flood_fill(tile_x, tile_y, current_type))
+                if event.button == 3 and in_view:
                     start_pos["x"] = tile_x
                     start_pos["y"] = tile_y
+                    track.mark_changed()
+                if event.button == 2:
+                    panning = True
+            if event.type == pygame.MOUSEWHEEL:
+                view.zoom(2 ** (0.25 * event.y), (mouse_x, min(mouse_y, view.view_h)))
 
             if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-                drawing = False
+                if drawing:
+                    history.commit()
+                    drawing = False
+                if rect_start is not None:
+                    end_x, end_y = view.screen_to_tile(*event.pos)
+                    end_x, end_y = min(max(end_x, 0), width - 1), min(max(end_y, 0), height - 1)
+                    apply_edit(history.fill_rect(rect_start[0], rect_start[1], end_x, end_y, current_type))
+                    rect_start = None
+            if event.type == pygame.MOUSEBUTTONUP and event.button == 2:
+                panning = False
+            if event.type == pygame.MOUSEMOTION and panning:
+                view.pan(-event.rel[0] / view.pixel_size, -event.rel[1] / view.pixel_size)
             if event.type == pygame.MOUSEMOTION and drawing:
-                if 0 <= tile_x < width and 0 <= tile_y < height:
-                    apply_brush(tile_x, tile_y, brush_size, current_type)
+                # Отрезок от прошлого события: быстрый мазок без разрывов
+                motion_x, motion_y = view.screen_to_tile(*event.pos)
+                apply_edit(history.stroke(last_tile[0], last_tile[1], motion_x, motion_y, brush_size // 2,
+                                          current_type, brush_shape))
+                last_tile = (motion_x, motion_y)
+
+        now = time.perf_counter()
+        if now - last_autosave >= AUTOSAVE_INTERVAL:
+            last_autosave = now
+            if track.revision not in (saved_revision, autosaved_revision):
+                saver.save(track_data(), autosave_path)
+                autosaved_revision = track.revision
+        for path, error in saver.poll():
+            if error is not None:
+                notice = f"Ошибка сохранения {path}: {error}"
+                if path == track_path:
+                    saved_revision = None  # слот не записан — автосохранение не удалять
+            elif path == track_path:
+                notice = f"Сохранено: {track_path} (tile_size={LOGICAL_TILE_SIZE})"
+                if track.revision == saved_revision and os.path.exists(autosave_path):
+                    os.remove(autosave_path)
+            else:
+                notice = "Автосохранение"
+            print(notice)
+            notice_until = now + 3.0
+
+        # Прокрутка стрелками: ~полэкрана в секунду
+        keys = pygame.key.get_pressed()
+        scroll = max(1.0, view.view_w / view.pixel_size / 60)
+        view.pan(scroll * (keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]),
+                 scroll * (keys[pygame.K_DOWN] - keys[pygame.K_UP]))
 
         screen.fill((0, 0, 0))
-        for y in range(height):
-            for x in range(width):
-                screen_x = x * EDITOR_PIXEL_SIZE
-                screen_y = y * EDITOR_PIXEL_SIZE
-                if 0 <= screen_x < win_w and 0 <= screen_y < win_h - 60:  # учитываем панель статуса
-                    tile_id = grid[y][x]
-                    color = SURFACE_TYPES[tile_id]["color"]
-                    rect = pygame.Rect(screen_x, screen_y, EDITOR_PIXEL_SIZE, EDITOR_PIXEL_SIZE)
-                    pygame.draw.rect(screen, color, rect)
-                    pygame.draw.rect(screen, (50, 50, 50), rect, 1)
-
-                    for cp in checkpoints:
-                        if cp['x'] - 1 <= x <= cp['x'] + 1 and cp['y'] - 1 <= y <= cp['y'] + 1:
-                            center_x = cp['x'] * EDITOR_PIXEL_SIZE + EDITOR_PIXEL_SIZE // 2
-                            center_y = cp['y'] * EDITOR_PIXEL_SIZE + EDITOR_PIXEL_SIZE // 2
-                            radius = int(EDITOR_PIXEL_SIZE * 1.5)
-                            pygame.draw.circle(screen, (0, 255, 255), (center_x, center_y), radius, 2)
-                            text = font.render(str(cp['id']), True, (0, 0, 0))
-                            text_rect = text.get_rect(center=(center_x, center_y))
-                            screen.blit(text, text_rect)
-
-        sx = start_pos["x"] * EDITOR_PIXEL_SIZE + EDITOR_PIXEL_SIZE // 2
-        sy = start_pos["y"] * EDITOR_PIXEL_SIZE + EDITOR_PIXEL_SIZE // 2
-        if 0 <= sx < win_w and 0 <= sy < win_h - 60:
-            pygame.draw.line(screen, (255, 0, 0), (sx - 3, sy), (sx + 3, sy), 2)
-            pygame.draw.line(screen, (255, 0, 0), (sx, sy - 3), (sx, sy + 3), 2)
-
+        view.draw(screen, font)
+        if rect_start is not None:
+            end_x, end_y = min(max(tile_x, 0), width - 1), min(max(tile_y, 0), height - 1)
+            x0, y0 = view.tile_to_screen(min(rect_start[0], end_x), min(rect_start[1], end_y))
+            x1, y1 = view.tile_to_screen(max(rect_start[0], end_x) + 1, max(rect_start[1], end_y) + 1)
+            half = view.pixel_size // 2  # tile_to_screen даёт центр тайла
+            pygame.draw.rect(screen, SURFACE_TYPES[current_type]['color'],
+                             (x0 - half, y0 - half, x1 - x0, y1 - y0), 2)
+
+        tools = (
+            f"{TOOL_NAMES[tool]} (B/R/F) | Тип: {SURFACE_TYPES[current_type]['name']} (1/2/3/4) | "
+            f"Кисть: {brush_size}x{brush_size} {brush_shape} (Q/W/E, [ ], O) | "
+            f"Отмена: {len(history.undo_stack)} (Ctrl+Z/Y)"
+        )
         status = (
-            f"Слот: {slot_name} | {width}x{height} | "
-            f"Тип: {SURFACE_TYPES[current_type]['name']} (1/2/3/4) | "
-            f"Кисть: {brush_size}x{brush_size} (Q/W/E) | S=сохранить | "
+            f"Слот: {slot_name} | {width}x{height} | S=сохранить | "
             f"C=чекпоинт | "
-            f"Экран: {EDITOR_PIXEL_SIZE}px/тайл → Файл: {LOGICAL_TILE_SIZE}"
+            f"Экран: {view.pixel_size}px/тайл (колесо, стрелки) → Файл: {LOGICAL_TILE_SIZE}"
         )
-        screen.blit(font.render(status, True, (255, 255, 255)), (10, win_h - 30))
+        hud.draw(screen, "tools", tools, (200, 200, 255), (10, win_h - 56))
+        hud.draw(screen, "status", status, (255, 255, 255), (10, win_h - 30))
+        if now < notice_until:
+            hud.draw(screen, "notice", notice, (255, 255, 100), (10, 10))
 
         pygame.display.flip()
         clock.tick(60)
@@ -484,7 +1211,7 @@ class Button:
         self.text = text
         self.color = color
         self.hover_color = hover_color
-        self.font = pygame.font.SysFont(None, 36)
+        self.font = get_font(36)
 
     def draw(self, screen):
         mouse_pos = pygame.mouse.get_pos()
@@ -502,12 +1229,12 @@ class Button:
 def track_selection_menu(fullscreen):
     if fullscreen:
         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+        w, h = get_native_size()
     else:
         screen = pygame.display.set_mode((800, 600))
         w, h = 800, 600
 
-    font = pygame.font.SysFont(None, 36)
+    font = get_font(36)
     clock = pygame.time.Clock()
 
     track_files = sorted([f for f in os.listdir("tracks") if f.endswith(".json")])
@@ -528,7 +1255,7 @@ def track_selection_menu(fullscreen):
                     fullscreen = not fullscreen
                     if fullscreen:
                         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-                        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+                        w, h = get_native_size()
                     else:
                         screen = pygame.display.set_mode((800, 600))
                         w, h = 800, 600
@@ -601,12 +1328,12 @@ def game_mode_selection(screen, w, h, font):
 def slot_selection_menu(fullscreen):
     if fullscreen:
         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+        w, h = get_native_size()
     else:
         screen = pygame.display.set_mode((800, 600))
         w, h = 800, 600
 
-    font = pygame.font.SysFont(None, 36)
+    font = get_font(36)
     clock = pygame.time.Clock()
 
     slots = [f"track_{i:02d}.json" for i in range(1, 6)]
@@ -624,7 +1351,7 @@ def slot_selection_menu(fullscreen):
                     fullscreen = not fullscreen
                     if fullscreen:
                         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-                        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+                        w, h = get_native_size()
                     else:
                         screen = pygame.display.set_mode((800, 600))
                         w, h = 800, 600
@@ -653,11 +1380,16 @@ def slot_selection_menu(fullscreen):
         clock.tick(FPS)
 
 
-def main_menu():
+def main_menu(profiler=None, new_track_size=(100, 80)):
+    pygame.init()
+    get_native_size()  # до первого set_mode, пока Info() возвращает разрешение экрана
+    os.makedirs("tracks", exist_ok=True)
+    os.makedirs("assets", exist_ok=True)
+
     fullscreen = FULLSCREEN_DEFAULT
     if fullscreen:
         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+        w, h = get_native_size()
     else:
         screen = pygame.display.set_mode((800, 600))
         w, h = 800, 600
@@ -684,7 +1416,7 @@ def main_menu():
                     fullscreen = not fullscreen
                     if fullscreen:
                         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-                        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+                        w, h = get_native_size()
                     else:
                         screen = pygame.display.set_mode((800, 600))
                         w, h = 800, 600
@@ -695,11 +1427,11 @@ def main_menu():
             if buttons[0].is_clicked(event):
                 track_path, fullscreen, time_trial_mode = track_selection_menu(fullscreen)
                 if track_path:
-                    game = Game(track_path, fullscreen, time_trial_mode)
+                    game = Game(track_path, fullscreen, time_trial_mode, profiler, record=True)
                     game.run()
                     if fullscreen:
                         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-                        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+                        w, h = get_native_size()
                     else:
                         screen = pygame.display.set_mode((800, 600))
                         w, h = 800, 600
@@ -710,10 +1442,10 @@ def main_menu():
             if buttons[1].is_clicked(event):
                 slot, fullscreen = slot_selection_menu(fullscreen)
                 if slot:
-                    run_track_editor(slot)
+                    run_track_editor(slot, new_track_size)
                     if fullscreen:
                         screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-                        w, h = NATIVE_WIDTH, NATIVE_HEIGHT
+                        w, h = get_native_size()
                     else:
                         screen = pygame.display.set_mode((800, 600))
                         w, h = 800, 600
@@ -726,7 +1458,7 @@ def main_menu():
                 sys.exit()
 
         screen.blit(bg_image, (0, 0))
-        title_font = pygame.font.SysFont(None, 72)
+        title_font = get_font(72)
         title = title_font.render("RACER GAME", True, (255, 255, 255))
         screen.blit(title, (w // 2 - title.get_width() // 2, 100))
         for btn in buttons:
@@ -735,9 +1467,70 @@ def main_menu():
         clock.tick(FPS)
 
 # === RacerEnv (ИИ) ===
+# === Датчики ===
+SENSORS_SUFFIX = ".sensors.json"
+
+
+class SensorConfig:
+    # Из чего состоит наблюдение после скорости и угла: лучи под углами ray_angles (от курса машины) и,
+    # если clearance, расстояние до ближайшей стены. ray_table — лучи из предрасчитанной таблицы
+    # (track_fields, постоянная цена за луч) вместо точного обхода сетки; clearance всегда из полей.
+    def __init__(self, ray_angles=RAY_ANGLES, clearance=False, ray_table=False, max_distance=RAY_MAX_DISTANCE):
+        self.ray_angles = tuple(ray_angles)
+        self.clearance = clearance
+        self.ray_table = ray_table
+        self.max_distance = max_distance
+
+    @classmethod
+    def fan(cls, n_rays, spread=180.0, **kwargs):
+        # n_rays лучей веером от -spread/2 до spread/2 градусов
+        angles = np.linspace(-spread / 2, spread / 2, n_rays).tolist() if n_rays > 1 else [0.0]
+        return cls(angles, **kwargs)
+
+    @property
+    def obs_size(self):
+        return 3 + len(self.ray_angles) + (1 if self.clearance else 0)
+
+    @property
+    def needs_fields(self):
+        return self.ray_table or self.clearance
+
+    def load_fields(self, track, track_path=None):
+        if not self.needs_fields:
+            return None
+        from track_fields import load_fields
+        return load_fields(track, track_path, self.max_distance)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"ray_angles": list(self.ray_angles), "clearance": self.clearance,
+                       "ray_table": self.ray_table, "max_distance": self.max_distance}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    @classmethod
+    def for_model(cls, model_path):
+        # У каждой модели свой <модель>.sensors.json (общий для .zip и .npz); без него — датчики по умолчанию
+        path = sensors_path(model_path)
+        return cls.load(path) if os.path.exists(path) else cls()
+
+
+def sensors_path(model_path):
+    return os.path.splitext(model_path)[0] + SENSORS_SUFFIX
+
+
 class RacerEnv:
-    def __init__(self, track_path):
+    # progress_reward > 0 — добавка к награде за каждый пиксель продвижения вдоль трассы по полю track_progress
+    # (назад — такой же штраф): за скорость по кругу без продвижения она ничего не даёт
+    def __init__(self, track_path, sensors=None, progress_reward=0.0):
         self.track = Track(track_path)
+        self.sensors = sensors if sensors is not None else SensorConfig()
+        self.fields = self.sensors.load_fields(self.track, track_path)
+        self.progress_reward = progress_reward
+        self.progress = load_progress(self.track, track_path) if progress_reward else None
         start = self.track.start_pos
         self.car = Car(
             start['x'] * self.track.tile_size + self.track.tile_size // 2,
@@ -745,16 +1538,17 @@ class RacerEnv:
             start.get('angle', 0)
         )
         self.done = False
+        self.last_checkpoint = None
+        self.last_progress = self.progress.progress_at(self.car.x, self.car.y) if self.progress is not None else -1.0
+        # Буфер наблюдения: get_state пишет в него на месте и возвращает его же (перезаписывается каждый шаг)
+        self.obs = np.empty(self.sensors.obs_size, dtype=np.float32)
+        self.ray_offsets = np.asarray(self.sensors.ray_angles, dtype=np.float64)
+
+    def cast_ray(self, angle_offset, max_distance=RAY_MAX_DISTANCE):
+        return self.track.cast_ray(self.car.x, self.car.y, self.car.angle + angle_offset, max_distance)
 
-    def cast_ray(self, angle_offset, max_distance=200):
-        rad = math.radians(self.car.angle + angle_offset)
-        for d in range(0, max_distance, 4):
-            check_x = self.car.x + d * math.cos(rad)
-            check_y = self.car.y + d * math.sin(rad)
-            tile = self.track.get_tile(check_x, check_y)
-            if tile == 0 or tile == 2:  # offroad или curb
-                return d / max_distance
-        return 1.0
+    def cast_rays(self, angle_offsets=RAY_ANGLES, max_distance=RAY_MAX_DISTANCE):
+        return self.track.cast_rays(self.car.x, self.car.y, self.car.angle + np.asarray(angle_offsets), max_distance)
 
     def reset(self):
         start = self.track.start_pos
@@ -762,27 +1556,44 @@ class RacerEnv:
         self.car.y = start['y'] * self.track.tile_size + self.track.tile_size // 2
         self.car.angle = start.get('angle', 0)
         self.car.speed = 0
+        self.car.brake_factor = 1.0
         self.done = False
+        self.last_checkpoint = None
+        if self.progress is not None:
+            self.last_progress = self.progress.progress_at(self.car.x, self.car.y)
         return self.get_state()
 
     def get_state(self):
-        min_speed = -self.car.max_speed / 2
-        speed_range = self.car.max_speed - min_speed
-        norm_speed = (self.car.speed - min_speed) / speed_range
-        norm_speed = np.clip(norm_speed, 0.0, 1.0)
-
-        angle_rad = math.radians(self.car.angle)
-        sin_a = (math.sin(angle_rad) + 1.0) / 2.0
-        cos_a = (math.cos(angle_rad) + 1.0) / 2.0
-
-        angles = [-90, -45, 0, 45, 90]
-        rays = [self.cast_ray(a) for a in angles]
-
-        return np.array([norm_speed, sin_a, cos_a] + rays, dtype=np.float32)
+        car = self.car
+        min_speed = -car.max_speed / 2
+        speed_range = car.max_speed - min_speed
+        norm_speed = (car.speed - min_speed) / speed_range
+        norm_speed = min(max(norm_speed, 0.0), 1.0)
+
+        angle_rad = math.radians(car.angle)
+        obs = self.obs
+        obs[0] = norm_speed
+        obs[1] = (math.sin(angle_rad) + 1.0) / 2.0
+        obs[2] = (math.cos(angle_rad) + 1.0) / 2.0
+
+        sensors, fields = self.sensors, self.fields
+        n_rays = len(sensors.ray_angles)
+        if sensors.ray_table and n_rays > 16:
+            obs[3:3 + n_rays] = fields.ray_distances(car.x, car.y, car.angle + self.ray_offsets)
+        elif sensors.ray_table:
+            for i, offset in enumerate(sensors.ray_angles, 3):
+                obs[i] = fields.ray_distance(car.x, car.y, car.angle + offset)
+        else:
+            # Лучи по одному: без временных массивов на каждом шаге
+            cast_ray = self.track.cast_ray
+            for i, offset in enumerate(sensors.ray_angles, 3):
+                obs[i] = cast_ray(car.x, car.y, car.angle + offset, sensors.max_distance)
+        if sensors.clearance:
+            obs[3 + n_rays] = fields.clearance_at(car.x, car.y)
+        return obs
 
     def step(self, action):
-        keys = self.action_to_keys(action)
-        self.car.update(keys, self.track)
+        self.car.apply_action(action, self.track)
 
         tile = self.track.get_tile(self.car.x, self.car.y)
         reward = 0.0
@@ -798,6 +1609,13 @@ class RacerEnv:
             elif tile == 2:  # curb — штраф
                 reward -= 0.5
 
+            if self.progress is not None:
+                # Плотная награда: сколько проехали вперёд вдоль трассы за тик (назад — штраф)
+                position = self.progress.progress_at(self.car.x, self.car.y)
+                reward += self.progress_reward * self.progress.delta_at(self.last_progress, position)
+                if position >= 0:
+                    self.last_progress = position
+
             if abs(self.car.speed) < 0.5:
                 reward -= 1.0
 
@@ -808,43 +1626,15 @@ class RacerEnv:
 
         return self.get_state(), reward, self.done, {}
 
-    def action_to_keys(self, action):
-        keys = {
-            pygame.K_w: False,
-            pygame.K_s: False,
-            pygame.K_a: False,
-            pygame.K_d: False,
-            pygame.K_SPACE: False
-        }
-        if action == 0:
-            keys[pygame.K_w] = True
-        elif action == 1:
-            keys[pygame.K_s] = True
-        elif action == 2:
-            keys[pygame.K_a] = True
-        elif action == 3:
-            keys[pygame.K_d] = True
-        elif action == 4:
-            keys[pygame.K_w] = True
-            keys[pygame.K_a] = True
-        elif action == 5:
-            keys[pygame.K_w] = True
-            keys[pygame.K_d] = True
-        elif action == 6:
-            keys[pygame.K_s] = True
-            keys[pygame.K_a] = True
-        elif action == 7:
-            keys[pygame.K_s] = True
-            keys[pygame.K_d] = True
-        return keys
 
 class GymRacerEnv(gym.Env):
-    def __init__(self, track_path):
+    def __init__(self, track_path, sensors=None, progress_reward=0.0):
         super().__init__()
-        self.racer_env = RacerEnv(track_path)
+        self.racer_env = RacerEnv(track_path, sensors, progress_reward)
 
         self.action_space = gym.spaces.Discrete(8)
-        self.observation_space = gym.spaces.Box(low=0.0, high=1.0, shape=(8,), dtype=np.float32)
+        self.observation_space = gym.spaces.Box(low=0.0, high=1.0, shape=(self.racer_env.sensors.obs_size,),
+                                                dtype=np.float32)
 
     def reset(self, *, seed=None, options=None):
         if seed is not None:
@@ -863,5 +1653,21 @@ class GymRacerEnv(gym.Env):
 
 # === ЗАПУСК ===
 if __name__ == "__main__":
-    main_menu()
+    import argparse
+    parser = argparse.ArgumentParser(description="Top-Down Racer")
+    parser.add_argument("--profile", action="store_true", help="показать оверлей времени кадра (в игре — F3)")
+    parser.add_argument("--profile-csv", default=None, help="писать время каждого кадра по участкам в CSV")
+    parser.add_argument("--cprofile", default=None, help="запустить весь сеанс под cProfile и сохранить статистику")
+    parser.add_argument("--new-track-size", type=parse_grid_size, default=(100, 80), metavar="WxH",
+                        help="размер новой трассы в редакторе, в тайлах (до 1000x1000)")
+    args = parser.parse_args()
+
+    profiler = FrameProfiler(overlay=args.profile, csv_path=args.profile_csv, sections=PROFILE_SECTIONS)
+    try:
+        if args.cprofile:
+            run_with_cprofile(args.cprofile, main_menu, profiler, args.new_track_size)
+        else:
+            main_menu(profiler, args.new_track_size)
+    finally:
+        profiler.close()
 
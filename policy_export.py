@@ -0,0 +1,133 @@
+# policy_export.py
+# Экспорт политики PPO (MlpPolicy) в .npz с весами NumPy и её исполнение без stable_baselines3 и torch.
+# Для сети 8 -> 64 -> 64 -> 8 прямой проход — три умножения матриц, пачкой для любого числа машин.
+#
+# Примеры:
+#   python policy_export.py models/racer_model_1275000_steps.zip    # -> models/racer_model_1275000_steps.npz
+#   python policy_export.py models/*.zip
+
+import glob
+import os
+import sys
+
+import numpy as np
+
+POLICY_EXT = ".npz"
+ACTIVATIONS = {
+    "Tanh": np.tanh,
+    "ReLU": lambda x: np.maximum(x, 0.0, out=x),
+}
+
+
+class NumpyPolicy:
+    # Та же сигнатура predict, что у моделей SB3: (действия, None)
+    def __init__(self, weights, biases, activation="Tanh"):
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Активация {activation} не поддерживается (есть: {', '.join(ACTIVATIONS)})")
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        self.activation = activation
+        self.activation_fn = ACTIVATIONS[activation]
+        self.obs_dim = self.weights[0].shape[0]
+        self.n_actions = self.weights[-1].shape[1]
+        self.rng = np.random.default_rng()
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            n_layers = int(data["n_layers"])
+            weights = [data[f"w{i}"] for i in range(n_layers)]
+            biases = [data[f"b{i}"] for i in range(n_layers)]
+            activation = str(data["activation"])
+        return cls(weights, biases, activation)
+
+    def save(self, path):
+        arrays = {"n_layers": np.int64(len(self.weights)), "activation": np.str_(self.activation)}
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            arrays[f"w{i}"] = w
+            arrays[f"b{i}"] = b
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # экспорт может идти сразу в обучении и в процессе оценки
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def set_random_seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def logits(self, obs):
+        # obs: (N, obs_dim) -> (N, n_actions); веса хранятся как (вход, выход), без транспонирования
+        x = obs
+        last = len(self.weights) - 1
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            x = x @ w
+            x += b
+            if i < last:
+                x = self.activation_fn(x)
+        return x
+
+    def predict(self, obs, state=None, episode_start=None, deterministic=False):
+        obs = np.asarray(obs, dtype=np.float32)
+        single = obs.ndim == 1
+        logits = self.logits(obs.reshape(-1, self.obs_dim))
+        if deterministic:
+            actions = logits.argmax(axis=1)
+        else:
+            # Выборка из softmax через Gumbel-max: одна операция на всю пачку
+            actions = (logits - np.log(-np.log(self.rng.random(logits.shape)))).argmax(axis=1)
+        return (actions[0] if single else actions), None
+
+
+def policy_activation(policy):
+    # Имя активации сети политики SB3 ("Tanh", "ReLU")
+    activations = {type(m).__name__ for m in policy.mlp_extractor.policy_net if not hasattr(m, "weight")}
+    if len(activations) > 1:
+        raise ValueError(f"разные активации в сети ({', '.join(sorted(activations))})")
+    return activations.pop() if activations else "Tanh"
+
+
+def policy_from_state_dict(state_dict, activation="Tanh"):
+    # NumpyPolicy из state_dict политики SB3 (model.get_parameters()["policy"]) без сборки модели
+    prefix = "mlp_extractor.policy_net."
+    indices = sorted(int(key[len(prefix):-len(".weight")]) for key in state_dict
+                     if key.startswith(prefix) and key.endswith(".weight"))
+    names = [f"{prefix}{i}" for i in indices] + ["action_net"]
+    # Torch хранит веса как (выход, вход) — транспонируем один раз при экспорте
+    weights = [state_dict[f"{name}.weight"].detach().cpu().numpy().T for name in names]
+    biases = [state_dict[f"{name}.bias"].detach().cpu().numpy() for name in names]
+    return NumpyPolicy(weights, biases, activation)
+
+
+def export_policy(model_path, out_path=None):
+    from stable_baselines3 import PPO
+
+    model = PPO.load(model_path, device="cpu")
+    try:
+        activation = policy_activation(model.policy)
+    except ValueError as e:
+        raise ValueError(f"{model_path}: {e}") from None
+    exported = policy_from_state_dict(model.policy.state_dict(), activation)
+
+    if out_path is None:
+        out_path = os.path.splitext(model_path)[0] + POLICY_EXT
+    exported.save(out_path)
+    return out_path
+
+
+def load_policy(path):
+    # .npz — напрямую; для .zip берётся экспорт рядом, если он не старше модели, иначе полная загрузка SB3
+    if path.endswith(POLICY_EXT):
+        return NumpyPolicy.load(path)
+    exported = os.path.splitext(path)[0] + POLICY_EXT
+    if os.path.exists(exported) and os.path.getmtime(exported) >= os.path.getmtime(path):
+        return NumpyPolicy.load(exported)
+    from stable_baselines3 import PPO
+    return PPO.load(path, device="cpu")
+
+
+if __name__ == "__main__":
+    paths = []
+    for pattern in sys.argv[1:] or ["models/*.zip"]:
+        paths.extend(sorted(glob.glob(pattern)))
+    for model_path in paths:
+        out_path = export_policy(model_path)
+        print(f"✅ {model_path} → {out_path} ({os.path.getsize(out_path)} байт)")
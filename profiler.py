@@ -0,0 +1,141 @@
+# profiler.py
+# Замеры времени кадра по именованным участкам игрового цикла.
+#
+# Цикл размечается метками: begin_frame(), затем mark("участок") после каждого участка, end_frame().
+# Метка записывает время от предыдущей метки. Пока профайлер выключен (нет оверлея и записи в CSV),
+# каждый вызов — одна проверка флага.
+# Столбцы CSV фиксированы заранее (sections); участки не из списка суммируются в other_ms.
+
+import cProfile
+import csv
+import pstats
+import time
+from collections import deque
+
+import numpy as np
+import pygame
+
+OVERLAY_REFRESH = 0.25  # текст оверлея обновляется 4 раза в секунду, а не каждый кадр
+OVERLAY_WIDTH = 380
+
+
+class FrameProfiler:
+    def __init__(self, overlay=False, csv_path=None, history=240, sections=()):
+        self.overlay = overlay
+        self.history = history
+        self.frames = deque(maxlen=history)  # длительность кадра целиком, с
+        self.sections = {}  # участок -> deque длительностей, с
+        self.current = {}
+        self.frame_start = 0.0
+        self.last = 0.0
+        self.frame_index = 0
+        self.overlay_lines = []
+        self.overlay_background = None
+        self.overlay_updated = 0.0
+
+        self.csv_file = None
+        self.csv_writer = None
+        self.csv_columns = list(sections)
+        self.csv_rows = []
+        if csv_path:
+            self.csv_file = open(csv_path, "w", newline="")
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(["frame", "total_ms"] + [f"{name}_ms" for name in self.csv_columns] +
+                                     ["other_ms"])
+        self.active = self.overlay or self.csv_writer is not None
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.active = self.overlay or self.csv_writer is not None
+
+    def begin_frame(self):
+        if not self.active:
+            return
+        self.frame_start = self.last = time.perf_counter()
+        self.current = {}
+
+    def mark(self, name):
+        if not self.active:
+            return
+        now = time.perf_counter()
+        self.current[name] = self.current.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def end_frame(self):
+        if not self.active:
+            return
+        total = time.perf_counter() - self.frame_start
+        self.frames.append(total)
+        for name, seconds in self.current.items():
+            samples = self.sections.get(name)
+            if samples is None:
+                samples = self.sections[name] = deque(maxlen=self.history)
+            samples.append(seconds)
+        if self.csv_writer is not None:
+            self.write_csv_row(total)
+        self.frame_index += 1
+
+    def write_csv_row(self, total):
+        known = [self.current.get(name, 0.0) for name in self.csv_columns]
+        other = sum(self.current.values()) - sum(known)
+        self.csv_rows.append([self.frame_index, round(total * 1000, 4)] +
+                             [round(seconds * 1000, 4) for seconds in known] + [round(other * 1000, 4)])
+        if len(self.csv_rows) >= 600:
+            self.flush()
+
+    def flush(self):
+        if self.csv_writer is not None and self.csv_rows:
+            self.csv_writer.writerows(self.csv_rows)
+            self.csv_rows = []
+            self.csv_file.flush()
+
+    def close(self):
+        if self.csv_file is not None:
+            self.flush()
+            self.csv_file.close()
+            self.csv_file = self.csv_writer = None
+            self.active = self.overlay
+
+    def stats(self):
+        # (кадр: последний, p50, p99 в мс; участки: [(имя, среднее мс, максимум мс)])
+        if not self.frames:
+            return None
+        frames = np.fromiter(self.frames, dtype=np.float64) * 1000
+        sections = [(name, float(np.mean(samples)) * 1000, float(np.max(samples)) * 1000)
+                    for name, samples in self.sections.items() if samples]
+        return (float(frames[-1]), float(np.percentile(frames, 50)), float(np.percentile(frames, 99)), sections)
+
+    def draw(self, screen, hud, pos=None):
+        # pos — левый верхний угол текста; по умолчанию правый верхний угол экрана (слева — HUD круга)
+        if not self.overlay:
+            return
+        now = time.perf_counter()
+        if now - self.overlay_updated >= OVERLAY_REFRESH:
+            self.overlay_updated = now
+            stats = self.stats()
+            if stats is not None:
+                last, p50, p99, sections = stats
+                self.overlay_lines = [f"кадр {last:5.2f} мс  p50 {p50:5.2f}  p99 {p99:5.2f}  "
+                                      f"({1000 / p50 if p50 else 0:.0f} FPS)"]
+                self.overlay_lines += [f"{name:8s} {mean:6.2f} мс  max {peak:6.2f}" for name, mean, peak in sections]
+                height = 26 * len(self.overlay_lines) + 8
+                if self.overlay_background is None or self.overlay_background.get_height() != height:
+                    self.overlay_background = pygame.Surface((OVERLAY_WIDTH, height), pygame.SRCALPHA)
+                    self.overlay_background.fill((0, 0, 0, 160))
+
+        x, y = pos if pos is not None else (screen.get_width() - OVERLAY_WIDTH - 6, 10)
+        if self.overlay_background is not None:
+            screen.blit(self.overlay_background, (x - 4, y - 4))
+        for i, line in enumerate(self.overlay_lines):
+            hud.draw(screen, f"profiler_{i}", line, (255, 220, 120), (x, y + 26 * i))
+
+
+def run_with_cprofile(path, func, *args, top=30, **kwargs):
+    # Весь сеанс под cProfile; статистика сохраняется даже при выходе через sys.exit()
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats(path)
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(top)
+        print(f"✅ Профиль cProfile: {path} (snakeviz / python -m pstats {path})")
@@ -0,0 +1,407 @@
+# replay.py
+# Повторы заездов в компактном бинарном формате. Физика детерминирована, поэтому на тик пишется только
+# управление (1 байт), а полное состояние машины — ключевым кадром раз в keyframe_interval тиков.
+# Любая точка повтора восстанавливается от ближайшего ключевого кадра пересимуляцией не больше
+# keyframe_interval тиков; час заезда при 60 тиках/с и кадре раз в 5 с — около 250 КБ.
+#
+# Файл: заголовок + метаданные JSON, затем блоки одинакового размера
+# (ключевой кадр x, y, angle, speed, brake_factor — 5×float64, и байты управления его тиков),
+# в конце — итог заезда JSON и его длина. Пока заезд идёт, файл лежит как <путь>.tmp и дописывается целыми
+# блоками; если игра упала, остаётся .tmp без итога — Replay, --info и --check читают его до конца последнего
+# записанного блока (теряется не больше keyframe_interval тиков).
+#
+# Примеры:
+#   python replay.py replays/track_05_best.rpl               # просмотр: SPACE пауза, ←/→ ±5 с, 0-9, клик по шкале
+#   python replay.py replays/*.rpl --info
+#   python replay.py replays/eval/*.rpl --check              # пересимуляция без окна: скорость и расхождение
+
+import argparse
+import glob
+import json
+import math
+import os
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b"RRPL"
+END_MAGIC = b"REND"
+VERSION = 1
+REPLAY_EXT = ".rpl"
+REPLAY_DIR = "replays"
+KEYFRAME_INTERVAL = 300  # 5 с при 60 тиках/с
+
+HEADER = struct.Struct("<4sHHIII")  # magic, версия, тиков/с, интервал кадров, crc сетки, длина метаданных
+KEYFRAME = struct.Struct("<5d")
+TRAILER = struct.Struct("<I4s")
+
+# Байт управления: газ, тормоз, влево, вправо, ручник
+THROTTLE, BRAKE, LEFT, RIGHT, HANDBRAKE = 1, 2, 4, 8, 16
+CODE_CONTROLS = [(int(bool(code & THROTTLE)), int(bool(code & BRAKE)),
+                  int(bool(code & RIGHT)) - int(bool(code & LEFT)), int(bool(code & HANDBRAKE)))
+                 for code in range(32)]
+
+
+def encode_controls(throttle, brake, steer, handbrake):
+    return ((THROTTLE if throttle else 0) | (BRAKE if brake else 0) | (LEFT if steer < 0 else 0) |
+            (RIGHT if steer > 0 else 0) | (HANDBRAKE if handbrake else 0))
+
+
+def track_crc(track):
+    return zlib.crc32(np.ascontiguousarray(np.asarray(track.grid, dtype=np.uint8)).tobytes())
+
+
+def session_replay_path(track_path):
+    return os.path.join(REPLAY_DIR, os.path.splitext(os.path.basename(track_path))[0] + "_last" + REPLAY_EXT)
+
+
+def best_replay_path(track_path):
+    return os.path.join(REPLAY_DIR, os.path.splitext(os.path.basename(track_path))[0] + "_best" + REPLAY_EXT)
+
+
+class ReplayWriter:
+    # record*() вызывается раз за тик, до шага физики. Тики копятся в буфере блока; законченный блок сразу
+    # уходит в файл (одна запись раз в keyframe_interval тиков). До close() файл лежит как <путь>.tmp,
+    # по close() атомарно занимает своё место.
+    def __init__(self, path, track, meta=None, tick_rate=60, keyframe_interval=KEYFRAME_INTERVAL):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.block_size = KEYFRAME.size + keyframe_interval
+        self.buffer = bytearray(self.block_size)
+        self.pos = 0
+        self.ticks = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        meta_bytes = json.dumps(meta or {}, ensure_ascii=False).encode("utf-8")
+        self.file.write(HEADER.pack(MAGIC, VERSION, tick_rate, keyframe_interval, track_crc(track), len(meta_bytes)))
+        self.file.write(meta_bytes)
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, controls, car):
+        self.record_code(encode_controls(*controls), car.x, car.y, car.angle, car.speed, car.brake_factor)
+
+    def record_code(self, code, x, y, angle, speed, brake_factor):
+        if self.ticks % self.keyframe_interval == 0:
+            self.flush()  # предыдущий блок закончен
+            KEYFRAME.pack_into(self.buffer, self.pos, x, y, angle, speed, brake_factor)
+            self.pos += KEYFRAME.size
+        self.buffer[self.pos] = code
+        self.pos += 1
+        self.ticks += 1
+
+    def flush(self):
+        # В файл (и из буфера Python в ОС): при падении процесса записанные блоки остаются в .tmp
+        if self.pos:
+            self.file.write(memoryview(self.buffer)[:self.pos])
+            self.file.flush()
+            self.pos = 0
+
+    def close(self, summary=None):
+        if self.file is None:
+            return
+        self.flush()
+        summary_bytes = json.dumps(dict(summary or {}, ticks=self.ticks), ensure_ascii=False).encode("utf-8")
+        self.file.write(summary_bytes)
+        self.file.write(TRAILER.pack(len(summary_bytes), END_MAGIC))
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.path)
+
+
+class Replay:
+    # path без файла, но с <path>.tmp (запись не закрыта — игра упала) — читается .tmp
+    def __init__(self, path):
+        if not os.path.exists(path) and os.path.exists(path + ".tmp"):
+            path += ".tmp"
+        self.path = path
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            raise ValueError(f"{path}: файл повтора обрезан")
+        magic, version, self.tick_rate, self.keyframe_interval, self.track_crc, meta_len = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: не файл повтора")
+        if version != VERSION:
+            raise ValueError(f"{path}: версия формата {version}, поддерживается {VERSION}")
+        body_start = HEADER.size + meta_len
+        self.meta = json.loads(data[HEADER.size:body_start].decode("utf-8"))
+
+        body_end = len(data)
+        self.summary = {}
+        if body_end - body_start >= TRAILER.size:
+            length, end_magic = TRAILER.unpack_from(data, body_end - TRAILER.size)
+            if end_magic == END_MAGIC and length <= body_end - body_start - TRAILER.size:
+                summary_start = body_end - TRAILER.size - length
+                self.summary = json.loads(data[summary_start:body_end - TRAILER.size].decode("utf-8"))
+                body_end = summary_start
+
+        block_size = KEYFRAME.size + self.keyframe_interval
+        body = memoryview(data)[body_start:body_end]
+        self.keyframes = []
+        inputs = []
+        for offset in range(0, len(body), block_size):
+            if len(body) - offset <= KEYFRAME.size:
+                break
+            self.keyframes.append(KEYFRAME.unpack_from(body, offset))
+            inputs.append(body[offset + KEYFRAME.size:offset + block_size])
+        self.codes = b"".join(inputs)
+        self.ticks = len(self.codes)
+
+    @property
+    def duration(self):
+        return self.ticks / self.tick_rate
+
+    def matches(self, track):
+        return track_crc(track) == self.track_crc
+
+    def controls(self, tick):
+        return CODE_CONTROLS[self.codes[tick]]
+
+    def load_keyframe(self, car, index):
+        car.x, car.y, car.angle, car.speed, car.brake_factor = self.keyframes[index]
+
+    def step(self, car, track, tick):
+        # Тик tick: на границе блока состояние берётся из ключевого кадра, затем шаг физики с записанным управлением
+        if tick % self.keyframe_interval == 0:
+            self.load_keyframe(car, tick // self.keyframe_interval)
+        car.control(*CODE_CONTROLS[self.codes[tick]], track)
+
+    def seek(self, car, track, tick):
+        # Состояние в начале тика tick (tick == ticks — после последнего тика)
+        tick = min(max(tick, 0), self.ticks)
+        if not self.keyframes:
+            return tick
+        index = min(tick // self.keyframe_interval, len(self.keyframes) - 1)
+        self.load_keyframe(car, index)
+        for t in range(index * self.keyframe_interval, tick):
+            car.control(*CODE_CONTROLS[self.codes[t]], track)
+        car.prev_x, car.prev_y, car.prev_angle = car.x, car.y, car.angle
+        return tick
+
+    def states(self, car, track, start=0, end=None):
+        # Для каждого тика от start до end: car — состояние в начале тика; после цикла car в состоянии end
+        end = self.ticks if end is None else min(end, self.ticks)
+        start = self.seek(car, track, start)
+        for tick in range(start, end):
+            yield tick
+            self.step(car, track, tick)
+
+    def drift(self, car, track):
+        # Наибольший разрыв между пересимуляцией блока и следующим ключевым кадром, px.
+        # У записей из Car он нулевой; у записей из VecRacerEnv — следы векторной арифметики.
+        worst = 0.0
+        for index in range(1, len(self.keyframes)):
+            self.seek(car, track, index * self.keyframe_interval - 1)
+            car.control(*self.controls(index * self.keyframe_interval - 1), track)
+            x, y = self.keyframes[index][:2]
+            worst = max(worst, math.hypot(car.x - x, car.y - y))
+        return worst
+
+
+def extract(replay, track, car, start, end, path, meta=None, summary=None):
+    # Отрезок [start, end) повтора — отдельным файлом с собственными ключевыми кадрами (например, один круг)
+    with ReplayWriter(path, track, replay.meta if meta is None else meta, replay.tick_rate,
+                      replay.keyframe_interval) as writer:
+        for tick in replay.states(car, track, start, end):
+            writer.record_code(replay.codes[tick], car.x, car.y, car.angle, car.speed, car.brake_factor)
+        writer.close(summary)
+    return path
+
+
+def save_best_lap(session_path, best_path, track, car):
+    # Лучший круг сессии заменяет сохранённый лучший круг трассы, если он быстрее
+    session = Replay(session_path)
+    lap_times = session.summary.get("lap_times") or []
+    if not lap_times:
+        return None
+    index = min(range(len(lap_times)), key=lap_times.__getitem__)
+    lap_time = lap_times[index]
+    if os.path.exists(best_path):
+        try:
+            previous = Replay(best_path).summary.get("best_lap_time")
+        except ValueError:
+            previous = None
+        if previous is not None and previous <= lap_time:
+            return None
+    start, end = session.summary["lap_ticks"][index]
+    meta = dict(session.meta, lap=index + 1)
+    return extract(session, track, car, start, end, best_path, meta,
+                   {"lap_times": [lap_time], "best_lap_time": lap_time, "session_tick": start})
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes):02d}:{seconds:05.2f}"
+
+
+# === Просмотр ===
+def play(path, track_path=None, ticks_per_frame=0):
+    # SPACE — пауза, ←/→ — ±5 с, Home/End, 0-9 — доля повтора, клик по шкале — перейти, F и +/- — перемотка
+    import pygame
+    from main import Car, FixedStepClock, FPS, HudLayer, SpriteCache, Track, TrackRenderer
+
+    replay = Replay(path)
+    track = Track(track_path or replay.meta["track"])
+    if not replay.matches(track):
+        print(f"⚠️ Трасса {track.name} изменилась после записи — повтор может разойтись", file=sys.stderr)
+
+    pygame.init()
+    screen = pygame.display.set_mode((800, 600))
+    pygame.display.set_caption(f"Replay — {os.path.basename(path)}")
+    display_width, display_height = 800, 600
+    clock = pygame.time.Clock()
+
+    car = Car(0, 0)
+    tick = replay.seek(car, track, 0)
+    track_renderer = TrackRenderer(track)
+    car_sprites = SpriteCache(car.original_image)
+    hud = HudLayer()
+    sim = FixedStepClock(ticks_per_frame)
+    fast_ticks = ticks_per_frame or 8
+    zoom = 1.5
+    paused = False
+    bar = pygame.Rect(10, display_height - 24, display_width - 20, 12)
+    jump = 5 * replay.tick_rate
+    title = replay.meta.get("driver", "")
+    if "lap" in replay.meta:
+        title += f", круг {replay.meta['lap']}"
+
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    running = False
+                elif event.key == pygame.K_SPACE:
+                    paused = not paused
+                elif event.key == pygame.K_LEFT:
+                    tick = replay.seek(car, track, tick - jump)
+                elif event.key == pygame.K_RIGHT:
+                    tick = replay.seek(car, track, tick + jump)
+                elif event.key == pygame.K_HOME:
+                    tick = replay.seek(car, track, 0)
+                elif event.key == pygame.K_END:
+                    tick = replay.seek(car, track, replay.ticks)
+                elif pygame.K_0 <= event.key <= pygame.K_9:
+                    tick = replay.seek(car, track, replay.ticks * (event.key - pygame.K_0) // 10)
+                elif event.key == pygame.K_f:
+                    sim.ticks_per_frame = 0 if sim.ticks_per_frame else fast_ticks
+                elif event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+                    fast_ticks = min(fast_ticks * 2, 1024)
+                    sim.ticks_per_frame = fast_ticks
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS) and sim.ticks_per_frame:
+                    fast_ticks = max(fast_ticks // 2, 1)
+                    sim.ticks_per_frame = fast_ticks
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and bar.inflate(0, 12).collidepoint(event.pos):
+                tick = replay.seek(car, track, replay.ticks * (event.pos[0] - bar.x) // bar.width)
+
+        ticks = sim.frame_ticks()
+        if paused or tick >= replay.ticks:
+            ticks = 0
+            sim.alpha = 1.0
+        for _ in range(min(ticks, replay.ticks - tick)):
+            replay.step(car, track, tick)
+            tick += 1
+
+        # === Рендеринг ===
+        car_x, car_y, car_angle = car.interpolated(sim.alpha)
+        camera_x = car_x - display_width // (2 * zoom)
+        camera_y = car_y - display_height // (2 * zoom)
+        screen.fill((0, 0, 0))
+        track_renderer.draw(screen, camera_x, camera_y, zoom)
+        car_sprites.draw(screen, car_angle, zoom, ((car_x - camera_x) * zoom, (car_y - camera_y) * zoom))
+
+        hud.draw(screen, "time", f"{format_time(tick / replay.tick_rate)} / {format_time(replay.duration)}",
+                 (255, 255, 255), (10, 10))
+        if title:
+            hud.draw(screen, "title", title, (200, 200, 255), (10, 40))
+        best = replay.summary.get("best_lap_time")
+        if best is not None:
+            hud.draw(screen, "best", f"Лучший круг: {best:.2f}s", (255, 255, 100), (10, 70))
+        state = "ПАУЗА" if paused else (f"x{sim.ticks_per_frame} тиков/кадр" if sim.ticks_per_frame else "x1")
+        hud.draw(screen, "state", f"{state}  (SPACE, стрелки, 0-9, F, +/-)", (200, 200, 200), (10, 100))
+
+        pygame.draw.rect(screen, (60, 60, 60), bar)
+        if replay.ticks:
+            filled = bar.copy()
+            filled.width = bar.width * tick // replay.ticks
+            pygame.draw.rect(screen, (100, 200, 255), filled)
+
+        pygame.display.flip()
+        clock.tick(0 if sim.ticks_per_frame else FPS)
+
+    pygame.quit()
+
+
+# === Без окна ===
+def info(path):
+    replay = Replay(path)
+    path = replay.path
+    size = os.path.getsize(path)
+    line = (f"{path}: {format_time(replay.duration)} ({replay.ticks} тиков), {size / 1024:.1f} КБ, "
+            f"трасса {replay.meta.get('track', '?')}")
+    if replay.meta.get("driver"):
+        line += f", {replay.meta['driver']}"
+    if replay.summary.get("best_lap_time") is not None:
+        line += f", лучший круг {replay.summary['best_lap_time']:.2f}s"
+    if not replay.summary:
+        line += " (не закрыт — прочитан до последнего записанного блока)"
+    print(line)
+
+
+def check(path, track_path=None):
+    from main import Car, Track
+
+    replay = Replay(path)
+    track = Track(track_path or replay.meta["track"])
+    car = Car(0, 0)
+    started = time.perf_counter()
+    for _ in replay.states(car, track):
+        pass
+    elapsed = time.perf_counter() - started
+    rate = replay.ticks / elapsed if elapsed > 0 else float("inf")
+    drift = replay.drift(car, track)
+    status = "✅" if replay.matches(track) else "⚠️ трасса изменилась,"
+    print(f"{status} {path}: {replay.ticks} тиков за {elapsed:.3f}s ({rate:.0f} тиков/с, "
+          f"x{rate / replay.tick_rate:.0f} реального времени), расхождение с ключевыми кадрами {drift:.2e} px")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Просмотр и проверка повторов заездов")
+    parser.add_argument("replays", nargs="+", help="файлы или маски .rpl (незакрытые .rpl.tmp подхватываются)")
+    parser.add_argument("--track", default=None, help="трасса (по умолчанию — записанная в повторе)")
+    parser.add_argument("--info", action="store_true", help="только напечатать сведения")
+    parser.add_argument("--check", action="store_true", help="пересимулировать без окна")
+    parser.add_argument("--fast", type=int, default=0, help="тиков физики на кадр при просмотре")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    paths = []
+    for pattern in args.replays:
+        # Вместе с незакрытыми записями (<повтор>.tmp), оставшимися после падения игры
+        found = set(glob.glob(pattern)) | set(glob.glob(pattern + ".tmp"))
+        paths.extend(sorted(found) or [pattern])
+    for replay_path in paths:
+        if args.info:
+            info(replay_path)
+        elif args.check:
+            check(replay_path, args.track)
+        else:
+            play(replay_path, args.track, args.fast)
@@ -0,0 +1,307 @@
+# snapshots.py
+# Снимки модели во время обучения, не останавливая обучение (замена CheckpointCallback):
+# - на шаге обучения параметры только копируются в память (доли миллисекунды);
+# - запись zip, экспорт политики в .npz, удаление лишних снимков и индекс — в фоновом потоке;
+# - оценка снимков — в отдельном процессе (evaluate_ai.evaluate_pair, без окна), пока обучение идёт дальше.
+# Хранятся keep лучших снимков по оценке (и самый свежий); метрики всех снимков — в <папка>/snapshots.json,
+# лучший снимок копируется в <папка>/best_model.zip (и .npz рядом).
+
+import copy
+import json
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+
+from concurrent.futures import ProcessPoolExecutor, wait as wait_futures
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.save_util import recursive_getattr, save_to_zip_file
+
+from evaluate_ai import _init_worker, evaluate_pair, rank_key, rank_models
+from main import PHYSICS_HZ, sensors_path
+from policy_export import POLICY_EXT, policy_activation, policy_from_state_dict
+
+INDEX_FILE = "snapshots.json"
+BEST_MODEL = "best_model.zip"
+EVAL_MAX_STEPS = PHYSICS_HZ * 120  # лимит тиков на оценочный заезд
+
+
+def copy_model_state(model):
+    # То же, что пишет BaseAlgorithm.save, но без сериализации: словарь атрибутов и копии тензоров.
+    # Изменяемые буферы копируются, чтобы обучение не меняло их под фоновой записью
+    data = model.__dict__.copy()
+    exclude = set(model._excluded_save_params())
+    state_dicts_names, torch_variable_names = model._get_torch_save_params()
+    for name in state_dicts_names + torch_variable_names:
+        exclude.add(name.split(".")[0])
+    for name in exclude:
+        data.pop(name, None)
+    for name, value in data.items():
+        if isinstance(value, deque):
+            data[name] = deque(value, maxlen=value.maxlen)
+    params = copy.deepcopy(model.get_parameters())
+    variables = {name: copy.deepcopy(recursive_getattr(model, name)) for name in torch_variable_names}
+    return data, params, variables or None
+
+
+def tmp_name(path):
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def write_snapshot(path, data, params, variables, sensors, activation="Tanh"):
+    tmp_path = tmp_name(path)
+    with open(tmp_path, "wb") as f:
+        save_to_zip_file(f, data=data, params=params, pytorch_variables=variables)
+    os.replace(tmp_path, path)
+    # Оценка и test_ai читают .npz без torch; веса — из уже скопированных параметров, без PPO.load
+    policy_from_state_dict(params["policy"], activation).save(policy_path(path))
+    if sensors is not None:
+        sensors.save(sensors_path(path))
+
+
+def policy_path(model_path):
+    return os.path.splitext(model_path)[0] + POLICY_EXT
+
+
+def remove_snapshot(path):
+    for file_path in (path, policy_path(path), sensors_path(path)):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def copy_snapshot(path, dest):
+    for src, dst in ((path, dest), (policy_path(path), policy_path(dest)),
+                     (sensors_path(path), sensors_path(dest))):
+        if os.path.exists(src):
+            shutil.copyfile(src, tmp_name(dst))
+            os.replace(tmp_name(dst), dst)
+
+
+def write_index(path, index):
+    with open(tmp_name(path), "w") as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_name(path), path)
+
+
+class SnapshotWriter:
+    # Фоновый поток с очередью задач: задачи выполняются строго по порядку (снимок пишется раньше, чем удаляется
+    # или копируется). Поток запускается по требованию, как у track_io.BackgroundSaver.
+    # poll() возвращает завершённые задачи: [(метка, None или исключение)]
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = deque()
+        self.results = []
+        self.thread = None
+
+    def submit(self, label, fn, *args):
+        with self.lock:
+            self.tasks.append((label, fn, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.tasks:
+                    self.thread = None
+                    return
+                label, fn, args = self.tasks.popleft()
+            try:
+                fn(*args)
+                error = None
+            except Exception as e:  # запись не должна ронять обучение
+                error = e
+            with self.lock:
+                self.results.append((label, error))
+
+    def poll(self):
+        with self.lock:
+            results, self.results = self.results, []
+        return results
+
+    def wait(self):
+        while True:
+            with self.lock:
+                thread = self.thread
+            if thread is None:
+                return
+            thread.join()
+
+
+class SnapshotCallback(BaseCallback):
+    # Каждые save_freq вызовов (шагов на одну машину) — снимок <prefix>_<шаги>_steps.zip в save_path.
+    # eval_tracks — на чём оценивать (пусто — без оценки, тогда хранятся keep последних снимков).
+    # Оценивается один снимок за раз: если оценка не успевает, промежуточные снимки пропускаются и удаляются.
+    # sensors — датчики модели, пишутся рядом с каждым снимком (<снимок>.sensors.json)
+    def __init__(self, save_freq, save_path, name_prefix="racer_model", keep=5, eval_tracks=(), eval_laps=2,
+                 eval_max_steps=EVAL_MAX_STEPS, start_method=None, sensors=None, verbose=1):
+        super().__init__(verbose)
+        self.save_freq = save_freq
+        self.save_path = save_path
+        self.name_prefix = name_prefix
+        self.keep = keep
+        self.eval_tracks = list(eval_tracks)
+        self.eval_laps = eval_laps
+        self.eval_max_steps = eval_max_steps
+        self.start_method = start_method
+        self.sensors = sensors
+        self.writer = SnapshotWriter()
+        self.snapshots = []  # {"path", "timesteps", "saved_at", "saved", "status", "metrics", "kept"}
+        self.pool = None
+        self.evaluation = None  # (снимок, [future по трассам])
+        self.best = None
+        self.snapshot_ms = 0.0
+        self.activation = "Tanh"
+
+    @property
+    def index_path(self):
+        return os.path.join(self.save_path, INDEX_FILE)
+
+    @property
+    def best_path(self):
+        return os.path.join(self.save_path, BEST_MODEL)
+
+    def _init_callback(self):
+        os.makedirs(self.save_path, exist_ok=True)
+        self.activation = policy_activation(self.model.policy)
+        if self.eval_tracks and self.pool is None:
+            start_method = self.start_method
+            if start_method is None:
+                start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+            self.pool = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context(start_method),
+                                            initializer=_init_worker)
+
+    def _on_step(self):
+        if self.n_calls % self.save_freq == 0:
+            self.take_snapshot()
+        self.collect()
+        return True
+
+    def _on_training_end(self):
+        # Последний снимок и его оценка: обучение уже закончилось, здесь можно и подождать
+        if not self.snapshots or self.snapshots[-1]["timesteps"] != self.num_timesteps:
+            self.take_snapshot()
+        self.close(wait=True)
+        if self.best is not None and self.verbose:
+            print(f"✅ Лучший снимок: {self.best['path']} → {self.best_path}")
+
+    def take_snapshot(self):
+        started = time.perf_counter()
+        path = os.path.join(self.save_path, f"{self.name_prefix}_{self.num_timesteps}_steps.zip")
+        data, params, variables = copy_model_state(self.model)
+        self.snapshot_ms = (time.perf_counter() - started) * 1000
+        self.snapshots.append({"path": path, "timesteps": self.num_timesteps, "saved_at": time.time(),
+                               "saved": False, "status": "pending" if self.pool is not None else "unevaluated",
+                               "metrics": None, "kept": True})
+        self.writer.submit(("save", path), write_snapshot, path, data, params, variables, self.sensors,
+                           self.activation)
+
+    def collect(self):
+        # Вызывается на каждом шаге: только проверки готовности, без ожидания
+        changed = False
+        for (kind, path), error in self.writer.poll():
+            if kind != "save":
+                if error is not None:
+                    print(f"⚠️ {path}: {error}", file=sys.stderr)
+                continue
+            snapshot = self.find(path)
+            if error is None:
+                snapshot["saved"] = True
+            else:
+                print(f"⚠️ Снимок {path} не записан: {error}", file=sys.stderr)
+                self.snapshots.remove(snapshot)
+            changed = True
+
+        if self.evaluation is not None and all(future.done() for future in self.evaluation[1]):
+            snapshot, futures = self.evaluation
+            self.evaluation = None
+            try:
+                results = [future.result() for future in futures]
+                row = rank_models(results)[0]
+                snapshot["metrics"] = {key: row[key] for key in
+                                       ("completion_rate", "crash_rate", "mean_reward", "mean_best_lap_time")}
+                snapshot["status"] = "evaluated"
+            except Exception as e:
+                print(f"⚠️ Оценка {snapshot['path']} не удалась: {e}", file=sys.stderr)
+                snapshot["metrics"] = {}
+                snapshot["status"] = "failed"
+            changed = True
+
+        if self.pool is not None and self.evaluation is None:
+            waiting = [s for s in self.snapshots if s["kept"] and s["saved"] and s["metrics"] is None]
+            if waiting:
+                # Свежий снимок — на оценку, более старые неоценённые пропускаются
+                for snapshot in waiting[:-1]:
+                    snapshot["metrics"] = {}
+                    snapshot["status"] = "skipped"
+                snapshot = waiting[-1]
+                snapshot["status"] = "evaluating"
+                futures = [self.pool.submit(evaluate_pair, snapshot["path"], track_path, episodes=1,
+                                            laps=self.eval_laps, max_steps=self.eval_max_steps, deterministic=True)
+                           for track_path in self.eval_tracks]
+                self.evaluation = (snapshot, futures)
+                changed = changed or len(waiting) > 1
+
+        if changed:
+            self.prune()
+
+    def find(self, path):
+        return next(s for s in self.snapshots if s["path"] == path)
+
+    def prune(self):
+        # Оставить keep лучших оценённых (без оценки — keep последних), самый свежий и ещё не оценённые
+        saved = [s for s in self.snapshots if s["kept"] and s["saved"]]
+        if self.pool is not None:
+            scored = [s for s in saved if s["metrics"]]
+            scored.sort(key=lambda s: rank_key(s["metrics"]))
+            keep = scored[:self.keep] + [s for s in saved if s["metrics"] is None]
+        else:
+            keep = saved[-self.keep:]
+        if self.evaluation is not None:
+            keep.append(self.evaluation[0])
+        if saved:
+            keep.append(saved[-1])
+        for snapshot in saved:
+            if not any(snapshot is s for s in keep):
+                snapshot["kept"] = False
+                self.writer.submit(("remove", snapshot["path"]), remove_snapshot, snapshot["path"])
+
+        best = scored[0] if self.pool is not None and scored else None
+        if best is not None and best is not self.best:
+            self.best = best
+            self.writer.submit(("best", self.best_path), copy_snapshot, best["path"], self.best_path)
+            if self.verbose:
+                metrics = best["metrics"]
+                lap = metrics["mean_best_lap_time"]
+                print(f"🏆 Лучший снимок: {os.path.basename(best['path'])} (финиш {metrics['completion_rate']:.0%}"
+                      f"{f', круг {lap:.2f}s' if lap is not None else ''})", file=sys.stderr)
+        index = {
+            "updated": time.time(),
+            "best": self.best["path"] if self.best is not None else None,
+            "best_copy": self.best_path if self.best is not None else None,
+            "eval_tracks": self.eval_tracks,
+            "snapshots": [dict(s) for s in self.snapshots if s["saved"]],
+        }
+        self.writer.submit(("index", self.index_path), write_index, self.index_path, index)
+
+    def close(self, wait=False):
+        # wait — дождаться оценки всех оставшихся снимков; иначе оценка отменяется, дописываются только файлы
+        if wait and self.pool is not None:
+            while True:
+                self.writer.wait()
+                self.collect()
+                if self.evaluation is None:
+                    break
+                wait_futures(self.evaluation[1])
+        self.writer.wait()
+        self.collect()
+        self.writer.wait()
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait, cancel_futures=True)
+            self.pool = None
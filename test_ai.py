@@ -1,77 +1,103 @@
 # run_ai.py
+#
+# Примеры:
+#   python test_ai.py                          # реальное время
+#   python test_ai.py --fast 32                # перемотка: 32 тика физики на кадр
+#   python test_ai.py --headless --laps 200    # без окна, только время кругов
+#   python test_ai.py --race models/a.npz models/b.npz --cars-per-model 4   # гонка нескольких моделей
+#   python test_ai.py --headless --laps 5 --record replays/ai.rpl          # записать заезд (python replay.py ...)
+import argparse
+import os
+import time
 import pygame
 import sys
 import numpy as np
-from stable_baselines3 import PPO
-from main import Track, Car, Game, SURFACE_TYPES  # используем твою Game-логику
+from policy_export import load_policy
+from replay import ReplayWriter
+from track_progress import load_progress
+from main import (Track, Car, RacerEnv, SensorConfig, TrackRenderer, SpriteCache, HudLayer, LapTimer,
+                  FixedStepClock, SURFACE_TYPES, ACTION_CONTROLS, FPS, PHYSICS_HZ, PHYSICS_DT)  # используем твою Game-логику
 
 # === Класс AI-контроллера ===
 class AIAgent:
     def __init__(self, model_path, track_path):
-        self.model = PPO.load(model_path)
-        self.track = Track(track_path)
-        start = self.track.start_pos
-        self.car = Car(
-            start['x'] * self.track.tile_size + self.track.tile_size // 2,
-            start['y'] * self.track.tile_size + self.track.tile_size // 2,
-            start.get('angle', 0)
-        )
+        self.model_path = model_path
+        self.track_path = track_path
+        self.model = load_policy(model_path)  # экспорт .npz, если есть (python policy_export.py), иначе SB3
+        # Наблюдение — точно как в RacerEnv и с теми же датчиками, с которыми модель обучалась
+        self.env = RacerEnv(track_path, SensorConfig.for_model(model_path))
+        self.track = self.env.track
+        self.car = self.env.car
 
     def get_action(self):
-        # Получаем состояние (точно как в RacerEnv)
-        norm_speed = (self.car.speed + self.car.max_speed / 2) / (1.5 * self.car.max_speed)
-        norm_speed = np.clip(norm_speed, 0.0, 1.0)
-
-        angle_rad = np.radians(self.car.angle)
-        sin_a = (np.sin(angle_rad) + 1.0) / 2.0
-        cos_a = (np.cos(angle_rad) + 1.0) / 2.0
-
-        # Лучи
-        def cast_ray(angle_offset, max_distance=200):
-            rad = np.radians(self.car.angle + angle_offset)
-            for d in range(0, max_distance, 4):
-                x = self.car.x + d * np.cos(rad)
-                y = self.car.y + d * np.sin(rad)
-                tile = self.track.get_tile(x, y)
-                if tile == 0 or tile == 2:
-                    return d / max_distance
-            return 1.0
-
-        rays = [cast_ray(a) for a in [-90, -45, 0, 45, 90]]
-        obs = np.array([norm_speed, sin_a, cos_a] + rays, dtype=np.float32)
-
         # Предсказание
-        action, _ = self.model.predict(obs, deterministic=True)
+        action, _ = self.model.predict(self.env.get_state(), deterministic=True)
         return int(action)
 
-    def update_car(self, action):
-        keys = self.action_to_keys(action)
-        self.car.update(keys, self.track)
-
-    def action_to_keys(self, action):
-        keys = {
-            pygame.K_w: False,
-            pygame.K_s: False,
-            pygame.K_a: False,
-            pygame.K_d: False,
-            pygame.K_SPACE: False
-        }
-        if action == 0: keys[pygame.K_w] = True
-        elif action == 1: keys[pygame.K_s] = True
-        elif action == 2: keys[pygame.K_a] = True
-        elif action == 3: keys[pygame.K_d] = True
-        elif action == 4: keys[pygame.K_w] = keys[pygame.K_a] = True
-        elif action == 5: keys[pygame.K_w] = keys[pygame.K_d] = True
-        elif action == 6: keys[pygame.K_s] = keys[pygame.K_a] = True
-        elif action == 7: keys[pygame.K_s] = keys[pygame.K_d] = True
-        elif action == 8: keys[pygame.K_SPACE] = True
-        return keys
+    def update_car(self, action, recorder=None):
+        if recorder is not None:
+            recorder.record(ACTION_CONTROLS[action], self.car)
+        self.car.apply_action(action, self.track)
+
+    def make_recorder(self, path):
+        return ReplayWriter(path, self.track, {"track": self.track_path, "driver": os.path.basename(self.model_path),
+                                               "created": time.time()}, PHYSICS_HZ)
+
+
+def batch_observations(track, cars, out, sensors, fields=None):
+    # Наблюдения машин одним массивом (как RacerEnv.get_state с датчиками sensors): лучи — одним пакетным вызовом.
+    # fields — sensors.load_fields(track), если датчикам нужны поля трассы
+    speeds = np.fromiter((car.speed for car in cars), dtype=np.float64, count=len(cars))
+    angles = np.fromiter((car.angle for car in cars), dtype=np.float64, count=len(cars))
+    xs = np.fromiter((car.x for car in cars), dtype=np.float64, count=len(cars))
+    ys = np.fromiter((car.y for car in cars), dtype=np.float64, count=len(cars))
+    min_speed = -Car.max_speed / 2
+    out[:, 0] = np.clip((speeds - min_speed) / (Car.max_speed - min_speed), 0.0, 1.0)
+    angle_rad = np.radians(angles)
+    out[:, 1] = (np.sin(angle_rad) + 1.0) / 2.0
+    out[:, 2] = (np.cos(angle_rad) + 1.0) / 2.0
+    ray_angles = angles[:, None] + np.asarray(sensors.ray_angles)
+    n_rays = len(sensors.ray_angles)
+    if sensors.ray_table:
+        out[:, 3:3 + n_rays] = fields.ray_distances(xs[:, None], ys[:, None], ray_angles)
+    else:
+        out[:, 3:3 + n_rays] = track.cast_rays(xs[:, None], ys[:, None], ray_angles, sensors.max_distance)
+    if sensors.clearance:
+        out[:, 3 + n_rays] = fields.clearance(xs, ys)
+    return out
 
 
 # === Запуск игры с ИИ ===
-def run_ai_game(track_path="tracks/track_05.json", model_path="models/racer_model_1275000_steps.zip"):
+def lap_summary(lap):
+    return {"lap_times": lap.lap_times, "lap_ticks": lap.lap_ticks, "best_lap_time": lap.best_lap_time}
+
+
+def run_ai_headless(agent, laps=10, max_ticks=PHYSICS_HZ * 3600, record=None):
+    # Без окна: только тики физики, пока не пройдено laps кругов или не истёк лимит
+    lap = LapTimer(agent.track, load_progress(agent.track, agent.track_path))
+    recorder = agent.make_recorder(record) if record else None
+    started = time.perf_counter()
+    for _ in range(max_ticks):
+        lap.update(agent.car.x, agent.car.y)
+        if lap.laps_completed >= laps:
+            break
+        agent.update_car(agent.get_action(), recorder)
+    elapsed = time.perf_counter() - started
+    if recorder is not None:
+        recorder.close(lap_summary(lap))
+        print(f"✅ Повтор: {record}")
+    print(f"Тиков: {lap.ticks} ({lap.ticks * PHYSICS_DT:.1f}s игрового времени) за {elapsed:.1f}s, "
+          f"кругов: {lap.laps_completed}")
+    if lap.lap_times:
+        print(f"Лучший круг: {lap.best_lap_time:.2f}s, средний: {sum(lap.lap_times) / len(lap.lap_times):.2f}s")
+    return lap
+
+
+def run_ai_game(track_path="tracks/track_05.json", model_path="models/racer_model_1275000_steps.zip",
+                ticks_per_frame=0, record=None):
+    # ticks_per_frame = 0 — реальное время; N — перемотка, N тиков физики на кадр без ограничения FPS.
+    # F — вкл/выкл перемотку, +/- — вдвое быстрее/медленнее. record — путь для повтора заезда
     pygame.init()
-    fullscreen = False
     screen = pygame.display.set_mode((800, 600))
     pygame.display.set_caption("AI Driving — Press ESC to exit")
     clock = pygame.time.Clock()
@@ -79,8 +105,16 @@ def run_ai_game(track_path="tracks/track_05.json", model_path="models/racer_mode
     agent = AIAgent(model_path, track_path)
     track = agent.track
     car = agent.car
+    track_renderer = TrackRenderer(track)
+    car_sprites = SpriteCache(car.original_image)
+    hud = HudLayer()
+    lap = LapTimer(track, load_progress(track, track_path))
+    recorder = agent.make_recorder(record) if record else None
+    sim = FixedStepClock(ticks_per_frame)
+    fast_ticks = ticks_per_frame or 8
     zoom = 1.0
     display_width, display_height = 800, 600
+    action = 0
 
     running = True
     while running:
@@ -90,58 +124,182 @@ def run_ai_game(track_path="tracks/track_05.json", model_path="models/racer_mode
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     running = False
+                if event.key == pygame.K_f:
+                    sim.ticks_per_frame = 0 if sim.ticks_per_frame else fast_ticks
+                if event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+                    fast_ticks = min(fast_ticks * 2, 1024)
+                    sim.ticks_per_frame = fast_ticks
+                if event.key in (pygame.K_MINUS, pygame.K_KP_MINUS) and sim.ticks_per_frame:
+                    fast_ticks = max(fast_ticks // 2, 1)
+                    sim.ticks_per_frame = fast_ticks
 
-        action = agent.get_action()
-        agent.update_car(action)
+        for _ in range(sim.frame_ticks()):
+            lap.update(car.x, car.y)
+            action = agent.get_action()
+            agent.update_car(action, recorder)
 
         # === Рендеринг ===
-        camera_x = car.x - display_width // (2 * zoom)
-        camera_y = car.y - display_height // (2 * zoom)
+        car_x, car_y, car_angle = car.interpolated(sim.alpha)
+        camera_x = car_x - display_width // (2 * zoom)
+        camera_y = car_y - display_height // (2 * zoom)
         screen.fill((0, 0, 0))
 
-        for y in range(track.height):
-            for x in range(track.width):
-                tile_id = track.grid[y][x]
-                color = SURFACE_TYPES[tile_id]['color']
-                world_x = x * track.tile_size
-                world_y = y * track.tile_size
-                screen_x = (world_x - camera_x) * zoom
-                screen_y = (world_y - camera_y) * zoom
-                scaled_tile = track.tile_size * zoom
-                rect = pygame.Rect(screen_x, screen_y, scaled_tile, scaled_tile)
-                if -scaled_tile < screen_x < display_width and -scaled_tile < screen_y < display_height:
-                    pygame.draw.rect(screen, color, rect)
-
-        car_screen_x = (car.x - camera_x) * zoom
-        car_screen_y = (car.y - camera_y) * zoom
-        scaled_car = pygame.transform.scale(
-            car.original_image,
-            (int(100 * zoom), int(50 * zoom))
-        )
-        rotated = pygame.transform.rotate(scaled_car, -car.angle)
-        rect = rotated.get_rect(center=(car_screen_x, car_screen_y))
-        screen.blit(rotated, rect.topleft)
+        track_renderer.draw(screen, camera_x, camera_y, zoom)
+
+        car_screen_x = (car_x - camera_x) * zoom
+        car_screen_y = (car_y - camera_y) * zoom
+        car_sprites.draw(screen, car_angle, zoom, (car_screen_x, car_screen_y))
 
         # Информация
-        font = pygame.font.SysFont(None, 24)
         action_names = ["Gas", "Brake", "Left", "Right", "Gas+L", "Gas+R", "Brake+L", "Brake+R"]
-        action_text = font.render(f"Action: {action_names[action]}", True, (255, 255, 255))
-        screen.blit(action_text, (10, 10))
-
-        speed_text = font.render(f"Speed: {car.speed:.1f}", True, (255, 255, 255))
-        screen.blit(speed_text, (10, 40))
+        hud.draw(screen, "action", f"Action: {action_names[action]}", (255, 255, 255), (10, 10))
+        hud.draw(screen, "speed", f"Speed: {car.speed:.1f}", (255, 255, 255), (10, 40))
 
         tile_id = track.get_tile(car.x, car.y)
         tile_name = SURFACE_TYPES[tile_id]["name"]
-        tile_text = font.render(f"Surface: {tile_name}", True, (255, 255, 255))
-        screen.blit(tile_text, (10, 70))
+        hud.draw(screen, "surface", f"Surface: {tile_name}", (255, 255, 255), (10, 70))
+
+        hud.draw(screen, "laps", f"Laps: {lap.laps_completed}  Lap: {lap.current_lap_time:.2f}s", (100, 255, 100), (10, 100))
+        if lap.best_lap_time:
+            hud.draw(screen, "best", f"Best: {lap.best_lap_time:.2f}s", (255, 255, 100), (10, 130))
+        speedup = f"x{sim.ticks_per_frame} ticks/frame" if sim.ticks_per_frame else "real time"
+        hud.draw(screen, "sim", f"{speedup} (F, +/-)  FPS: {clock.get_fps():.0f}", (200, 200, 200), (10, 160))
+
+        pygame.display.flip()
+        clock.tick(0 if sim.ticks_per_frame else FPS)
+
+    if recorder is not None:
+        recorder.close(lap_summary(lap))
+    pygame.quit()
+    sys.exit()
+
+
+# === Гонка нескольких ИИ ===
+RACE_COLORS = [(255, 80, 80), (80, 160, 255), (80, 255, 120), (255, 220, 60),
+               (220, 100, 255), (255, 150, 40), (60, 255, 255), (255, 255, 255)]
+
+
+def run_ai_race(track_path, model_paths, cars_per_model=1, ticks_per_frame=0):
+    # Машины не сталкиваются друг с другом. Каждая модель вызывается раз за тик — одним predict на все её машины.
+    # TAB — следить за следующей машиной, F и +/- — перемотка, как в run_ai_game
+    pygame.init()
+    screen = pygame.display.set_mode((800, 600))
+    pygame.display.set_caption("AI Race — Press ESC to exit")
+    clock = pygame.time.Clock()
+
+    track = Track(track_path)
+    progress = load_progress(track, track_path)
+    policies = [load_policy(path) for path in model_paths]
+    sensors = [SensorConfig.for_model(path) for path in model_paths]  # у каждой модели свои датчики
+    fields = [config.load_fields(track, track_path) for config in sensors]
+    names = [os.path.splitext(os.path.basename(path))[0] for path in model_paths]
+    start = track.start_pos
+    cars, timers, owners = [], [], []
+    for model_index in range(len(policies)):
+        for _ in range(cars_per_model):
+            cars.append(Car(start['x'] * track.tile_size + track.tile_size // 2,
+                            start['y'] * track.tile_size + track.tile_size // 2,
+                            start.get('angle', 0)))
+            timers.append(LapTimer(track, progress))
+            owners.append(model_index)
+    owners = np.array(owners)
+    groups = [np.flatnonzero(owners == i) for i in range(len(policies))]
+    group_cars = [[cars[i] for i in indices] for indices in groups]
+    group_obs = [np.empty((len(indices), config.obs_size), dtype=np.float32)
+                 for indices, config in zip(groups, sensors)]
+    actions = np.zeros(len(cars), dtype=np.int64)
+
+    track_renderer = TrackRenderer(track)
+    car_sprites = SpriteCache(cars[0].original_image)
+    hud = HudLayer()
+    sim = FixedStepClock(ticks_per_frame)
+    fast_ticks = ticks_per_frame or 8
+    zoom = 1.0
+    display_width, display_height = 800, 600
+    followed = 0
+
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    running = False
+                if event.key == pygame.K_TAB:
+                    followed = (followed + 1) % len(cars)
+                if event.key == pygame.K_f:
+                    sim.ticks_per_frame = 0 if sim.ticks_per_frame else fast_ticks
+                if event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+                    fast_ticks = min(fast_ticks * 2, 1024)
+                    sim.ticks_per_frame = fast_ticks
+                if event.key in (pygame.K_MINUS, pygame.K_KP_MINUS) and sim.ticks_per_frame:
+                    fast_ticks = max(fast_ticks // 2, 1)
+                    sim.ticks_per_frame = fast_ticks
+
+        for _ in range(sim.frame_ticks()):
+            for car, timer in zip(cars, timers):
+                timer.update(car.x, car.y)
+            for policy, indices, config, group_fields, members, obs in zip(policies, groups, sensors, fields,
+                                                                             group_cars, group_obs):
+                batch_observations(track, members, obs, config, group_fields)
+                actions[indices], _ = policy.predict(obs, deterministic=True)
+            for car, action in zip(cars, actions.tolist()):
+                car.apply_action(action, track)
+
+        # === Рендеринг ===
+        focus_x, focus_y, _ = cars[followed].interpolated(sim.alpha)
+        camera_x = focus_x - display_width // (2 * zoom)
+        camera_y = focus_y - display_height // (2 * zoom)
+        screen.fill((0, 0, 0))
+        track_renderer.draw(screen, camera_x, camera_y, zoom)
+
+        for car, owner in zip(cars, owners.tolist()):
+            car_x, car_y, car_angle = car.interpolated(sim.alpha)
+            screen_x = (car_x - camera_x) * zoom
+            screen_y = (car_y - camera_y) * zoom
+            if -100 <= screen_x <= display_width + 100 and -100 <= screen_y <= display_height + 100:
+                car_sprites.draw(screen, car_angle, zoom, (screen_x, screen_y))
+                pygame.draw.circle(screen, RACE_COLORS[owner % len(RACE_COLORS)], (screen_x, screen_y), 6)
+
+        # Таблица: больше кругов, затем лучший круг
+        order = sorted(range(len(cars)), key=lambda i: (-timers[i].laps_completed,
+                                                        timers[i].best_lap_time or float("inf")))
+        for row, i in enumerate(order[:12]):
+            best = f"{timers[i].best_lap_time:.2f}s" if timers[i].best_lap_time else "—"
+            marker = ">" if i == followed else " "
+            hud.draw(screen, f"race_{row}", f"{marker}{row + 1}. {names[owners[i]]}#{i}  Laps: {timers[i].laps_completed}  Best: {best}",
+                     RACE_COLORS[owners[i] % len(RACE_COLORS)], (10, 10 + 26 * row))
+        speedup = f"x{sim.ticks_per_frame} ticks/frame" if sim.ticks_per_frame else "real time"
+        hud.draw(screen, "sim", f"{speedup} (F, +/-, TAB)  FPS: {clock.get_fps():.0f}", (200, 200, 200),
+                 (10, display_height - 30))
 
         pygame.display.flip()
-        clock.tick(60)
+        clock.tick(0 if sim.ticks_per_frame else FPS)
 
     pygame.quit()
     sys.exit()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Просмотр и проверка обученного ИИ")
+    parser.add_argument("--track", default="tracks/track_05.json")
+    parser.add_argument("--model", default="models/racer_model_1275000_steps.zip")
+    parser.add_argument("--fast", type=int, default=0, help="тиков физики на кадр (0 — реальное время)")
+    parser.add_argument("--headless", action="store_true", help="без окна, только прогон и время кругов")
+    parser.add_argument("--laps", type=int, default=10, help="сколько кругов проехать в режиме --headless")
+    parser.add_argument("--race", nargs="+", default=None, metavar="MODEL",
+                        help="гонка: модели (zip или npz), у каждой --cars-per-model машин")
+    parser.add_argument("--cars-per-model", type=int, default=1)
+    parser.add_argument("--record", default=None, metavar="PATH", help="записать заезд в файл повтора (.rpl)")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    run_ai_game()
\ No newline at end of file
+    args = parse_args()
+    if args.race:
+        run_ai_race(args.track, args.race, cars_per_model=args.cars_per_model, ticks_per_frame=args.fast)
+    elif args.headless:
+        run_ai_headless(AIAgent(args.model, args.track), laps=args.laps, record=args.record)
+    else:
+        run_ai_game(args.track, args.model, ticks_per_frame=args.fast, record=args.record)
@@ -0,0 +1,211 @@
+# track_fields.py
+# Предрасчитанные поля трассы для датчиков: расстояние до ближайшей стены (clearance) и таблица
+# длин лучей по направлениям. Считаются один раз и кэшируются рядом с файлом трассы (<трасса>.fields.npz),
+# после этого любой датчик стоит одно обращение к массиву — хоть 5 лучей, хоть 32.
+#
+# Сетка полей мельче тайлов: samples_per_tile ячеек на сторону тайла. Длина луча хранится для центра ячейки
+# и поправляется на смещение машины от центра вдоль луча; направления квантуются на angle_bins секторов.
+#
+# Пересобрать кэш вручную:
+#   python track_fields.py tracks/*.json
+
+import math
+import os
+import sys
+import zipfile
+import zlib
+
+import numpy as np
+
+FIELDS_VERSION = 1
+FIELDS_SUFFIX = ".fields.npz"
+DEFAULT_ANGLE_BINS = 72  # 5°: углы RAY_ANGLES (кратные 45°) попадают в сектора точно
+MAX_TABLE_BYTES = 256 * 1024 * 1024  # на больших трассах ячейка — целый тайл, чтобы таблица влезла
+
+
+class TrackFields:
+    def __init__(self, ray_table, clearance, cell_size, max_distance, wall_lut, tile_size, grid):
+        self.ray_table = ray_table  # (H, W, angle_bins) uint16, доля max_distance * 65535
+        self.clearance_map = clearance  # (H, W) float32, доля max_distance
+        self.cell_size = float(cell_size)
+        self.max_distance = float(max_distance)
+        self.angle_bins = ray_table.shape[2]
+        self.rows, self.cols = ray_table.shape[:2]
+        self.bin_scale = self.angle_bins / 360.0
+        self.wall_lut = wall_lut
+        self.tile_size = tile_size
+        self.grid = grid
+        # Направление центра каждого сектора — для поправки на смещение от центра ячейки
+        sector = np.radians(np.arange(self.angle_bins) / self.bin_scale)
+        self.sector_cos = np.cos(sector)
+        self.sector_sin = np.sin(sector)
+        self.sector_cos_list = self.sector_cos.tolist()
+        self.sector_sin_list = self.sector_sin.tolist()
+        # Для скалярных запросов: memoryview и списки индексируются без создания NumPy-скаляров
+        self.table_cells = memoryview(np.ascontiguousarray(ray_table))
+        self.clearance_cells = memoryview(np.ascontiguousarray(clearance, dtype=np.float32))
+        self.grid_cells = memoryview(np.ascontiguousarray(grid, dtype=np.uint8))
+        self.wall_list = [bool(v) for v in wall_lut]
+
+    def _in_wall(self, x, y):
+        tile_x = np.floor(np.asarray(x) / self.tile_size).astype(np.int64)
+        tile_y = np.floor(np.asarray(y) / self.tile_size).astype(np.int64)
+        height, width = self.grid.shape
+        inside = (tile_x >= 0) & (tile_x < width) & (tile_y >= 0) & (tile_y < height)
+        tiles = self.grid[np.clip(tile_y, 0, height - 1), np.clip(tile_x, 0, width - 1)]
+        return ~inside | self.wall_lut[tiles]
+
+    def ray_distances(self, x, y, angles):
+        # Как Track.cast_rays (нормированные расстояния), но табличным поиском; x, y, angles транслируются
+        x, y, angles = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                                           np.asarray(angles, dtype=np.float64))
+        cs = self.cell_size
+        col = np.clip(np.floor(x / cs).astype(np.int64), 0, self.cols - 1)
+        row = np.clip(np.floor(y / cs).astype(np.int64), 0, self.rows - 1)
+        sector = np.rint(angles * self.bin_scale).astype(np.int64) % self.angle_bins
+        dist = self.ray_table[row, col, sector] * (1.0 / 65535)
+        along = ((x - (col + 0.5) * cs) * self.sector_cos[sector] +
+                 (y - (row + 0.5) * cs) * self.sector_sin[sector]) / self.max_distance
+        dist = np.clip(dist - along, 0.0, 1.0)
+        return np.where(self._in_wall(x, y), 0.0, dist)
+
+    def ray_distance(self, x, y, angle):
+        # Скалярная версия ray_distances без NumPy-накладных на один луч
+        cs = self.cell_size
+        tile_x, tile_y = int(x // self.tile_size), int(y // self.tile_size)
+        height, width = self.grid.shape
+        if not (0 <= tile_x < width and 0 <= tile_y < height) or self.wall_list[self.grid_cells[tile_y, tile_x]]:
+            return 0.0
+        col = min(max(int(x // cs), 0), self.cols - 1)
+        row = min(max(int(y // cs), 0), self.rows - 1)
+        sector = round(angle * self.bin_scale) % self.angle_bins
+        dist = self.table_cells[row, col, sector] * (1.0 / 65535)
+        along = ((x - (col + 0.5) * cs) * self.sector_cos_list[sector] +
+                 (y - (row + 0.5) * cs) * self.sector_sin_list[sector]) / self.max_distance
+        return min(max(dist - along, 0.0), 1.0)
+
+    def clearance_at(self, x, y):
+        # Скалярная версия clearance
+        tile_x, tile_y = int(x // self.tile_size), int(y // self.tile_size)
+        height, width = self.grid.shape
+        if not (0 <= tile_x < width and 0 <= tile_y < height) or self.wall_list[self.grid_cells[tile_y, tile_x]]:
+            return 0.0
+        fx = x / self.cell_size - 0.5
+        fy = y / self.cell_size - 0.5
+        col, row = math.floor(fx), math.floor(fy)
+        wx, wy = fx - col, fy - row
+        c0, c1 = min(max(col, 0), self.cols - 1), min(max(col + 1, 0), self.cols - 1)
+        r0, r1 = min(max(row, 0), self.rows - 1), min(max(row + 1, 0), self.rows - 1)
+        m = self.clearance_cells
+        return float((m[r0, c0] * (1 - wx) + m[r0, c1] * wx) * (1 - wy) +
+                     (m[r1, c0] * (1 - wx) + m[r1, c1] * wx) * wy)
+
+    def clearance(self, x, y):
+        # Расстояние до ближайшей стены (доля max_distance), билинейно между центрами ячеек
+        fx = np.asarray(x, dtype=np.float64) / self.cell_size - 0.5
+        fy = np.asarray(y, dtype=np.float64) / self.cell_size - 0.5
+        col = np.floor(fx).astype(np.int64)
+        row = np.floor(fy).astype(np.int64)
+        wx, wy = fx - col, fy - row
+        c0, c1 = np.clip(col, 0, self.cols - 1), np.clip(col + 1, 0, self.cols - 1)
+        r0, r1 = np.clip(row, 0, self.rows - 1), np.clip(row + 1, 0, self.rows - 1)
+        m = self.clearance_map
+        value = ((m[r0, c0] * (1 - wx) + m[r0, c1] * wx) * (1 - wy) +
+                 (m[r1, c0] * (1 - wx) + m[r1, c1] * wx) * wy)
+        return np.where(self._in_wall(x, y), 0.0, value)
+
+
+def fields_path(track_path):
+    return os.path.splitext(track_path)[0] + FIELDS_SUFFIX
+
+
+def _cell_walls(track, samples):
+    # Стена ли каждая ячейка (ячейки тайла наследуют его покрытие)
+    walls = track.wall_lut[np.asarray(track.grid)]
+    return np.repeat(np.repeat(walls, samples, axis=0), samples, axis=1)
+
+
+def _clearance(walls, cell_size, max_distance):
+    # Евклидово расстояние до центра ближайшей стены минус полъячейки, с потолком max_distance.
+    # Два прохода окном ±K ячеек (сначала по строкам, затем по столбцам); за краем трассы — стена.
+    k = int(np.ceil(max_distance / cell_size)) + 1
+    rows, cols = walls.shape
+    inf = np.float64(k + 1)
+    padded = np.pad(walls, k, constant_values=True)
+
+    along_row = np.full((rows + 2 * k, cols), inf)
+    for d in range(-k, k + 1):
+        along_row = np.where(padded[:, k + d:k + d + cols], np.minimum(along_row, abs(d)), along_row)
+
+    best = np.full((rows, cols), inf * inf)
+    for d in range(-k, k + 1):
+        best = np.minimum(best, along_row[k + d:k + d + rows] ** 2 + d * d)
+    distance = (np.sqrt(best) - 0.5) * cell_size
+    return np.clip(distance / max_distance, 0.0, 1.0).astype(np.float32)
+
+
+def build_fields(track, max_distance, angle_bins=DEFAULT_ANGLE_BINS, samples_per_tile=None):
+    if samples_per_tile is None:
+        samples_per_tile = 2
+        if track.width * track.height * 4 * angle_bins * 2 > MAX_TABLE_BYTES:
+            samples_per_tile = 1
+    cell_size = track.tile_size / samples_per_tile
+    rows, cols = track.height * samples_per_tile, track.width * samples_per_tile
+
+    center_y, center_x = np.mgrid[0:rows, 0:cols]
+    center_x = (center_x + 0.5) * cell_size
+    center_y = (center_y + 0.5) * cell_size
+    ray_table = np.empty((rows, cols, angle_bins), dtype=np.uint16)
+    for sector in range(angle_bins):
+        dist = track.cast_rays(center_x, center_y, sector * 360.0 / angle_bins, max_distance)
+        ray_table[:, :, sector] = np.rint(dist * 65535)
+
+    clearance = _clearance(_cell_walls(track, samples_per_tile), cell_size, max_distance)
+    return TrackFields(ray_table, clearance, cell_size, max_distance, track.wall_lut, track.tile_size,
+                       np.asarray(track.grid))
+
+
+def _cache_key(track, max_distance, angle_bins):
+    grid = np.ascontiguousarray(np.asarray(track.grid, dtype=np.uint8))
+    walls = "".join(str(int(v)) for v in track.wall_lut[:8])
+    return (f"v{FIELDS_VERSION}:{zlib.crc32(grid.tobytes()):08x}:{grid.shape}:{track.tile_size}:"
+            f"{float(max_distance)}:{angle_bins}:{walls}")
+
+
+def load_fields(track, track_path=None, max_distance=None, angle_bins=DEFAULT_ANGLE_BINS):
+    # Поля из кэша рядом с трассой, если он собран для той же сетки и параметров; иначе собрать и сохранить
+    if max_distance is None:
+        from main import RAY_MAX_DISTANCE
+        max_distance = RAY_MAX_DISTANCE
+    key = _cache_key(track, max_distance, angle_bins)
+    path = fields_path(track_path) if track_path else None
+
+    if path and os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                if str(data["key"]) == key:
+                    return TrackFields(data["ray_table"], data["clearance"], float(data["cell_size"]), max_distance,
+                                       track.wall_lut, track.tile_size, np.asarray(track.grid))
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            pass  # битый кэш — пересобрать
+
+    fields = build_fields(track, max_distance, angle_bins)
+    if path:
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # поля одной трассы могут собирать несколько процессов сразу
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, key=np.str_(key), ray_table=fields.ray_table, clearance=fields.clearance_map,
+                         cell_size=np.float64(fields.cell_size))
+            os.replace(tmp_path, path)
+        except OSError:
+            pass  # каталог только для чтения — работаем без кэша
+    return fields
+
+
+if __name__ == "__main__":
+    from main import Track
+    for track_path in sys.argv[1:] or sorted(
+            os.path.join("tracks", f) for f in os.listdir("tracks") if f.endswith((".json", ".trk"))):
+        fields = load_fields(Track(track_path), track_path)
+        print(f"✅ {track_path} → {fields_path(track_path)} "
+              f"({fields.rows}x{fields.cols} ячеек, {fields.angle_bins} направлений)")
@@ -0,0 +1,266 @@
+# track_io.py
+# Загрузка и сохранение трасс: исходный JSON и компактный бинарный формат .trk.
+#
+# Сетка в JSON — либо список строк чисел (старые трассы), либо упакованная:
+#   "grid": {"encoding": "zlib+base64", "shape": [height, width], "data": "<base64 от zlib байтов по строкам>"}
+# Редактор пишет упакованную сетку (в десятки раз меньше файл), загрузка понимает обе.
+#
+# Формат .trk (little-endian):
+#   заголовок  <4sHHIIII>: магия b"ERTK", версия, резерв, width, height, tile_size, длина метаданных
+#   метаданные JSON (utf-8): name, start_position, checkpoints
+#   выравнивание нулями до GRID_ALIGN байт
+#   сетка      width * height байт (uint8, по строкам) — читается через np.memmap без копирования
+#
+# JSON-трасса разбирается один раз: результат кэшируется как .trk в tracks/.cache/<имя>-<хэш содержимого>.trk,
+# и все процессы (воркеры обучения, оценки) отображают одну и ту же сетку только для чтения.
+# Правка исходного JSON меняет хэш — старый кэш удаляется и собирается новый. Внутри процесса
+# повторная загрузка того же файла (по пути, mtime и размеру) не читает его заново.
+#
+# Запуск как скрипт конвертирует JSON-трассы в .trk, с --compact — переписывает JSON с упакованной сеткой:
+#   python track_io.py tracks/*.json
+#   python track_io.py --compact tracks/*.json
+
+import base64
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+
+import numpy as np
+
+TRACK_MAGIC = b"ERTK"
+TRACK_VERSION = 1
+BINARY_EXT = ".trk"
+GRID_ALIGN = 64
+HEADER = struct.Struct("<4sHHIIII")
+CACHE_DIR = ".cache"  # рядом с трассами
+CACHE_DIGEST_SIZE = 8  # байт хэша содержимого в имени кэша (16 hex-символов)
+GRID_ENCODING = "zlib+base64"
+
+_loaded = {}  # (путь, mtime, размер) -> данные трассы, уже загруженные этим процессом
+
+
+def load_track_data(path):
+    # Сетка общая для всех вызовов (только чтение); словарь, старт и чекпоинты — свои копии у каждого
+    stat = os.stat(path)
+    real_path = os.path.realpath(path)
+    key = (real_path, stat.st_mtime_ns, stat.st_size)
+    data = _loaded.get(key)
+    if data is None:
+        for stale in [k for k in _loaded if k[0] == real_path]:
+            del _loaded[stale]
+        data = load_track_binary(path) if path.endswith(BINARY_EXT) else load_track_cached(path)
+        _loaded[key] = data
+    return dict(data, start_position=dict(data['start_position']),
+                checkpoints=[dict(cp) for cp in data.get('checkpoints', [])])
+
+
+def load_track_json(path):
+    with open(path, 'rb') as f:
+        return _parse_track_json(f.read())
+
+
+def _parse_track_json(raw):
+    data = json.loads(raw)
+    data['grid'] = decode_grid(data['grid'])
+    return data
+
+
+def encode_grid(grid):
+    grid = np.ascontiguousarray(np.asarray(grid, dtype=np.uint8))
+    return {"encoding": GRID_ENCODING, "shape": list(grid.shape),
+            "data": base64.b64encode(zlib.compress(grid.tobytes(), 6)).decode('ascii')}
+
+
+def decode_grid(grid):
+    if not isinstance(grid, dict):
+        return np.ascontiguousarray(np.array(grid, dtype=np.uint8))
+    if grid.get("encoding") != GRID_ENCODING:
+        raise ValueError(f"Неизвестная упаковка сетки: {grid.get('encoding')}")
+    height, width = grid["shape"]
+    raw = zlib.decompress(base64.b64decode(grid["data"]))
+    return np.frombuffer(raw, dtype=np.uint8).reshape(height, width).copy()
+
+
+def save_track_json(data, path, compact=True):
+    # Атомарно: читатель (игра, воркеры, кэш .trk) видит либо старый файл, либо новый целиком
+    grid = np.asarray(data['grid'], dtype=np.uint8)
+    height, width = grid.shape
+    track_data = {
+        "name": data['name'],
+        "width": width,
+        "height": height,
+        "tile_size": data['tile_size'],
+        "grid": encode_grid(grid) if compact else grid.tolist(),
+        "start_position": data['start_position'],
+        "checkpoints": data.get('checkpoints', []),
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(track_data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def track_cache_path(json_path, digest):
+    name = os.path.splitext(os.path.basename(json_path))[0]
+    return os.path.join(os.path.dirname(json_path), CACHE_DIR, f"{name}-{digest}{BINARY_EXT}")
+
+
+def stale_cache_paths(json_path, cache_path):
+    # Прежние кэши этой трассы: ровно <имя>-<16 hex>.trk, чтобы не задеть трассы с именами вида <имя>-...
+    name = os.path.splitext(os.path.basename(json_path))[0]
+    pattern = re.compile(re.escape(name) + r"-[0-9a-f]{%d}" % (CACHE_DIGEST_SIZE * 2) + re.escape(BINARY_EXT))
+    cache_dir = os.path.dirname(cache_path)
+    return [os.path.join(cache_dir, entry) for entry in os.listdir(cache_dir)
+            if pattern.fullmatch(entry) and os.path.join(cache_dir, entry) != cache_path]
+
+
+def load_track_cached(json_path):
+    with open(json_path, 'rb') as f:
+        raw = f.read()
+    cache_path = track_cache_path(json_path, hashlib.blake2b(raw, digest_size=CACHE_DIGEST_SIZE).hexdigest())
+    if os.path.exists(cache_path):
+        try:
+            return load_track_binary(cache_path)
+        except (OSError, ValueError, struct.error):
+            pass  # битый кэш — пересобрать
+
+    data = _parse_track_json(raw)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        for stale in stale_cache_paths(json_path, cache_path):
+            os.remove(stale)
+        save_track_binary(data, cache_path)
+        return load_track_binary(cache_path)
+    except OSError:
+        return data  # каталог только для чтения — работаем без кэша
+
+
+def load_track_binary(path):
+    with open(path, 'rb') as f:
+        magic, version, _, width, height, tile_size, meta_len = HEADER.unpack(f.read(HEADER.size))
+        if magic != TRACK_MAGIC:
+            raise ValueError(f"{path}: не файл трассы .trk")
+        if version != TRACK_VERSION:
+            raise ValueError(f"{path}: неподдерживаемая версия формата {version}")
+        meta = json.loads(f.read(meta_len).decode('utf-8'))
+
+    # Сетка отображается из файла: все процессы делят одни и те же страницы кэша ОС
+    grid = np.memmap(path, dtype=np.uint8, mode='r', offset=_grid_offset(meta_len), shape=(height, width))
+    meta.update(width=width, height=height, tile_size=tile_size, grid=grid)
+    return meta
+
+
+def save_track_binary(data, path):
+    grid = np.ascontiguousarray(np.asarray(data['grid'], dtype=np.uint8))
+    height, width = grid.shape
+    meta = json.dumps({
+        "name": data['name'],
+        "start_position": data['start_position'],
+        "checkpoints": data.get('checkpoints', []),
+    }, ensure_ascii=False).encode('utf-8')
+
+    header = HEADER.pack(TRACK_MAGIC, TRACK_VERSION, 0, width, height, data['tile_size'], len(meta))
+    padding = _grid_offset(len(meta)) - len(header) - len(meta)
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # несколько процессов могут собирать один кэш одновременно
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(meta)
+        f.write(b"\0" * padding)
+        f.write(grid.tobytes())
+    os.replace(tmp_path, path)
+
+
+class BackgroundSaver:
+    # Сохранение трасс в фоновом потоке: снимок данных делается сразу в вызывающем потоке,
+    # упаковка и запись — в фоне. Пока поток занят, новые запросы на тот же путь схлопываются в последний.
+    # poll() возвращает завершённые записи: [(путь, None или исключение)].
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.results = []
+        self.thread = None
+
+    def save(self, data, path):
+        snapshot = dict(data, grid=np.array(data['grid'], dtype=np.uint8),
+                        start_position=dict(data['start_position']),
+                        checkpoints=[dict(cp) for cp in data.get('checkpoints', [])])
+        with self.lock:
+            self.pending[path] = snapshot
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="track-saver", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self.lock:
+                    if not self.pending:
+                        self.thread = None
+                        return
+                    path = next(iter(self.pending))
+                    snapshot = self.pending.pop(path)
+                try:
+                    directory = os.path.dirname(path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    save_track_json(snapshot, path)
+                    error = None
+                except Exception as e:  # любая ошибка записи — в результаты, поток продолжает очередь
+                    error = e
+                with self.lock:
+                    self.results.append((path, error))
+        finally:
+            # Поток сбрасывается при любом выходе, иначе следующие save не запустят новый, а wait() зависнет
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    @property
+    def busy(self):
+        with self.lock:
+            return self.thread is not None
+
+    def poll(self):
+        with self.lock:
+            results, self.results = self.results, []
+        return results
+
+    def wait(self):
+        while True:
+            with self.lock:
+                thread = self.thread
+            if thread is None:
+                return
+            thread.join()
+
+
+def convert_track(json_path, out_path=None):
+    if out_path is None:
+        out_path = os.path.splitext(json_path)[0] + BINARY_EXT
+    save_track_binary(load_track_json(json_path), out_path)
+    return out_path
+
+
+def _grid_offset(meta_len):
+    offset = HEADER.size + meta_len
+    return (offset + GRID_ALIGN - 1) // GRID_ALIGN * GRID_ALIGN
+
+
+if __name__ == "__main__":
+    compact = "--compact" in sys.argv[1:]
+    paths = [arg for arg in sys.argv[1:] if arg != "--compact"] or sorted(
+        os.path.join("tracks", f) for f in os.listdir("tracks") if f.endswith(".json"))
+    if compact:
+        for json_path in paths:
+            size = os.path.getsize(json_path)
+            save_track_json(load_track_json(json_path), json_path)
+            print(f"✅ {json_path}: {size} → {os.path.getsize(json_path)} байт")
+        sys.exit()
+    for json_path in paths:
+        out_path = convert_track(json_path)
+        print(f"✅ {json_path} → {out_path} ({os.path.getsize(json_path)} → {os.path.getsize(out_path)} байт)")
@@ -0,0 +1,253 @@
+# track_progress.py
+# Поле прогресса по трассе: для каждой ячейки проезжей части — расстояние вдоль трассы от линии старта
+# в направлении старта (геодезическое: обход по ячейкам шагами прямо и по диагонали, веса 5 и 7 ≈ 1 и √2).
+# С ним прогресс машины, езда не в ту сторону и засчитывание круга — одно обращение к массиву за тик.
+#
+# Линия старта — тайлы start_finish; если их нет, отрезок через стартовую позицию поперёк направления старта.
+# Ячейки линии — 0, волна уходит от линии только вперёд и обратно через линию не проходит, поэтому ячейки
+# сразу за линией получают почти длину круга. Недостижимые ячейки и трава — -1.
+# На открытых картах (асфальт вокруг островов травы) поле идёт по кратчайшему пути: на другой траектории
+# прогресс местами убывает, но за круг вперёд через линию набирается ровно длина круга.
+# Кэш — рядом с трассой (<трасса>.progress.npz), как у track_fields.
+#
+# Пересобрать кэш вручную:
+#   python track_progress.py tracks/*.json
+
+import heapq
+import math
+import os
+import sys
+import zipfile
+import zlib
+
+import numpy as np
+
+PROGRESS_VERSION = 1
+PROGRESS_SUFFIX = ".progress.npz"
+STEP_WEIGHTS = (5, 7)  # прямой и диагональный шаг волны
+MAX_FIELD_CELLS = 4_000_000  # больше — ячейка поля становится целым тайлом
+OFFSETS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+class TrackProgress:
+    def __init__(self, field, line, cell_size, lap_length):
+        self.field = field  # (H, W) float32, пиксели вдоль трассы от линии старта; -1 — вне трассы
+        self.line = line  # (H, W) bool, ячейки линии старта
+        self.cell_size = float(cell_size)
+        self.lap_length = float(lap_length)  # длина круга в пикселях; 0 — трасса не замкнута
+        self.rows, self.cols = field.shape
+        self.field_cells = memoryview(np.ascontiguousarray(field, dtype=np.float32))
+        self.line_cells = memoryview(np.ascontiguousarray(line, dtype=np.uint8))
+
+    @property
+    def closed(self):
+        return self.lap_length > 0
+
+    def _cell(self, x, y):
+        col, row = int(x // self.cell_size), int(y // self.cell_size)
+        if 0 <= col < self.cols and 0 <= row < self.rows:
+            return row, col
+        return None
+
+    def progress_at(self, x, y):
+        cell = self._cell(x, y)
+        return self.field_cells[cell] if cell is not None else -1.0
+
+    def on_line_at(self, x, y):
+        cell = self._cell(x, y)
+        return cell is not None and self.line_cells[cell] == 1
+
+    def delta_at(self, old, new):
+        # Продвижение вперёд между двумя отсчётами progress_at (через линию старта — по модулю круга)
+        if old < 0 or new < 0:
+            return 0.0
+        delta = new - old
+        half = self.lap_length / 2
+        if half:
+            if delta > half:
+                delta -= self.lap_length
+            elif delta < -half:
+                delta += self.lap_length
+        return delta
+
+    def progress(self, x, y):
+        # Векторный progress_at
+        col = np.floor(np.asarray(x, dtype=np.float64) / self.cell_size).astype(np.int64)
+        row = np.floor(np.asarray(y, dtype=np.float64) / self.cell_size).astype(np.int64)
+        inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        value = self.field[np.clip(row, 0, self.rows - 1), np.clip(col, 0, self.cols - 1)]
+        return np.where(inside, value, -1.0)
+
+    def delta(self, old, new):
+        # Векторный delta_at
+        old, new = np.asarray(old, dtype=np.float64), np.asarray(new, dtype=np.float64)
+        delta = new - old
+        if self.lap_length:
+            delta = (delta + self.lap_length / 2) % self.lap_length - self.lap_length / 2
+        return np.where((old < 0) | (new < 0), 0.0, delta)
+
+
+def progress_path(track_path):
+    return os.path.splitext(track_path)[0] + PROGRESS_SUFFIX
+
+
+def _start_line(track, drivable, samples, heading):
+    # Ячейки линии старта: тайлы start_finish, а без них — отрезок поперёк направления старта через стартовую
+    # позицию. Линия продлевается поперёк направления старта до травы, иначе волна обойдёт её по поребрику
+    rows, cols = drivable.shape
+    normal_x, normal_y = -heading[1], heading[0]
+    grid = np.asarray(track.grid)
+    if (grid == 3).any():
+        line = np.repeat(np.repeat(grid == 3, samples, axis=0), samples, axis=1) & drivable
+        step_x = int(np.sign(normal_x)) if abs(normal_x) > 0.38 else 0  # 0.38 ≈ sin 22.5°
+        step_y = int(np.sign(normal_y)) if abs(normal_y) > 0.38 else 0
+        for row, col in zip(*np.nonzero(line)):
+            for sign in (1, -1):
+                r, c = row + sign * step_y, col + sign * step_x
+                while 0 <= r < rows and 0 <= c < cols and drivable[r, c] and not line[r, c]:
+                    line[r, c] = True
+                    r, c = r + sign * step_y, c + sign * step_x
+        return line
+
+    line = np.zeros_like(drivable)
+    cell_size = track.tile_size / samples
+    start = track.start_pos
+    x0 = (start['x'] + 0.5) * track.tile_size
+    y0 = (start['y'] + 0.5) * track.tile_size
+    for sign in (1, -1):
+        # Шаг в полъячейки: соседние ячейки отрезка касаются хотя бы углом
+        for step in range(2 * max(rows, cols)):
+            t = sign * step * cell_size / 2
+            col, row = int((x0 + normal_x * t) // cell_size), int((y0 + normal_y * t) // cell_size)
+            if not (0 <= col < cols and 0 <= row < rows) or not drivable[row, col]:
+                break
+            line[row, col] = True
+    return line
+
+
+def _geodesic(passable, line, heading):
+    # Алгоритм Дейкстры с корзинами (веса — малые целые): каждая корзина — одно расстояние, обрабатывается
+    # целиком массивами. passable и line — с рамкой в одну непроходимую ячейку, чтобы сдвиги не заворачивали
+    # на соседнюю строку. Диагональный шаг запрещён, если занят любой из двух соседних прямых (не срезаем
+    # углы стен и не проскакиваем линию старта наискосок). Возвращает расстояния (int32, -1 — недостижимо)
+    # и длину круга в тех же единицах (0 — линия не замкнута)
+    rows, cols = passable.shape
+    flat = passable.reshape(-1)
+    straight, diagonal = STEP_WEIGHTS
+    shift = np.array([dy * cols + dx for dx, dy in OFFSETS], dtype=np.int64)
+    # Прямые соседи для угловой проверки (у прямого шага оба совпадают с самим шагом)
+    side_a = np.array([dx if dx else dy * cols for dx, dy in OFFSETS], dtype=np.int64)
+    side_b = np.array([dy * cols if dy else dx for dx, dy in OFFSETS], dtype=np.int64)
+    weight = np.array([diagonal if dx and dy else straight for dx, dy in OFFSETS], dtype=np.int32)
+    facing = np.array([dx * heading[0] + dy * heading[1] for dx, dy in OFFSETS])
+
+    def neighbours(cells, columns):
+        nb = cells[:, None] + shift[columns]
+        ok = flat[nb] & flat[cells[:, None] + side_a[columns]] & flat[cells[:, None] + side_b[columns]]
+        return nb, ok
+
+    unreached = np.iinfo(np.int32).max
+    dist = np.full(rows * cols, unreached, dtype=np.int32)
+    line_cells = np.flatnonzero(line)
+    dist[line_cells] = 0
+    buckets = {0: [line_cells]}
+    heap = [0]
+    forward = np.flatnonzero(facing > 1e-9)
+    every = np.arange(len(OFFSETS))
+    while heap:
+        d = heapq.heappop(heap)
+        cells = np.unique(np.concatenate(buckets.pop(d)))
+        cells = cells[dist[cells] == d]
+        if not cells.size:
+            continue
+        columns = forward if d == 0 else every  # от линии старта — только вперёд
+        nb, ok = neighbours(cells, columns)
+        cand = np.broadcast_to(d + weight[columns], nb.shape)
+        ok &= cand < dist[nb]
+        nb, cand = nb[ok], cand[ok]
+        if not nb.size:
+            continue
+        order = np.lexsort((cand, nb))
+        nb, cand = nb[order], cand[order]
+        first = np.concatenate(([True], nb[1:] != nb[:-1]))
+        nb, cand = nb[first], cand[first]
+        dist[nb] = cand
+        for value in (d + straight, d + diagonal):
+            reached = nb[cand == value]
+            if reached.size:
+                if value not in buckets:
+                    buckets[value] = []
+                    heapq.heappush(heap, value)
+                buckets[value].append(reached)
+
+    # Круг замыкается шагом назад через линию: из ячейки за линией в ячейку линии
+    lap = 0
+    backward = np.flatnonzero(facing < -1e-9)
+    if line_cells.size and backward.size:
+        nb, ok = neighbours(line_cells, backward)
+        ok &= dist[nb] != unreached
+        if ok.any():
+            lap = int((dist[nb] + weight[backward])[ok].min())
+    dist[dist == unreached] = -1
+    return dist.reshape(rows, cols), lap
+
+
+def build_progress(track, samples_per_tile=None):
+    if samples_per_tile is None:
+        samples_per_tile = 2 if track.width * track.height * 4 <= MAX_FIELD_CELLS else 1
+    cell_size = track.tile_size / samples_per_tile
+    grid = np.asarray(track.grid)
+    drivable = np.repeat(np.repeat(grid != 0, samples_per_tile, axis=0), samples_per_tile, axis=1)
+    angle = math.radians(track.start_pos.get('angle', 0))
+    heading = (math.cos(angle), math.sin(angle))
+    line = _start_line(track, drivable, samples_per_tile, heading)
+
+    dist, lap = _geodesic(np.pad(drivable & ~line, 1), np.pad(line, 1), heading)
+    dist = dist[1:-1, 1:-1]
+    scale = cell_size / STEP_WEIGHTS[0]
+    field = np.where(dist >= 0, dist * scale, -1.0).astype(np.float32)
+    return TrackProgress(field, line, cell_size, lap * scale)
+
+
+def _cache_key(track):
+    grid = np.ascontiguousarray(np.asarray(track.grid, dtype=np.uint8))
+    start = track.start_pos
+    return (f"v{PROGRESS_VERSION}:{zlib.crc32(grid.tobytes()):08x}:{grid.shape}:{track.tile_size}:"
+            f"{start['x']}:{start['y']}:{start.get('angle', 0)}")
+
+
+def load_progress(track, track_path=None):
+    # Поле из кэша рядом с трассой, если оно собрано для той же сетки и старта; иначе собрать и сохранить
+    key = _cache_key(track)
+    path = progress_path(track_path) if track_path else None
+
+    if path and os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                if str(data["key"]) == key:
+                    return TrackProgress(data["field"], data["line"], float(data["cell_size"]),
+                                         float(data["lap_length"]))
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            pass  # битый кэш — пересобрать
+
+    progress = build_progress(track)
+    if path:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, key=np.str_(key), field=progress.field, line=progress.line,
+                         cell_size=np.float64(progress.cell_size), lap_length=np.float64(progress.lap_length))
+            os.replace(tmp_path, path)
+        except OSError:
+            pass  # каталог только для чтения — работаем без кэша
+    return progress
+
+
+if __name__ == "__main__":
+    from main import Track
+    for track_path in sys.argv[1:] or sorted(
+            os.path.join("tracks", f) for f in os.listdir("tracks") if f.endswith((".json", ".trk"))):
+        track = Track(track_path)
+        progress = load_progress(track, track_path)
+        length = f"круг {progress.lap_length / track.tile_size:.0f} тайлов" if progress.closed else "не замкнута"
+        print(f"✅ {track_path} → {progress_path(track_path)} ({progress.rows}x{progress.cols} ячеек, {length})")
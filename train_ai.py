@@ -1,62 +1,172 @@
 # train_ai.py
+#
+# Примеры:
+#   python train_ai.py                                   # трек по умолчанию, воркеры по числу ядер
+#   python train_ai.py --workers 16 --envs-per-worker 64
+#   python train_ai.py --track-per-worker                # каждому воркеру своя трасса из tracks/
+#   python train_ai.py --rays 24 --ray-table --clearance # 24 луча из таблицы полей трассы + расстояние до стены
+#   python train_ai.py --progress-reward 0.5             # + награда за продвижение вдоль трассы (track_progress)
+#   python train_ai.py --keep 3 --eval-tracks tracks/track_02.json  # хранить 3 лучших снимка по оценке на track_02
 
-import pygame
-pygame.init()
-pygame.display.set_mode((1, 1), pygame.HIDDEN)
-
+import argparse
+import glob
+import math
 import os
-import gymnasium as gym
+
 from stable_baselines3 import PPO
-from stable_baselines3.common.callbacks import CheckpointCallback
 from stable_baselines3.common.env_checker import check_env
-from main import GymRacerEnv
+from stable_baselines3.common.vec_env import VecMonitor
+from main import GymRacerEnv, SensorConfig, sensors_path
+from policy_export import export_policy
+from snapshots import SnapshotCallback
+from vec_env import VecRacerEnv, ShmSubprocVecEnv
 import torch
-torch.set_num_threads(torch.get_num_threads())
-torch.set_num_threads(8)  #Количество используемых ядер процессора для обчуения
-
-# === Настройки ===
-track_path = "tracks/track_01.json" #трек на котором тренируется
-model_save_dir = "./models/"
-os.makedirs(model_save_dir, exist_ok=True)
-
-# === Создание среды ===
-env = GymRacerEnv(track_path)
-print("Проверка среды...")
-check_env(env, warn=True)
-print("✅ Среда прошла проверку!")
-
-checkpoint_callback = CheckpointCallback(
-    save_freq=25_000, # раз в сколько шагов ИИ сохраняется
-    save_path=model_save_dir,
-    name_prefix="racer_model",
-    save_replay_buffer=False,
-    save_vecnormalize=False
-)
-
-# === Модель ===
-model = PPO(
-    "MlpPolicy",
-    env,
-    verbose=1,
-    tensorboard_log="./logs/",
-    learning_rate=3e-4,
-    n_steps=4096,
-    batch_size=128,
-    n_epochs=10,
-    gamma=0.99,
-    gae_lambda=0.95,
-    ent_coef=0.03,
-)
-
-# === Обучение  ===
-print("🚀 Начало обучения")
-model.learn(
-    total_timesteps=2_000_000, #количество шагов обучения
-    callback=checkpoint_callback,
-    progress_bar=True,
-    tb_log_name="racer_run"
-)
-
-# === Финальное сохранение ===
-model.save(os.path.join(model_save_dir, "final_model"))
-print("✅ Обучение завершено. Модель сохранена.")
\ No newline at end of file
+
+MIN_STEPS_PER_ENV = 16  # меньше — GAE по слишком коротким отрезкам
+BATCH_SIZE = 128
+
+
+def parse_args():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Обучение PPO на RacerEnv")
+    parser.add_argument("--track", default="tracks/track_01.json", help="трек на котором тренируется")
+    parser.add_argument("--track-per-worker", action="store_true",
+                        help="раздать воркерам по кругу все трассы из tracks/")
+    parser.add_argument("--workers", type=int, default=cpu_count // 2,
+                        help="число процессов-воркеров со средами (0 — всё в основном процессе)")
+    parser.add_argument("--envs-per-worker", type=int, default=64,
+                        help="сколько машин симулирует каждый воркер одним векторным шагом")
+    parser.add_argument("--torch-threads", type=int, default=None,
+                        help="потоки torch для обучения (по умолчанию — ядра, свободные от воркеров)")
+    parser.add_argument("--start-method", default=None, help="fork / forkserver / spawn")
+    parser.add_argument("--timesteps", type=int, default=2_000_000, help="количество шагов обучения")
+    parser.add_argument("--rollout-steps", type=int, default=None,
+                        help=f"шагов на один сбор данных, всего по всем машинам (по умолчанию 4096, но не меньше "
+                             f"{MIN_STEPS_PER_ENV} на машину); округляется вверх до кратного {BATCH_SIZE}")
+    parser.add_argument("--save-freq", type=int, default=25_000, help="раз в сколько шагов ИИ сохраняется")
+    parser.add_argument("--model-dir", default="./models/")
+    parser.add_argument("--keep", type=int, default=5,
+                        help="сколько лучших по оценке снимков хранить (с --no-eval — последних)")
+    parser.add_argument("--eval-tracks", nargs="+", default=None,
+                        help="трассы для оценки снимков в фоне (по умолчанию — трассы обучения)")
+    parser.add_argument("--eval-laps", type=int, default=2, help="кругов в оценочном заезде")
+    parser.add_argument("--no-eval", action="store_true", help="не оценивать снимки")
+    parser.add_argument("--rays", type=int, default=None, help="лучей веером (по умолчанию — 5 лучей RAY_ANGLES)")
+    parser.add_argument("--ray-spread", type=float, default=180.0, help="ширина веера лучей, градусы")
+    parser.add_argument("--ray-table", action="store_true",
+                        help="лучи из предрасчитанной таблицы трассы (track_fields) вместо точного обхода")
+    parser.add_argument("--clearance", action="store_true", help="добавить расстояние до ближайшей стены")
+    parser.add_argument("--progress-reward", type=float, default=0.0,
+                        help="добавка к награде за пиксель продвижения вдоль трассы (track_progress), "
+                             "назад — штраф; 0 — выключено")
+    args = parser.parse_args()
+    if args.track_per_worker and args.workers <= 0:
+        parser.error("--track-per-worker требует воркеров (--workers > 0): без них обучение идёт на одной трассе")
+    if args.torch_threads is None:
+        args.torch_threads = max(1, cpu_count - args.workers)
+    num_envs = args.envs_per_worker * max(args.workers, 1)  # как в make_env
+    min_rollout = MIN_STEPS_PER_ENV * num_envs
+    if args.rollout_steps is None:
+        args.rollout_steps = max(4096, min_rollout)
+    elif args.rollout_steps < min_rollout:
+        parser.error(f"--rollout-steps {args.rollout_steps} меньше {min_rollout}: это {MIN_STEPS_PER_ENV} шагов "
+                     f"на каждую из {num_envs} машин (уменьшите --workers / --envs-per-worker)")
+    return args
+
+
+def make_sensors(args):
+    if args.rays is None:
+        return SensorConfig(clearance=args.clearance, ray_table=args.ray_table)
+    return SensorConfig.fan(args.rays, args.ray_spread, clearance=args.clearance, ray_table=args.ray_table)
+
+
+def make_env(args, sensors):
+    if args.track_per_worker:
+        tracks = sorted(glob.glob(os.path.join("tracks", "*.json")))
+    else:
+        tracks = [args.track]
+
+    if args.workers <= 0:
+        env = VecRacerEnv(tracks[0], num_envs=args.envs_per_worker, sensors=sensors,
+                          progress_reward=args.progress_reward)
+    else:
+        worker_tracks = [tracks[i % len(tracks)] for i in range(args.workers)]
+        env = ShmSubprocVecEnv(worker_tracks, envs_per_worker=args.envs_per_worker,
+                               start_method=args.start_method, sensors=sensors,
+                               progress_reward=args.progress_reward)
+    return VecMonitor(env), tracks
+
+
+def rollout_n_steps(rollout_steps, num_envs):
+    # Шагов на машину за сбор: сбор целиком (n_steps * num_envs) делится на BATCH_SIZE без остатка
+    step = BATCH_SIZE // math.gcd(num_envs, BATCH_SIZE)
+    n_steps = max(MIN_STEPS_PER_ENV, rollout_steps // num_envs)
+    return -(-n_steps // step) * step
+
+
+def main():
+    args = parse_args()
+    torch.set_num_threads(args.torch_threads)  # Количество используемых ядер процессора для обучения
+    os.makedirs(args.model_dir, exist_ok=True)
+
+    # === Создание среды ===
+    print("Проверка среды...")
+    sensors = make_sensors(args)
+    check_env(GymRacerEnv(args.track, sensors, args.progress_reward), warn=True)
+    print("✅ Среда прошла проверку!")
+    env, tracks = make_env(args, sensors)
+    print(f"Среды: {env.num_envs} машин, воркеров: {args.workers}, потоков torch: {args.torch_threads}, "
+          f"трассы: {', '.join(tracks)}")
+
+    # Снимки пишутся и оцениваются в фоне, в папке остаются --keep лучших и best_model.zip
+    snapshot_callback = SnapshotCallback(
+        save_freq=max(1, args.save_freq // env.num_envs),  # считается в шагах на одну машину
+        save_path=args.model_dir,
+        name_prefix="racer_model",
+        keep=args.keep,
+        eval_tracks=[] if args.no_eval else args.eval_tracks or tracks,
+        eval_laps=args.eval_laps,
+        start_method=args.start_method,
+        sensors=sensors,
+    )
+
+    # === Модель ===
+    n_steps = rollout_n_steps(args.rollout_steps, env.num_envs)
+    print(f"Сбор данных: {n_steps} шагов x {env.num_envs} машин = {n_steps * env.num_envs} переходов")
+    model = PPO(
+        "MlpPolicy",
+        env,
+        verbose=1,
+        tensorboard_log="./logs/",
+        learning_rate=3e-4,
+        n_steps=n_steps,
+        batch_size=BATCH_SIZE,
+        n_epochs=10,
+        gamma=0.99,
+        gae_lambda=0.95,
+        ent_coef=0.03,
+    )
+
+    # === Обучение  ===
+    print("🚀 Начало обучения")
+    try:
+        model.learn(
+            total_timesteps=args.timesteps,
+            callback=snapshot_callback,
+            progress_bar=True,
+            tb_log_name="racer_run"
+        )
+    finally:
+        snapshot_callback.close()
+        env.close()
+
+    # === Финальное сохранение ===
+    final_path = os.path.join(args.model_dir, "final_model.zip")
+    model.save(final_path)
+    export_policy(final_path)
+    sensors.save(sensors_path(final_path))  # с этими датчиками модель и запускается
+    print("✅ Обучение завершено. Модель сохранена.")
+
+
+if __name__ == "__main__":
+    main()
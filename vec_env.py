@@ -0,0 +1,371 @@
+# vec_env.py
+# Пакетная среда: N машин на одной трассе, вся физика — массивами NumPy.
+# ShmSubprocVecEnv раскладывает несколько таких сред по процессам-воркерам.
+
+import multiprocessing as mp
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+import gymnasium as gym
+from stable_baselines3.common.vec_env import VecEnv
+
+from main import Track, Car, SURFACE_TYPES, ACTION_CONTROLS, SensorConfig
+from track_progress import load_progress
+
+# Клавиши для каждого действия (из ACTION_CONTROLS): газ, тормоз, влево, вправо, ручник
+ACTION_KEYS = np.array([(throttle, brake, steer < 0, steer > 0, handbrake)
+                        for throttle, brake, steer, handbrake in ACTION_CONTROLS], dtype=bool)
+
+
+class VecRacerEnv(VecEnv):
+    """N машин на одной трассе; шаг физики и наблюдения считаются одним вызовом для всех машин."""
+
+    render_mode = None
+
+    def __init__(self, track_path, num_envs=64, sensors=None, progress_reward=0.0):
+        self.track = Track(track_path)
+        self.tile_size = self.track.tile_size
+        self.sensors = sensors if sensors is not None else SensorConfig()
+        self.fields = self.sensors.load_fields(self.track, track_path)
+        # Добавка к награде за продвижение вдоль трассы (см. RacerEnv)
+        self.progress_reward = progress_reward
+        self.progress = load_progress(self.track, track_path) if progress_reward else None
+
+        # Сцепление по id покрытия (неизвестные id ведут себя как поребрик, как в get_surface_info)
+        self.traction_lut = np.full(256, SURFACE_TYPES[2]['traction'], dtype=np.float64)
+        for tile_id, surf in SURFACE_TYPES.items():
+            self.traction_lut[tile_id] = surf['traction']
+
+        start = self.track.start_pos
+        self.start_x = start['x'] * self.tile_size + self.tile_size // 2
+        self.start_y = start['y'] * self.tile_size + self.tile_size // 2
+        self.start_angle = start.get('angle', 0)
+        self.start_progress = -1.0
+        if self.progress is not None:
+            self.start_progress = self.progress.progress_at(self.start_x, self.start_y)
+
+        # Состояние машин
+        self.x = np.full(num_envs, self.start_x, dtype=np.float64)
+        self.y = np.full(num_envs, self.start_y, dtype=np.float64)
+        self.angle = np.full(num_envs, self.start_angle, dtype=np.float64)
+        self.speed = np.zeros(num_envs, dtype=np.float64)
+        self.brake_factor = np.ones(num_envs, dtype=np.float64)
+        self.last_checkpoint = np.full(num_envs, -1, dtype=np.int64)  # -1 = нет чекпоинта
+        self.last_progress = np.full(num_envs, self.start_progress, dtype=np.float64)
+
+        self.actions = np.zeros(num_envs, dtype=np.int64)
+        self.ray_angles = np.asarray(self.sensors.ray_angles, dtype=np.float64)
+
+        action_space = gym.spaces.Discrete(len(ACTION_KEYS))
+        observation_space = gym.spaces.Box(low=0.0, high=1.0, shape=(self.sensors.obs_size,), dtype=np.float32)
+        super().__init__(num_envs, observation_space, action_space)
+
+    # === Физика (векторная версия Car.update) ===
+    def physics_step(self, actions):
+        keys = ACTION_KEYS[actions]
+        gas, brake, left, right, handbrake = keys.T
+
+        speed = np.where(gas, self.speed + Car.acceleration, self.speed)
+        speed = np.clip(speed, -Car.max_speed / 2, Car.max_speed)
+        coasting = ~(gas | brake)
+        speed = np.where(coasting & (speed > 0), np.maximum(0.0, speed - Car.friction), speed)
+        speed = np.where(coasting & (speed < 0), np.minimum(0.0, speed + Car.friction), speed)
+        self.speed = speed
+
+        self.brake_factor = np.where(brake, np.maximum(0.0, self.brake_factor * Car.brake_decay), 1.0)
+
+        turn = Car.steering * (np.abs(speed) / Car.max_speed)
+        self.angle = self.angle - turn * left + turn * right
+
+        rad = np.radians(self.angle)
+        dx = speed * np.cos(rad)
+        dy = speed * np.sin(rad)
+
+        traction = self.traction_lut[self.track.tiles_at(self.x + dx, self.y + dy)] * self.brake_factor
+        traction = np.where(handbrake & (traction > 0), traction * Car.handbrake_traction, traction)
+
+        self.x = self.x + dx * traction
+        self.y = self.y + dy * traction
+
+    # === Наблюдения (векторная версия RacerEnv.get_state) ===
+    def cast_rays(self):
+        # Все лучи всех машин одним пакетом: (N, R)
+        angles = self.angle[:, None] + self.ray_angles
+        if self.sensors.ray_table:
+            return self.fields.ray_distances(self.x[:, None], self.y[:, None], angles)
+        return self.track.cast_rays(self.x[:, None], self.y[:, None], angles, self.sensors.max_distance)
+
+    def get_state(self):
+        min_speed = -Car.max_speed / 2
+        speed_range = Car.max_speed - min_speed
+        obs = np.empty((self.num_envs,) + self.observation_space.shape, dtype=np.float32)
+        obs[:, 0] = np.clip((self.speed - min_speed) / speed_range, 0.0, 1.0)
+        angle_rad = np.radians(self.angle)
+        obs[:, 1] = (np.sin(angle_rad) + 1.0) / 2.0
+        obs[:, 2] = (np.cos(angle_rad) + 1.0) / 2.0
+        n_rays = len(self.ray_angles)
+        obs[:, 3:3 + n_rays] = self.cast_rays()
+        if self.sensors.clearance:
+            obs[:, 3 + n_rays] = self.fields.clearance(self.x, self.y)
+        return obs
+
+    def reset_cars(self, mask):
+        self.x[mask] = self.start_x
+        self.y[mask] = self.start_y
+        self.angle[mask] = self.start_angle
+        self.speed[mask] = 0.0
+        self.brake_factor[mask] = 1.0
+        self.last_checkpoint[mask] = -1
+        self.last_progress[mask] = self.start_progress
+
+    # === Интерфейс VecEnv ===
+    def reset(self):
+        self.reset_cars(np.ones(self.num_envs, dtype=bool))
+        self._reset_seeds()
+        self._reset_options()
+        return self.get_state()
+
+    def step_async(self, actions):
+        self.actions = np.asarray(actions, dtype=np.int64).reshape(self.num_envs)
+
+    def step_wait(self):
+        self.physics_step(self.actions)
+
+        tiles = self.track.tiles_at(self.x, self.y)
+        dones = tiles == 0  # 🔴 Трава = смерть
+
+        rewards = np.where((tiles == 1) | (tiles == 3), 0.5 * self.speed, 0.0)  # бонус за скорость
+        rewards = np.where(tiles == 2, rewards - 0.5, rewards)  # curb — штраф
+        if self.progress is not None:
+            position = self.progress.progress(self.x, self.y)
+            rewards = rewards + self.progress_reward * self.progress.delta(self.last_progress, position)
+            self.last_progress = np.where(position >= 0, position, self.last_progress)
+        rewards = np.where(np.abs(self.speed) < 0.5, rewards - 1.0, rewards)
+
+        current_cp = self.track.checkpoints_at(self.x, self.y)
+        new_cp = (current_cp != -1) & (current_cp != self.last_checkpoint)
+        rewards = np.where(new_cp, rewards + 5.0, rewards)
+        self.last_checkpoint = np.where(dones, self.last_checkpoint, current_cp)
+        rewards = np.where(dones, -50.0, rewards).astype(np.float32)
+
+        obs = self.get_state()
+        infos = [{"TimeLimit.truncated": False} for _ in range(self.num_envs)]
+        if dones.any():
+            for i in np.flatnonzero(dones):
+                infos[i]["terminal_observation"] = obs[i].copy()
+            # Автосброс, как в DummyVecEnv
+            self.reset_cars(dones)
+            obs[dones] = self.get_state()[dones]
+        return obs, rewards, dones.copy(), infos
+
+    def close(self):
+        pass
+
+    def _indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [indices]
+        return indices
+
+    def get_attr(self, attr_name, indices=None):
+        value = getattr(self, attr_name)
+        return [value for _ in self._indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        method = getattr(self, method_name)
+        return [method(*method_args, **method_kwargs) for _ in self._indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._indices(indices)]
+
+    def get_images(self):
+        return [None for _ in range(self.num_envs)]
+
+
+# === Воркеры в подпроцессах ===
+class ShmSubprocVecEnv(VecEnv):
+    """K процессов, в каждом VecRacerEnv на M машин; наблюдения, награды и действия — в общей памяти."""
+
+    render_mode = None
+
+    def __init__(self, worker_tracks, envs_per_worker=32, start_method=None, sensors=None, progress_reward=0.0):
+        self.worker_tracks = list(worker_tracks)
+        self.envs_per_worker = envs_per_worker
+        n_workers = len(self.worker_tracks)
+        num_envs = n_workers * envs_per_worker
+
+        # Пространства одинаковы для всех трасс — берём из локальной среды на одну машину
+        probe = VecRacerEnv(self.worker_tracks[0], num_envs=1, sensors=sensors, progress_reward=progress_reward)
+        observation_space, action_space = probe.observation_space, probe.action_space
+        if probe.sensors.needs_fields or progress_reward:
+            # Кэш полей датчиков и прогресса собирается здесь, а не наперегонки в воркерах
+            for track_path in sorted(set(self.worker_tracks[1:])):
+                track = Track(track_path)
+                if probe.sensors.needs_fields:
+                    probe.sensors.load_fields(track, track_path)
+                if progress_reward:
+                    load_progress(track, track_path)
+
+        # Общие буферы: по трубам ходят только команды и редкие terminal_observation
+        self.shm = {}
+        self.buffers = {}
+        for name, shape, dtype in (("obs", (num_envs,) + observation_space.shape, np.float32),
+                                   ("rewards", (num_envs,), np.float32),
+                                   ("dones", (num_envs,), np.bool_),
+                                   ("actions", (num_envs,), np.int64)):
+            size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm[name] = shm
+            self.buffers[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        layout = {name: (shm.name, self.buffers[name].shape, self.buffers[name].dtype.str)
+                  for name, shm in self.shm.items()}
+
+        if start_method is None:
+            # fork небезопасен после импорта torch
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+        self.remotes, self.processes = [], []
+        for index, track_path in enumerate(self.worker_tracks):
+            remote, worker_remote = ctx.Pipe()
+            env_slice = (index * envs_per_worker, (index + 1) * envs_per_worker)
+            process = ctx.Process(target=_shm_worker,
+                                  args=(worker_remote, track_path, env_slice, layout, sensors, progress_reward),
+                                  daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        for remote in self.remotes:
+            remote.recv()  # среда воркера создана
+
+        self.waiting = False
+        self.closed = False
+        super().__init__(num_envs, observation_space, action_space)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        self._reset_seeds()
+        self._reset_options()
+        return self.buffers["obs"].copy()
+
+    def step_async(self, actions):
+        self.buffers["actions"][:] = np.asarray(actions, dtype=np.int64).reshape(self.num_envs)
+        for remote in self.remotes:
+            remote.send(("step", None))
+        self.waiting = True
+
+    def step_wait(self):
+        infos = [{"TimeLimit.truncated": False} for _ in range(self.num_envs)]
+        for remote in self.remotes:
+            for index, terminal_obs in remote.recv():
+                infos[index]["terminal_observation"] = terminal_obs
+        self.waiting = False
+        # Копия: SB3 держит ссылку на прошлые наблюдения, а буфер перезапишется на следующем шаге
+        return (self.buffers["obs"].copy(), self.buffers["rewards"].copy(),
+                self.buffers["dones"].copy(), infos)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.buffers.clear()
+        for shm in self.shm.values():
+            shm.close()
+            shm.unlink()
+        self.closed = True
+
+    def _worker_envs(self, indices):
+        # Индексы машин -> {воркер: [индексы]}
+        if indices is None:
+            indices = range(self.num_envs)
+        elif isinstance(indices, int):
+            indices = [indices]
+        by_worker = {}
+        for index in indices:
+            by_worker.setdefault(index // self.envs_per_worker, []).append(index)
+        return by_worker
+
+    def _call(self, command, payload, indices):
+        by_worker = self._worker_envs(indices)
+        for worker, envs in by_worker.items():
+            self.remotes[worker].send((command, payload))
+        results = []
+        for worker, envs in by_worker.items():
+            value = self.remotes[worker].recv()
+            results.extend(value for _ in envs)
+        return results
+
+    def get_attr(self, attr_name, indices=None):
+        return self._call("get_attr", attr_name, indices)
+
+    def set_attr(self, attr_name, value, indices=None):
+        self._call("set_attr", (attr_name, value), indices)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return self._call("env_method", (method_name, method_args, method_kwargs), indices)
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        if indices is None:
+            return [False for _ in range(self.num_envs)]
+        return [False for _ in ([indices] if isinstance(indices, int) else indices)]
+
+    def get_images(self):
+        return [None for _ in range(self.num_envs)]
+
+
+def _shm_worker(remote, track_path, env_slice, layout, sensors=None, progress_reward=0.0):
+    if "torch" in sys.modules:
+        # Воркеру не нужны потоки torch: ядра остаются обучению
+        sys.modules["torch"].set_num_threads(1)
+
+    start, end = env_slice
+    shms = {name: shared_memory.SharedMemory(name=shm_name) for name, (shm_name, _, _) in layout.items()}
+    buffers = {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shms[name].buf)[start:end]
+               for name, (_, shape, dtype) in layout.items()}
+
+    env = VecRacerEnv(track_path, num_envs=end - start, sensors=sensors, progress_reward=progress_reward)
+    remote.send(None)
+    try:
+        while True:
+            command, payload = remote.recv()
+            if command == "step":
+                env.step_async(buffers["actions"].copy())
+                obs, rewards, dones, infos = env.step_wait()
+                buffers["obs"][:] = obs
+                buffers["rewards"][:] = rewards
+                buffers["dones"][:] = dones
+                remote.send([(start + i, info["terminal_observation"])
+                             for i, info in enumerate(infos) if "terminal_observation" in info])
+            elif command == "reset":
+                buffers["obs"][:] = env.reset()
+                remote.send(None)
+            elif command == "get_attr":
+                remote.send(getattr(env, payload))
+            elif command == "set_attr":
+                remote.send(setattr(env, *payload))
+            elif command == "env_method":
+                method_name, args, kwargs = payload
+                remote.send(getattr(env, method_name)(*args, **kwargs))
+            elif command == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        buffers.clear()
+        for shm in shms.values():
+            shm.close()
+        remote.close()